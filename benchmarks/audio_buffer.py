@@ -0,0 +1,76 @@
+"""Compares the np.append audio buffer of the online processors with the growable AudioBuffer.
+
+Simulates one long session per speaker: chunks are appended and, once the buffer is longer than the
+trimming threshold, the head is trimmed back the way chunk_at does, with a view taken for every pass like
+the one handed to asr.transcribe. Reports chunks per second and the average cost of a chunk over the
+first and last minute, which stays flat for AudioBuffer.
+
+Usage:
+    python -m benchmarks.audio_buffer [--minutes 60] [--chunk 1.0] [--trim 15] [--speakers 1]
+"""
+#Default libraries
+import argparse
+import time
+
+import numpy as np
+
+from sinks.whisper_stream.audio_buffer import AudioBuffer
+
+SAMPLING_RATE = 16000
+
+class AppendBuffer:
+    """The old buffer: np.append on insert, a new slice on trim."""
+
+    def __init__(self):
+        self.audio_buffer = np.array([], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.audio_buffer)
+
+    def append(self, audio):
+        self.audio_buffer = np.append(self.audio_buffer, audio)
+
+    def trim(self, n):
+        self.audio_buffer = self.audio_buffer[n:]
+
+    def view(self):
+        return self.audio_buffer
+
+def run(make, chunks, chunk, trim, speakers):
+    buffers = [make() for _ in range(speakers)]
+    times = []
+    start_time = time.perf_counter()
+    for i in range(chunks):
+        chunk_start = time.perf_counter()
+        for buffer in buffers:
+            buffer.append(chunk)
+            if len(buffer) > trim:
+                #chunk_at keeps the part after the last committed segment, a few seconds
+                buffer.trim(len(buffer) - 3 * SAMPLING_RATE)
+            buffer.view()
+        times.append(time.perf_counter() - chunk_start)
+    return time.perf_counter() - start_time, times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--chunk", type=float, default=1.0, help="Seconds per inserted chunk")
+    parser.add_argument("--trim", type=float, default=15, help="Buffer length in seconds that triggers a trim")
+    parser.add_argument("--speakers", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    chunk = np.random.default_rng(0).normal(0, 0.1, int(args.chunk * SAMPLING_RATE)).astype(np.float32)
+    chunks = int(args.minutes * 60 / args.chunk)
+    per_minute = max(int(60 / args.chunk), 1)
+    trim = int(args.trim * SAMPLING_RATE)
+
+    print(f"{args.minutes:g} min sessions, {args.chunk:g}s chunks, trimmed past {args.trim:g}s, {args.speakers} speakers")
+    print(f"{'buffer':>12}{'chunks/s':>12}{'first min us':>14}{'last min us':>13}")
+    for name, make in (("np.append", AppendBuffer), ("AudioBuffer", lambda: AudioBuffer(trim))):
+        elapsed, times = run(make, chunks, chunk, trim, args.speakers)
+        first = np.mean(times[:per_minute]) * 1e6
+        last = np.mean(times[-per_minute:]) * 1e6
+        print(f"{name:>12}{chunks / elapsed:>12.0f}{first:>14.1f}{last:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Replays a spoken transcript through OnlineASRProcessor to compare buffer trimming options.
+
+Every process_iter decodes the whole audio buffer again, so the buffer length is what each ASR call
+costs. A fake ASR stands in for Whisper: it "hears" the words of a script that fall inside the buffer,
+with whisper-like segments ending at sentence ends. Everything else (commits, sentence splitting,
+trimming) is the real code. Reports the seconds of audio decoded per iteration and in total per second
+of speech, and checks every option commits the same text.
+
+Usage:
+    python -m benchmarks.buffer_trimming [--minutes 10] [--chunk 1.0] [--text transcript.txt]
+"""
+#Default libraries
+import argparse
+import random
+
+import numpy as np
+
+from sinks.whisper_stream.whisper_online import OnlineASRProcessor
+
+SAMPLING_RATE = 16000
+WORD = 0.4
+
+OPTIONS = [("segment", 15), ("sentence", 10), ("sentence", 6), ("sentence", 4)]
+
+SENTENCES = [
+    "Okay so I think we should push to the left side.",
+    "Did anyone see where Mr. Smith went?",
+    "No.",
+    "I was in the kitchen making tea, and then the dog started barking at nothing.",
+    "That's wild!",
+    "We can try again at 7 p.m. if everyone is free.",
+    "Honestly the last update broke half of my settings and I had to redo them all.",
+    "Sure, sounds good.",
+]
+
+def make_script(words_needed, text=None, seed=0):
+    if text is not None:
+        with open(text, encoding="utf-8") as file:
+            words = file.read().split()
+    else:
+        rng = random.Random(seed)
+        words = []
+        while len(words) < words_needed:
+            words.extend(rng.choice(SENTENCES).split())
+    return [(i * WORD, (i + 1) * WORD, " " + word) for i, word in enumerate(words[:words_needed])]
+
+class ScriptASR:
+    """Returns the script words inside the buffer, one segment per sentence."""
+    sep = ""
+
+    def __init__(self, script):
+        self.script = script
+        self.online = None
+        self.decoded = []
+
+    def transcribe(self, audio, init_prompt=""):
+        offset = self.online.buffer_time_offset
+        self.decoded.append(len(audio) / SAMPLING_RATE)
+        end = offset + len(audio) / SAMPLING_RATE
+        return [(b - offset, e - offset, w) for b, e, w in self.script if b >= offset - 0.01 and e <= end + 0.01]
+
+    def ts_words(self, res):
+        return res
+
+    def segments_end_ts(self, res):
+        ends = [e for _, e, w in res if w.rstrip().endswith((".", "!", "?"))]
+        if res and (not ends or ends[-1] != res[-1][1]):
+            ends.append(res[-1][1])
+        return ends
+
+def run(script, option, chunk, seconds):
+    asr = ScriptASR(script)
+    online = OnlineASRProcessor(asr, buffer_trimming=option)
+    asr.online = online
+    audio = np.zeros(int(chunk * SAMPLING_RATE), dtype=np.float32)
+    committed = []
+    for _ in range(int(seconds / chunk)):
+        online.insert_audio_chunk(audio)
+        committed.append(online.process_iter()[2])
+    committed.append(online.finish()[2])
+    return asr.decoded, "".join(committed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, default=10)
+    parser.add_argument("--chunk", type=float, default=1.0, help="Seconds of audio per process_iter")
+    parser.add_argument("--text", default=None, help="Transcript to replay, sample sentences when left out")
+    args = parser.parse_args(argv)
+
+    seconds = args.minutes * 60
+    script = make_script(int(seconds / WORD), args.text)
+    seconds = script[-1][1]
+    print(f"{seconds / 60:.1f} min of speech, {len(script)} words, process_iter every {args.chunk:g}s")
+    print(f"{'trimming':>16}{'mean s/iter':>13}{'max s/iter':>12}{'decoded s per s':>17}  text")
+    reference = None
+    for option in OPTIONS:
+        decoded, text = run(script, option, args.chunk, seconds)
+        if reference is None:
+            reference = text
+        same = "same" if text == reference else "DIFFERENT"
+        name = f"{option[0]} {option[1]}"
+        print(f"{name:>16}{np.mean(decoded):>13.2f}{np.max(decoded):>12.2f}{sum(decoded) / seconds:>17.2f}  {same}")
+
+if __name__ == "__main__":
+    main()
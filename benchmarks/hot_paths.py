@@ -0,0 +1,283 @@
+"""Microbenchmarks of the CPU only hot paths of streaming ASR, compared against stored baselines.
+
+Every case runs on deterministic synthetic input of realistic size with the models stubbed out, so the
+numbers only cover this project's own code. Each case is timed with timeit after a warm-up pass: the
+best of --repeat runs, as seconds per call. Cases whose dependencies are not installed are skipped.
+
+Compare mode (the default) checks every case against benchmarks/baselines/hot_paths.json and exits with
+status 1 when one got slower than the baseline by more than --threshold. A case over the threshold is
+measured again up to --retries times and only reported when it stays over, so one noisy run on a busy
+machine does not count. --save stores the results as
+the new baseline for the cases that ran. Baselines depend on the machine, save them on the one you
+compare on.
+
+Usage:
+    python -m benchmarks.hot_paths [--cases process_iter vad_iterator] [--threshold 0.25] [--save]
+"""
+#Default libraries
+import argparse
+import asyncio
+import json
+import os
+import platform
+import timeit
+
+import numpy as np
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines", "hot_paths.json")
+
+SAMPLING_RATE = 16000
+DISCORD_SAMPLING = 48000
+WORD = 0.4
+
+TRANSCRIPTS = [
+    " So I was thinking we could try the other route this time.",
+    " Thank you for watching!",
+    " Yeah yeah yeah yeah yeah yeah yeah yeah",
+    " Can you turn the music down a little, it is really loud on my end.",
+    " Okay.",
+]
+
+#Each case is a setup function returning the zero argument callable that is timed
+CASES = {}
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+def speech(seconds, rate=SAMPLING_RATE, seed=0):
+    """Noise bursts of one second every two seconds, float32 in [-1, 1]."""
+    rng = np.random.default_rng(seed)
+    audio = np.zeros(int(seconds * rate), dtype=np.float32)
+    for start in range(0, len(audio), 2 * rate):
+        audio[start:start + rate] = rng.normal(0, 0.2, len(audio[start:start + rate]))
+    return np.clip(audio, -1, 1)
+
+def discord_packets(seconds, seed=0):
+    """20ms packets of 48kHz stereo 16 bit PCM like py-cord hands to sinks."""
+    mono = (speech(seconds, DISCORD_SAMPLING, seed) * 32767).astype(np.int16)
+    stereo = np.repeat(mono, 2).tobytes()
+    packet = DISCORD_SAMPLING // 50 * 4
+    return [stereo[i:i + packet] for i in range(0, len(stereo), packet)]
+
+def timed_words(first, last, offset=0.0):
+    return [(i * WORD - offset, (i + 1) * WORD - offset, f" w{i}") for i in range(first, last)]
+
+@case("hypothesis_buffer")
+def hypothesis_buffer():
+    from sinks.whisper_stream.whisper_online import HypothesisBuffer
+    #Two passes over a 15s buffer agreeing on its words, then a pass that moved on by a second
+    first = timed_words(0, 37)
+    second = timed_words(2, 40)
+
+    def run():
+        buffer = HypothesisBuffer()
+        buffer.insert(first, 0)
+        buffer.flush()
+        buffer.insert(first, 0)
+        buffer.flush()
+        buffer.insert(second, 0)
+        buffer.flush()
+    return run
+
+@case("process_iter")
+def process_iter():
+    from sinks.whisper_stream.whisper_online import ASRBase, OnlineASRProcessor
+
+    class StubASR(ASRBase):
+        """Hears a word every WORD seconds and ends a segment every 3 seconds, at no cost."""
+        sep = ""
+
+        def __init__(self):
+            super().__init__("en")
+            self.online = None
+
+        def load_model(self, *args, **kwargs):
+            return None
+
+        def transcribe(self, audio, init_prompt=""):
+            return self.online.buffer_time_offset, len(audio) / SAMPLING_RATE
+
+        def ts_words(self, res):
+            offset, seconds = res
+            return timed_words(int(np.ceil(offset / WORD)), int((offset + seconds) / WORD), offset)
+
+        def segments_end_ts(self, res):
+            offset, seconds = res
+            return [i * 3.0 - offset for i in range(int(np.ceil(offset / 3.0)), int((offset + seconds) / 3.0) + 1)]
+
+    asr = StubASR()
+    online = OnlineASRProcessor(asr)
+    asr.online = online
+    chunk = speech(1.0)
+    #Into the steady state where the buffer is trimmed regularly
+    for _ in range(30):
+        online.insert_audio_chunk(chunk)
+        online.process_iter()
+
+    def run():
+        online.insert_audio_chunk(chunk)
+        online.process_iter()
+    return run
+
+@case("vad_iterator")
+def vad_iterator():
+    from sinks.whisper_stream.silero_vad_engine import BatchedVAD, BatchedVADIterator
+
+    def stub_silero(x, state, sampling_rate):
+        """Energy instead of the model, called like OnnxSilero."""
+        return (np.abs(x).mean(axis=1) > 0.05).astype(np.float32), state
+
+    #The iterator VACOnlineASRProcessor runs, with one stream
+    iterator = BatchedVADIterator(BatchedVAD(stub_silero))
+    audio = speech(10.0)
+    chunks = [audio[i:i + SAMPLING_RATE // 10] for i in range(0, len(audio), SAMPLING_RATE // 10)]
+    position = [0]
+
+    def run():
+        iterator(chunks[position[0] % len(chunks)])
+        position[0] += 1
+    return run
+
+def stream_speaker():
+    from sinks.stream_sink import Speaker
+    loop = asyncio.new_event_loop()
+    return loop, Speaker(loop, asyncio.Queue(), min_chunk=500, scheduler=None)
+
+@case("convert_audio")
+def convert_audio():
+    loop, speaker = stream_speaker()
+    data = b"".join(discord_packets(0.5))
+
+    def run():
+        speaker.convert_audio(data)
+    return run
+
+@case("recieve_audio_chunk")
+def recieve_audio_chunk():
+    loop, speaker = stream_speaker()
+    packets = discord_packets(0.5)
+
+    def run():
+        speaker.data = list(packets)
+        loop.run_until_complete(speaker.recieve_audio_chunk())
+    return run
+
+@case("is_valid_phrase")
+def is_valid_phrase():
+    #WhisperSink.is_valid_phrase and the stream sinks run this check, timed here without importing
+    #whisper_sink, which needs torch and speech_recognition
+    from sinks.phrase_filter import phrase_filter
+    position = [0]
+
+    def run():
+        phrase_filter.is_valid(TRANSCRIPTS[position[0] % len(TRANSCRIPTS)])
+        position[0] += 1
+    return run
+
+@case("silence_gate")
+def silence_gate():
+    from sinks.silence_gate import SilenceGate
+    gate = SilenceGate()
+    packets = discord_packets(4.0)
+    position = [0]
+
+    def run():
+        gate.filter(1, packets[position[0] % len(packets)])
+        position[0] += 1
+    return run
+
+@case("audio_buffer")
+def audio_buffer():
+    from sinks.whisper_stream.audio_buffer import AudioBuffer
+    buffer = AudioBuffer(15 * SAMPLING_RATE)
+    chunk = speech(0.5)
+
+    def run():
+        buffer.append(chunk)
+        if len(buffer) > 15 * SAMPLING_RATE:
+            buffer.trim(len(buffer) - 3 * SAMPLING_RATE)
+        buffer.view()
+    return run
+
+@case("sentence_splitter")
+def sentence_splitter():
+    from sinks.whisper_stream.sentence_splitter import SentenceSplitter
+    splitter = SentenceSplitter()
+    #About 15 seconds of speech, what sentence trimming splits on every commit
+    text = " ".join(TRANSCRIPTS * 2)
+
+    def run():
+        splitter.split(text)
+    return run
+
+def measure(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    #Warm-up pass, caches, allocator and lazily built state settle before anything is timed
+    timer.timeit(number)
+    return min(timer.repeat(repeat, number)) / number
+
+def load_baselines():
+    if not os.path.exists(BASELINES):
+        return {"cases": {}}
+    with open(BASELINES, encoding="utf-8") as file:
+        return json.load(file)
+
+def save_baselines(baselines, results):
+    baselines["cases"].update({name: {"seconds": seconds} for name, seconds in results.items()})
+    baselines["machine"] = {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()}
+    os.makedirs(os.path.dirname(BASELINES), exist_ok=True)
+    with open(BASELINES, "w", encoding="utf-8") as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--threshold", type=float, default=0.25, help="Slowdown over the baseline that counts as a regression, 0.25 is 25%%")
+    parser.add_argument("--retries", type=int, default=2, help="Times a case over the threshold is measured again before it counts")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baselines instead of comparing")
+    args = parser.parse_args(argv)
+
+    baselines = load_baselines()
+    results = {}
+    regressions = []
+    print(f"{'case':>20}{'us/call':>12}{'baseline':>12}{'change':>9}")
+    for name in args.cases:
+        try:
+            fn = CASES[name]()
+        except ImportError as e:
+            print(f"{name:>20}  skipped: {e}")
+            continue
+        seconds = measure(fn, args.repeat)
+        baseline = baselines["cases"].get(name, {}).get("seconds")
+        if baseline is None:
+            results[name] = seconds
+            print(f"{name:>20}{seconds * 1e6:>12.2f}{'-':>12}")
+            continue
+        for _ in range(0 if args.save else args.retries):
+            if seconds / baseline - 1 <= args.threshold:
+                break
+            seconds = min(seconds, measure(fn, args.repeat))
+        results[name] = seconds
+        change = seconds / baseline - 1
+        flag = "  REGRESSION" if change > args.threshold else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:>20}{seconds * 1e6:>12.2f}{baseline * 1e6:>12.2f}{change:>+9.0%}{flag}")
+
+    if args.save:
+        save_baselines(baselines, results)
+        print(f"Saved {len(results)} baselines to {BASELINES}")
+        return 0
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
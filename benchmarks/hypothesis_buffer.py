@@ -0,0 +1,95 @@
+"""Per iteration cost of OnlineASRProcessor's bookkeeping over a long session.
+
+A fake ASR stands in for Whisper: it returns a word every 0.4 s of the audio buffer, with the same text
+for the same time on every pass so words get committed, and a segment end every 3 s so the buffer is
+trimmed. Everything else (HypothesisBuffer, commits, prompt, trimming) is the real code. The unbounded
+column is what the old prompt() cost on top: a walk back through the whole committed history kept for
+the session. Reports the average microseconds per process_iter for each slice of the session, which
+should stay flat.
+
+Usage:
+    python -m benchmarks.hypothesis_buffer [--minutes 60] [--chunk 1.0] [--slices 6]
+"""
+#Default libraries
+import argparse
+import time
+
+import numpy as np
+
+from sinks.whisper_stream.whisper_online import OnlineASRProcessor
+
+SAMPLING_RATE = 16000
+WORD = 0.4
+SEGMENT = 3.0
+
+class FakeASR:
+    sep = " "
+
+    def __init__(self):
+        self.online = None
+
+    def transcribe(self, audio, init_prompt=""):
+        offset = self.online.buffer_time_offset
+        return offset, len(audio) / SAMPLING_RATE
+
+    def ts_words(self, res):
+        offset, seconds = res
+        first = int(np.ceil(offset / WORD))
+        last = int((offset + seconds) / WORD)
+        return [(i * WORD - offset, (i + 1) * WORD - offset, f"w{i}") for i in range(first, last)]
+
+    def segments_end_ts(self, res):
+        offset, seconds = res
+        first = int(np.ceil(offset / SEGMENT))
+        return [i * SEGMENT - offset for i in range(first, int((offset + seconds) / SEGMENT) + 1)]
+
+def unbounded_prompt(history, offset):
+    #The old prompt(): walk back from the end of the whole history to the buffer start
+    k = max(0, len(history) - 1)
+    while k > 0 and history[k - 1][1] > offset:
+        k -= 1
+    p = [t for _, _, t in history[:k]]
+    prompt = []
+    l = 0
+    while p and l < 200:
+        x = p.pop(-1)
+        l += len(x) + 1
+        prompt.append(x)
+    return " ".join(prompt[::-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--chunk", type=float, default=1.0, help="Seconds of audio per process_iter")
+    parser.add_argument("--slices", type=int, default=6, help="Parts of the session to report separately")
+    args = parser.parse_args(argv)
+
+    asr = FakeASR()
+    online = OnlineASRProcessor(asr, buffer_trimming=("segment", 15))
+    asr.online = online
+    chunk = np.zeros(int(args.chunk * SAMPLING_RATE), dtype=np.float32)
+    iterations = int(args.minutes * 60 / args.chunk)
+    history = []
+    times = []
+    unbounded = []
+    for _ in range(iterations):
+        online.insert_audio_chunk(chunk)
+        start_time = time.perf_counter()
+        beg, end, text = online.process_iter()
+        times.append(time.perf_counter() - start_time)
+        #Only the end times matter to the walk, committed words end every WORD seconds
+        history.extend((0, beg + (i + 1) * WORD, word) for i, word in enumerate(text.split()))
+        start_time = time.perf_counter()
+        unbounded_prompt(history, online.buffer_time_offset)
+        unbounded.append(time.perf_counter() - start_time)
+
+    print(f"{args.minutes:g} min session, process_iter every {args.chunk:g}s, {len(history)} words committed")
+    print(f"{'minutes':>12}{'process_iter us':>17}{'+ unbounded prompt us':>23}")
+    per_slice = max(iterations // args.slices, 1)
+    for i in range(0, iterations, per_slice):
+        label = f"{i * args.chunk / 60:.0f}-{min(i + per_slice, iterations) * args.chunk / 60:.0f}"
+        print(f"{label:>12}{np.mean(times[i:i + per_slice]) * 1e6:>17.1f}{np.mean(unbounded[i:i + per_slice]) * 1e6:>23.1f}")
+    print(f"words kept: {len(online.commited)} in buffer, {len(online.prompt_words)} for the prompt")
+
+if __name__ == "__main__":
+    main()
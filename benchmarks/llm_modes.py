@@ -0,0 +1,108 @@
+"""Compares the execution modes of modules.llm_dialo on this machine.
+
+For every mode it reports load time, first-token latency, tokens per second and how far the greedy
+output drifts from the fp32 model: the share of prompts with identical answers and the share of
+answer tokens before the first difference.
+
+Usage:
+    python -m benchmarks.llm_modes [--modes fp32 int8 compile onnx] [--tokens 40] [--threads 4] [--interop-threads 1]
+"""
+#Default libraries
+import argparse
+import statistics
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from modules.llm_dialo import LLM, MODES
+
+PROMPTS = [
+    "hey how are you doing today",
+    "what game should we play tonight",
+    "did you see the match yesterday",
+    "can you tell me a joke",
+    "I think the new patch broke everything",
+    "what is your favourite food",
+    "are you a robot",
+    "we need one more player for the raid",
+]
+
+class FirstToken(StoppingCriteria):
+    """Never stops generate, only notes when the first new token came out."""
+
+    def __init__(self):
+        self.at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.at is None:
+            self.at = time.perf_counter()
+        return False
+
+def run(ai, max_new_tokens):
+    outputs = []
+    first_tokens = []
+    tokens = 0
+    total = 0.0
+    for prompt in PROMPTS:
+        input_ids = ai.tokenizer.encode(f">> user: {prompt}" + ai.tokenizer.eos_token, return_tensors="pt")
+        first = FirstToken()
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            output_ids = ai.model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                           pad_token_id=ai.tokenizer.eos_token_id, stopping_criteria=StoppingCriteriaList([first]))
+        total += time.perf_counter() - start_time
+        new_ids = output_ids[0, input_ids.shape[-1]:].tolist()
+        outputs.append(new_ids)
+        tokens += len(new_ids)
+        first_tokens.append(first.at - start_time)
+    return outputs, first_tokens, tokens / total
+
+def agreement(baseline, outputs):
+    exact = sum(1 for a, b in zip(baseline, outputs) if a == b) / len(baseline)
+    matched = 0
+    length = 0
+    for a, b in zip(baseline, outputs):
+        prefix = 0
+        while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+            prefix += 1
+        matched += prefix
+        length += max(len(a), len(b))
+    return exact, matched / length if length else 1.0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--tokens", type=int, default=40, help="Max new tokens per answer")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--interop-threads", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    modes = args.modes if args.modes[0] == "fp32" else ["fp32"] + [m for m in args.modes if m != "fp32"]
+    print(f"{len(PROMPTS)} prompts, up to {args.tokens} tokens, threads {args.threads or torch.get_num_threads()}")
+    print(f"{'mode':>8}{'load s':>8}{'warmup s':>10}{'first tok':>11}{'tok/s':>8}{'exact':>7}{'tokens':>8}")
+
+    baseline = None
+    for mode in modes:
+        start_time = time.perf_counter()
+        try:
+            ai = LLM(mode, args.threads, args.interop_threads)
+        except ImportError as e:
+            print(f"{mode:>8}  skipped: {e}")
+            continue
+        load = time.perf_counter() - start_time
+
+        #The first call pays for compilation and allocator warm up, it is reported on its own
+        start_time = time.perf_counter()
+        run(ai, 2)
+        warmup = time.perf_counter() - start_time
+
+        outputs, first_tokens, tokens_per_second = run(ai, args.tokens)
+        if baseline is None:
+            baseline = outputs
+        exact, matched = agreement(baseline, outputs)
+        print(f"{mode:>8}{load:>8.2f}{warmup:>10.2f}{statistics.median(first_tokens) * 1000:>9.1f}ms{tokens_per_second:>8.1f}"
+              f"{exact:>7.0%}{matched:>8.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Replays a synthetic busy voice channel through modules.pipeline.VoicePipeline with stub stages.
+
+Measures throughput and transcript-to-playback latency for different LLM/TTS worker counts, with and
+without the turn scheduler, and checks that every user's replies are played in the order they spoke.
+
+Usage:
+    python -m benchmarks.replay_pipeline [--turns 40] [--users 4] [--llm 1.0] [--tts 0.6] [--speak 1.5] [--utterance 2.0]
+"""
+#Default libraries
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from modules.pipeline import VoicePipeline
+from modules.scheduler import TurnScheduler
+
+def make_script(turns, users, gap, seed=0):
+    rng = random.Random(seed)
+    t = 0.0
+    script = []
+    for i in range(turns):
+        t += rng.expovariate(1 / gap)
+        script.append((t, rng.randrange(users), f"utterance {i}"))
+    return script
+
+async def replay(script, llm_seconds, tts_seconds, speak_seconds, llm_workers, tts_workers, scale, scheduled=False, utterance_seconds=2.0):
+    played = []
+    latencies = []
+    sent_at = {}
+    playing_until = 0.0
+    start = time.perf_counter()
+
+    def speaking():
+        #Every utterance is taken to last utterance_seconds up to the time it finishes in the script
+        now = (time.perf_counter() - start) / scale
+        return {user for offset, user, _ in script if offset - utterance_seconds <= now < offset}
+
+    async def resolve_username(user_id):
+        return f"user{user_id}"
+
+    async def respond(turn):
+        await asyncio.sleep(llm_seconds * scale)
+        return f"answer to {turn.text}"
+
+    async def synthesize(turn):
+        await asyncio.sleep(tts_seconds * scale)
+        return turn.answer
+
+    async def play(turn):
+        nonlocal playing_until
+        #Same as play_audio_file: wait for the current reply to finish, then start
+        while time.perf_counter() < playing_until:
+            await asyncio.sleep(0.001)
+        latencies.append(time.perf_counter() - turn.created)
+        played.append((turn.user_id, turn.text))
+        playing_until = time.perf_counter() + speak_seconds * scale
+
+    scheduler = None
+    if scheduled:
+        #Same defaults as discord_AI.py, in scaled time
+        scheduler = TurnScheduler(1.5 * scale, 20 * scale, speaking_budget=30 * scale,
+                                  words_per_second=2.5 / scale, budget_window=60 * scale, speaking_fn=speaking)
+    pipeline = VoicePipeline(resolve_username=resolve_username, respond=respond, synthesize=synthesize, play=play,
+                             llm_workers=llm_workers, tts_workers=tts_workers, queue_size=len(script), scheduler=scheduler)
+    queue = asyncio.Queue()
+    runner = asyncio.ensure_future(pipeline.run(queue))
+
+    for offset, user, text in script:
+        delay = start + offset * scale - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent_at[text] = time.perf_counter()
+        await queue.put({"user": user, "result": text})
+    await queue.put(None)
+    await runner
+    total = time.perf_counter() - start
+
+    #Per user order must match the order they spoke in, the scheduler merges and drops so only check without it
+    if not scheduled:
+        for user in {u for _, u, _ in script}:
+            spoken = [t for _, u, t in script if u == user]
+            replies = [t for u, t in played if u == user]
+            assert spoken == replies, f"user {user} replies out of order"
+
+    return total / scale, [l / scale for l in latencies], len(played)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--gap", type=float, default=1.5, help="Mean seconds between finished utterances")
+    parser.add_argument("--llm", type=float, default=1.0, help="Seconds per LLM answer")
+    parser.add_argument("--tts", type=float, default=0.6, help="Seconds per TTS synthesis")
+    parser.add_argument("--speak", type=float, default=1.0, help="Seconds each reply takes to play")
+    parser.add_argument("--utterance", type=float, default=2.0, help="Seconds each utterance lasts, other speakers' turns wait for it to be merged")
+    parser.add_argument("--scale", type=float, default=0.02, help="Wall clock seconds per simulated second")
+    args = parser.parse_args(argv)
+
+    script = make_script(args.turns, args.users, args.gap)
+    configs = [(1, 1), (1, 2), (2, 2), (4, 4)]
+
+    print(f"{args.turns} turns from {args.users} users, llm {args.llm}s tts {args.tts}s playback {args.speak}s")
+    print(f"{'llm':>4}{'tts':>4}{'sched':>6}{'total s':>10}{'turns/s':>9}{'replies':>8}{'mean lat':>10}{'p95 lat':>9}")
+
+    #The old whisper_message: username, LLM, TTS and playback one transcript at a time
+    sequential = 0.0
+    latencies = []
+    for offset, _, _ in script:
+        sequential = max(sequential, offset) + args.llm + args.tts + args.speak
+        latencies.append(sequential - args.speak - offset)
+    print(f"{'seq':>8}{'no':>6}{sequential:>10.2f}{args.turns / sequential:>9.3f}{args.turns:>8}{statistics.mean(latencies):>10.2f}"
+          f"{sorted(latencies)[int(0.95 * (len(latencies) - 1))]:>9.2f}")
+
+    for scheduled in (False, True):
+        for llm_workers, tts_workers in configs:
+            total, latencies, replies = asyncio.run(replay(script, args.llm, args.tts, args.speak, llm_workers, tts_workers, args.scale, scheduled, args.utterance))
+            print(f"{llm_workers:>4}{tts_workers:>4}{'yes' if scheduled else 'no':>6}{total:>10.2f}{args.turns / total:>9.3f}{replies:>8}"
+                  f"{statistics.mean(latencies):>10.2f}{sorted(latencies)[int(0.95 * (len(latencies) - 1))]:>9.2f}")
+
+if __name__ == "__main__":
+    main()
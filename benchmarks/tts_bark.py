@@ -0,0 +1,68 @@
+"""Compares Bark synthesis of whole replies against the sentence level process pool in modules.tts_bark.
+
+The baseline is the old path: one generate_audio call on the whole reply. For the pool it reports when
+the first sentence was ready (what playback could start on) and when the whole reply was.
+
+Usage:
+    python -m benchmarks.tts_bark [--workers 1 2 4] [--runs 2]
+"""
+#Default libraries
+import argparse
+import statistics
+import time
+
+from bark import generate_audio, preload_models
+
+from modules.tts_bark import TTS
+
+REPLIES = [
+    "Hey there! I was just thinking about what we talked about yesterday. Do you want to keep going with that?",
+    "Sure, I can help with that. First open the settings. Then pick audio. Tell me when you see the list.",
+    "That match was wild. The last round came down to one player. I still can not believe they won it.",
+]
+
+def baseline(runs):
+    preload_models()
+    times = []
+    for _ in range(runs):
+        for reply in REPLIES:
+            start_time = time.perf_counter()
+            generate_audio(reply, silent=True)
+            times.append(time.perf_counter() - start_time)
+    return times
+
+def pooled(workers, runs):
+    tts = TTS(workers)
+    #Loads Bark in every worker before timing
+    list(tts.tts_stream(" ".join(["Warm up."] * max(workers, 1))))
+    first_chunks = []
+    totals = []
+    for _ in range(runs):
+        for reply in REPLIES:
+            start_time = time.perf_counter()
+            first = None
+            for _ in tts.tts_stream(reply):
+                if first is None:
+                    first = time.perf_counter() - start_time
+            totals.append(time.perf_counter() - start_time)
+            first_chunks.append(first)
+    tts.unload()
+    return first_chunks, totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    print(f"{len(REPLIES)} replies x {args.runs} runs")
+    print(f"{'path':>12}{'first chunk s':>15}{'total s':>10}")
+    times = baseline(args.runs)
+    #The single call only has audio once everything is done
+    print(f"{'single call':>12}{statistics.mean(times):>15.2f}{statistics.mean(times):>10.2f}")
+    for workers in args.workers:
+        first_chunks, totals = pooled(workers, args.runs)
+        print(f"{f'{workers} workers':>12}{statistics.mean(first_chunks):>15.2f}{statistics.mean(totals):>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Compares FixedVADIterator (one model call per 512 sample window) with the batched Silero VAD engine.
+
+Every stream gets the same audio in 100 ms chunks, like speakers in a call. Checks the batched engine
+reports the same start/end events as FixedVADIterator, then reports audio seconds processed per second
+of wall clock for each.
+
+Usage:
+    python -m benchmarks.vad_engine --model silero_vad.jit [--onnx silero_vad.onnx] [--streams 1 4 8] [--wav speech.wav]
+"""
+#Default libraries
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from sinks.whisper_stream.silero_vad_iterator import FixedVADIterator
+from sinks.whisper_stream.silero_vad_engine import BatchedVAD
+
+SAMPLING_RATE = 16000
+CHUNK = SAMPLING_RATE // 10
+
+def load_audio(path, seconds):
+    if path is not None:
+        import librosa
+        audio, _ = librosa.load(path, sr=SAMPLING_RATE, mono=True, dtype=np.float32)
+        return audio
+    #Bursts of noise between silences, enough to exercise both branches of the trigger logic
+    rng = np.random.default_rng(0)
+    audio = np.zeros(int(seconds * SAMPLING_RATE), dtype=np.float32)
+    for start in range(0, len(audio), 3 * SAMPLING_RATE):
+        audio[start:start + SAMPLING_RATE] = rng.normal(0, 0.3, min(SAMPLING_RATE, len(audio) - start))
+    return audio
+
+def run_fixed(model_path, audio, streams):
+    iterators = [FixedVADIterator(torch.jit.load(model_path, map_location="cpu")) for _ in range(streams)]
+    events = []
+    start_time = time.perf_counter()
+    for i in range(0, len(audio), CHUNK):
+        for n, iterator in enumerate(iterators):
+            event = iterator(audio[i:i + CHUNK])
+            if n == 0 and event is not None:
+                events.append(event)
+    return time.perf_counter() - start_time, events
+
+def run_batched(model_path, audio, streams):
+    engine = BatchedVAD(model_path)
+    events = []
+    start_time = time.perf_counter()
+    for i in range(0, len(audio), CHUNK):
+        for n in range(streams):
+            engine.feed(n, audio[i:i + CHUNK])
+        event = engine.process()[0]
+        if event is not None:
+            events.append(event)
+    return time.perf_counter() - start_time, events
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", required=True, help="Local silero_vad.jit")
+    parser.add_argument("--onnx", default=None, help="Local silero_vad.onnx, also benchmarked when given")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--wav", default=None, help="Audio to run, synthetic noise bursts when left out")
+    parser.add_argument("--seconds", type=float, default=30)
+    args = parser.parse_args(argv)
+
+    torch.set_num_threads(1)
+    audio = load_audio(args.wav, args.seconds)
+    seconds = len(audio) / SAMPLING_RATE
+    print(f"{seconds:.1f}s of audio per stream, {CHUNK} sample chunks")
+    print(f"{'streams':>8}{'engine':>16}{'audio s/s':>11}{'events':>8}")
+
+    for streams in args.streams:
+        elapsed, expected = run_fixed(args.model, audio, streams)
+        print(f"{streams:>8}{'fixed iterator':>16}{seconds * streams / elapsed:>11.1f}{len(expected):>8}")
+        for name, path in (("batched jit", args.model), ("batched onnx", args.onnx)):
+            if path is None:
+                continue
+            elapsed, events = run_batched(path, audio, streams)
+            match = "same" if events == expected else "DIFFERENT"
+            print(f"{streams:>8}{name:>16}{seconds * streams / elapsed:>11.1f}{len(events):>8}  {match}")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import asyncio
+import io
+import time
 
 import discord
 from discord.ext import commands
@@ -8,6 +10,15 @@ from discord import FFmpegOpusAudio
 #llm_dialo for fast but awful conversation
 #llm_guan_3b for slow but better conversation
 from modules import llm_guan_3b as llm, tts_windows as tts
+from modules.metrics import metrics, InstrumentedExecutor
+from modules.tracing import tracer
+from modules.queues import transcript_queue
+from modules.speculative import SpeculativeResponder
+from modules.pipeline import VoicePipeline
+from modules.scheduler import TurnScheduler
+from modules.usernames import UsernameResolver, display_name
+from modules.response_cache import ResponseCache
+from modules.models import models
 
 from os import environ
 from sys import exit
@@ -24,7 +35,7 @@ if TOKEN is None:
 #sink_settings = Sink.SinkSettings(50000, 1.2, 1.8, 0.75, 30, 3, -1)
 
 from sinks.stream_sink import StreamSink  as Sink
-sink_settings = Sink.SinkSettings(500, 800, 25000, 2)
+sink_settings = Sink.SinkSettings(500, 300, 25000, 2, target_latency=800)
 
 #This is who you allow to use commands with the bot, either by role, user or both.
 #can be a list, both being empty means anyone can command the bot. Roles should be lowercase, USERS requires user IDs
@@ -34,59 +45,130 @@ COMMANDS_USERS = []
 #Enter the channel IDs for which channels you want the bot to reply to users. Keep empty to allow all channels.
 REPLY_CHANNELS = []
 
+#Max finished transcripts waiting for the LLM. When full, new transcripts are merged into a pending one from
+#the same user ("coalesce"), or the oldest is dropped ("drop_oldest"), or the new one is dropped ("reject")
+TRANSCRIPT_QUEUE_SIZE = 10
+TRANSCRIPT_QUEUE_POLICY = "coalesce"
+
+#Start the LLM on partial transcripts when a turn looks about to end, the draft is kept if the final transcript matches
+SPECULATIVE_LLM = True
+
+#How many answers can be generated and synthesized at once. Replies to one user always play in the order they spoke.
+#Both bundled LLMs and pyttsx3 run one job at a time, raise these for backends that can run in parallel
+LLM_WORKERS = 1
+TTS_WORKERS = 1
+
+#Busy channels: hold a turn up to TURN_MERGE_WINDOW seconds while another user is still talking and merge their utterance into it,
+#drop turns still waiting after TURN_MAX_AGE seconds, and stop answering once the bot has spoken for
+#SPEAKING_BUDGET seconds in the last minute. Set TURN_SCHEDULER = False to answer every utterance on its own.
+TURN_SCHEDULER = True
+TURN_MERGE_WINDOW = 1.5
+TURN_MAX_AGE = 20
+SPEAKING_BUDGET = 30
+
+#Reuse answers to questions asked before in the same guild, matched by similarity of at least RESPONSE_CACHE_THRESHOLD
+#and kept for RESPONSE_CACHE_TTL seconds. Uses sentence-transformers when installed, hashed n-grams otherwise.
+RESPONSE_CACHE = False
+RESPONSE_CACHE_THRESHOLD = 0.9
+RESPONSE_CACHE_TTL = 3600
+
+#The LLM, TTS and whisper models are loaded on first use and unloaded after MODEL_IDLE_UNLOAD seconds
+#without a voice call or a message that needs them. The LLM's chat history goes with it.
+MODEL_IDLE_UNLOAD = 1800
+
+#Set METRICS_PORT to serve pipeline metrics in Prometheus text format on http://127.0.0.1:<port>/metrics
+METRICS_PORT = environ.get("METRICS_PORT", None)
+
+#Set TRACE_FILE to write a per-utterance timeline to a rotating JSONL file, read it with python -m modules.trace_analyzer
+TRACE_FILE = environ.get("TRACE_FILE", None)
+
 loop = asyncio.get_event_loop()
+#Counts jobs waiting on the default executor so !stats can show when it is saturated
+loop.set_default_executor(InstrumentedExecutor())
+if METRICS_PORT is not None:
+    metrics.start_http_server(int(METRICS_PORT))
+if TRACE_FILE is not None:
+    tracer.configure(TRACE_FILE)
 intents = discord.Intents.all()
 client = commands.Bot(command_prefix="!", intents=intents, loop=loop)
 
-ai = llm.LLM()
-speech = tts.TTS()
+models.idle_timeout = MODEL_IDLE_UNLOAD
+models.register("llm", llm.LLM)
+models.register("tts", tts.TTS)
+
+#Loads happen in the executor, the first answer after an unload waits for them
+async def get_model(name):
+    return await loop.run_in_executor(None, models.get, name)
   
 voice_channel = None
 
-class DiscordUser:
-    def __init__(self):
-        self.user_id = None
-        self.username = None
+#Names by user id, shared by every voice session
+usernames = UsernameResolver(client)
 
-    async def add_user(self, user_id):
-        self.user_id = user_id
-        self.username = await get_username(user_id)  
-        return self.username
+cache = ResponseCache(threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL) if RESPONSE_CACHE else None
         
 #In a seperate async thread, recieves messages from STT
-async def whisper_message(queue : asyncio.Queue):
- 
- #store user names based on their id
- discord_users = []
+#speaking_fn returns the ids of users talking right now, turns wait for them to be merged
+async def whisper_message(queue : asyncio.Queue, speaking_fn=None):
 
- while True:
-    response = await queue.get()
+ #Held for the whole call and loaded now, so the first answer does not wait for them
+ for name in ("llm", "tts"):
+    models.acquire(name)
+    models.prefetch(loop, name)
 
-    if response is None:
-        break
+ speculative = SpeculativeResponder(loop, lambda username, text, cancel: models.get("llm").generate(username, text, cancel=cancel)) if SPECULATIVE_LLM else None
+
+ async def respond(turn):
+    print(f"Detected Message: {turn.text}")
+    scope = (voice_channel.guild.id if voice_channel is not None else None, "voice")
+    ai = await get_model("llm")
+    if cache is not None:
+        #Embedding the question is too slow for the event loop, voice ingest runs there
+        answer = await loop.run_in_executor(None, cache.get, turn.text, scope)
+        if answer is not None:
+            if speculative is not None:
+                speculative.cancel(turn.user_id)
+            ai.commit(turn.username, turn.text, answer)
+            return answer
+
+    start_time = time.perf_counter()
+    if speculative is not None:
+        answer = await speculative.resolve(turn.user_id, turn.username, turn.text)
+        ai.commit(turn.username, turn.text, answer)
     else:
-        user_id = response["user"]
-        text = response["result"]
-
-        #Check if user name already exists to reduce time calling get_username
-        user_exists= False
-        username = None
-        for discord_user in discord_users:
-            if discord_user.user_id == user_id:
-                username = discord_user.username
-                user_exists = True
-                break    
-        if not user_exists:
-            discord_users.append(DiscordUser())
-            username = await discord_users[-1].add_user(user_id)
-
-        print(f"Detected Message: {text}")
-        
-        if username is not None:
-            answer = await loop.run_in_executor(None, ai.chat, username, text)
-            await play_audio(answer)
-        else:
-            print(f"Error: Username is null")
+        answer = await loop.run_in_executor(None, ai.chat, turn.username, turn.text)
+    if cache is not None:
+        await loop.run_in_executor(None, cache.put, turn.text, answer, scope, time.perf_counter() - start_time)
+    return answer
+
+ async def synthesize(turn):
+    if voice_channel is None:
+        return None
+    speech = await get_model("tts")
+    if hasattr(speech, "tts_sentences"):
+        #Ready once the first sentence is, the others are synthesized while it plays
+        sentences = speech.tts_sentences(turn.answer)
+        if not sentences:
+            return None
+        await asyncio.wrap_future(sentences[0])
+        return sentences
+    return await loop.run_in_executor(None, speech.tts_wav, turn.answer)
+
+ pipeline = VoicePipeline(resolve_username=get_username,
+                          respond=respond,
+                          synthesize=synthesize,
+                          play=lambda turn: play_audio_file(turn.audio),
+                          on_partial=speculative.speculate if speculative is not None else None,
+                          llm_workers=LLM_WORKERS,
+                          tts_workers=TTS_WORKERS,
+                          scheduler=TurnScheduler(TURN_MERGE_WINDOW, TURN_MAX_AGE, speaking_budget=SPEAKING_BUDGET,
+                                                  on_discard=lambda turn: speculative.cancel(turn.user_id) if speculative is not None else None,
+                                                  speaking_fn=speaking_fn) if TURN_SCHEDULER else None)
+ try:
+    await pipeline.run(queue)
+ finally:
+    models.release("llm")
+    models.release("tts")
 
 @client.command()
 async def quit(ctx):
@@ -103,10 +185,12 @@ async def join(ctx):
         except Exception as e:
             print(e)
         voice_channel = ctx.guild.voice_client
+        #Names of everyone already in the call are ready before they speak
+        usernames.prefetch(channel)
         #Replace Sink for either StreamSink or WhisperSink
-        queue = asyncio.Queue()
-        loop.create_task(whisper_message(queue))
+        queue = transcript_queue(TRANSCRIPT_QUEUE_SIZE, TRANSCRIPT_QUEUE_POLICY)
         whisper_sink = Sink(sink_settings=sink_settings, queue=queue, loop=loop)
+        loop.create_task(whisper_message(queue, whisper_sink.gaps.speaking))
         
         voice_channel.start_recording(whisper_sink, callback, ctx)
         await ctx.send("Joining.")
@@ -169,35 +253,64 @@ async def on_message(message : discord.Message):
 
             text = message.content.replace(client.user.mention, '').strip()
             
-            if message.author.nick is not None:
-                username = message.author.nick.replace(".", " ")
-            elif message.author.display_name is not None:
-                username = message.author.display_name.replace(".", " ")
-            else:
-                username = message.author.name.replace(".", " ")
+            username = display_name(message.author)
 
-            response = await loop.run_in_executor(None, ai.chat, username, text)
+            #Direct messages have no guild, their channel stands in for it
+            scope = (message.guild.id if message.guild is not None else message.channel.id, "text")
+            ai = await get_model("llm")
+            response = await loop.run_in_executor(None, cache.get, text, scope) if cache is not None else None
+            if response is not None:
+                ai.commit(username, text, response)
+            else:
+                start_time = time.perf_counter()
+                response = await loop.run_in_executor(None, ai.chat, username, text, "text")
+                elapsed = time.perf_counter() - start_time
+                metrics.observe_stage("llm", elapsed)
+                if cache is not None:
+                    await loop.run_in_executor(None, cache.put, text, response, scope, elapsed)
 
             await message.reply(response, mention_author=False)
 
-#Plays an audio file through discord. So far only audio files work, not streaming.
+#Plays audio through discord once the current reply has finished. Takes a file path, wav audio in memory,
+#or a list of futures of either, played one after another as they finish.
 #TODO make voice_channel.play async. Probably need to use the callback feature.
-async def play_audio(text):
-    global voice_channel   
-    if voice_channel is not None:      
-        audio_file = await loop.run_in_executor(None, speech.tts_wav, text)
-        if audio_file is not None:
-            while voice_channel.is_playing():
-                await asyncio.sleep(.1)
+async def play_audio_file(audio_file):
+    global voice_channel
+    if isinstance(audio_file, list):
+        for sentence in audio_file:
+            await play_audio_file(await asyncio.wrap_future(sentence))
+        return
+    if voice_channel is not None and audio_file is not None:
+        while voice_channel.is_playing():
+            await asyncio.sleep(.1)
+        if isinstance(audio_file, io.BytesIO):
+            prepared_audio = FFmpegOpusAudio(audio_file, pipe=True, executable="ffmpeg")
+        else:
             prepared_audio = FFmpegOpusAudio(audio_file, executable="ffmpeg")
-            voice_channel.play(prepared_audio)
+        voice_channel.play(prepared_audio)
 
 #Stops the bot if they are speaking
 @client.command()
 async def stop(ctx):
     ctx.guild.voice_client.stop()
 
+#Shows latency per pipeline stage, queue depths and speaker counts
+@client.command()
+async def stats(ctx):
+    summary = metrics.summary()
+    #Discord messages are limited to 2000 characters
+    if len(summary) > 1900:
+        summary = summary[:1900] + "\n..."
+    await ctx.send(f"```\n{summary}\n```")
+
 async def get_username(user_id):
-    return await client.fetch_user(user_id).name
+    guild = voice_channel.guild if voice_channel is not None else None
+    return await usernames.resolve(user_id, guild)
+
+#Keep names warm for people joining the call the bot is in
+@client.event
+async def on_voice_state_update(member, before, after):
+    if voice_channel is not None and after.channel is not None and after.channel == voice_channel.channel:
+        usernames.remember(member.id, display_name(member))
 
 client.run(TOKEN)
@@ -0,0 +1,104 @@
+#Default libraries
+import re
+import time
+
+from modules.metrics import metrics
+
+#End of the last complete sentence: . ! or ? followed by an optional closing quote or bracket
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*(?=\s|$)")
+
+class GenerationBudget:
+    """How much an answer may cost. max_tokens caps the generated tokens, deadline is in seconds of wall clock."""
+
+    def __init__(self, max_tokens, deadline=None):
+        self.max_tokens = max_tokens
+        self.deadline = deadline
+
+#Spoken replies are kept short so TTS and playback start quickly, text replies can be longer
+BUDGETS = {
+    "voice": GenerationBudget(max_tokens=60, deadline=6.0),
+    "text": GenerationBudget(max_tokens=250, deadline=30.0),
+}
+
+def split_sentences(text):
+    """Splits text after every sentence end, the last piece keeps whatever has no ending punctuation."""
+    sentences = []
+    start = 0
+    for end in SENTENCE_END.finditer(text):
+        sentence = text[start:end.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = end.end()
+    rest = text[start:].strip()
+    if rest:
+        sentences.append(rest)
+    return sentences
+
+def truncate_at_sentence(text):
+    """Cuts text after its last complete sentence, or returns it as is when there is none."""
+    ends = list(SENTENCE_END.finditer(text))
+    if not ends:
+        return text
+    return text[:ends[-1].end()]
+
+class BudgetedGeneration:
+    """Tracks one answer while it is decoded and says when to stop.
+
+    Feed every decoded piece to add(), which returns False once a stop sequence shows up, the token cap
+    is reached, the deadline has passed or cancel (a threading.Event) is set. finish() cuts the text at the stop sequence, or at the last
+    sentence boundary when the budget ran out, and records generated and kept tokens per channel.
+    """
+
+    def __init__(self, budget : GenerationBudget, stop=(), channel="voice", cancel=None):
+        self.budget = budget
+        self.stop = tuple(stop)
+        self.channel = channel
+        self.cancel = cancel
+        self.started = time.perf_counter()
+        self.text = ""
+        self.tokens = 0
+        self.reason = None
+        self.longest_stop = max((len(s) for s in self.stop), default=0)
+
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def expired(self):
+        return self.budget.deadline is not None and time.perf_counter() - self.started >= self.budget.deadline
+
+    def add(self, piece):
+        self.text += piece
+        self.tokens += 1
+        #A stop sequence can only end in the new piece
+        tail = self.text[-(len(piece) + self.longest_stop):]
+        if self.cancelled():
+            self.reason = "cancelled"
+        elif any(s in tail for s in self.stop):
+            self.reason = "stop"
+        elif self.tokens >= self.budget.max_tokens:
+            self.reason = "max_tokens"
+        elif self.expired():
+            self.reason = "deadline"
+        return self.reason is None
+
+    def finish(self, text=None, count_tokens=None):
+        """text overrides what was fed to add(), count_tokens(text) gives exact kept counts when the model has a tokenizer."""
+        generated = self.text if text is None else text
+        kept = generated
+        for s in self.stop:
+            index = kept.find(s)
+            if index != -1:
+                kept = kept[:index]
+        if self.reason in ("max_tokens", "deadline"):
+            kept = truncate_at_sentence(kept)
+        kept = kept.strip()
+
+        if count_tokens is not None:
+            kept_tokens = count_tokens(kept) if kept else 0
+        else:
+            kept_tokens = round(self.tokens * len(kept) / len(generated)) if generated else 0
+
+        metrics.counter("llm_tokens_generated_total", "Tokens decoded by the LLM", channel=self.channel).inc(self.tokens)
+        metrics.counter("llm_tokens_kept_total", "Decoded tokens kept in the answer", channel=self.channel).inc(min(kept_tokens, self.tokens))
+        metrics.counter("llm_stop_total", "Why LLM decoding stopped", reason=self.reason or "eos").inc()
+        return kept
@@ -1,15 +1,112 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+from transformers.pytorch_utils import Conv1D
+import threading
 import torch
 
+from modules.generation import BUDGETS, BudgetedGeneration
+
+MODEL_NAME = "microsoft/DialoGPT-small"
+#fp32 is the plain PyTorch model, int8 quantizes the linear layers after loading, compile runs forward through
+#torch.compile and onnx exports the model to ONNX Runtime (needs optimum[onnxruntime])
+MODES = ("fp32", "int8", "compile", "onnx")
+
+def linear_from_conv1d(module):
+    """GPT-2 layers are transformers Conv1D, a Linear with a transposed weight. quantize_dynamic only knows Linear."""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+            linear.weight = torch.nn.Parameter(child.weight.t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            linear_from_conv1d(child)
+
+def load_model(mode="fp32", threads=None, interop_threads=None):
+    if mode == "onnx":
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError:
+            raise ImportError("The onnx mode needs optimum with onnxruntime: pip install optimum[onnxruntime]")
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        if interop_threads:
+            options.inter_op_num_threads = interop_threads
+        return ORTModelForCausalLM.from_pretrained(MODEL_NAME, export=True, session_options=options)
+
+    model = AutoModelForCausalLM.from_pretrained(MODEL_NAME)
+    model.eval()
+    if mode == "int8":
+        linear_from_conv1d(model)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif mode == "compile":
+        #dynamic because the sequence grows by one token every step
+        model.forward = torch.compile(model.forward, dynamic=True)
+    elif mode != "fp32":
+        raise ValueError(f"Unknown mode {mode}, use one of {MODES}")
+    return model
+
+class BudgetCriteria(StoppingCriteria):
+    """Feeds every new token to a BudgetedGeneration and stops generate once it says so."""
+
+    def __init__(self, tokenizer, generation : BudgetedGeneration):
+        self.tokenizer = tokenizer
+        self.generation = generation
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return not self.generation.add(self.tokenizer.decode(input_ids[0, -1:], skip_special_tokens=True))
+
 class LLM:
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("microsoft/DialoGPT-small", padding_side='left')
-        self.model = AutoModelForCausalLM.from_pretrained("microsoft/DialoGPT-small")
+    #Turns in the history start with >>, the model sometimes carries on with the next one
+    stop = [">>"]
+
+    #threads and interop_threads set PyTorch's (or ONNX Runtime's) intra and inter op thread pools, None keeps the defaults
+    def __init__(self, mode="fp32", threads=None, interop_threads=None):
+        if threads:
+            torch.set_num_threads(threads)
+        if interop_threads:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError as e:
+                #Can only be set once, before PyTorch has run anything in parallel
+                print(f"Could not set interop threads: {e}")
+        self.mode = mode
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, padding_side='left')
+        self.model = load_model(mode, threads, interop_threads)
         self.chat_history_ids = None
+        #generate can be called for speculative drafts while another reply is running
+        self.lock = threading.Lock()
 
-    def chat(self, user, text):
+    def chat(self, user, text, channel="voice"):
+        answer = self.generate(user, text, channel)
+        self.commit(user, text, answer)
+        return answer
+
+    #Answers without touching the chat history, so a speculative draft can be thrown away
+    #cancel is a threading.Event, setting it stops decoding after the current token
+    def generate(self, user, text, channel="voice", cancel=None):
         new_user_input_ids = self.tokenizer.encode(f">> {user}: {text}" + self.tokenizer.eos_token, return_tensors='pt')
         bot_input_ids = torch.cat([self.chat_history_ids, new_user_input_ids], dim=-1) if self.chat_history_ids is not None else new_user_input_ids
-        self.chat_history_ids = self.model.generate(bot_input_ids, max_length=1000, pad_token_id=self.tokenizer.eos_token_id)
 
-        return (self.tokenizer.decode(self.chat_history_ids[:, bot_input_ids.shape[-1]:][0], skip_special_tokens=True))
\ No newline at end of file
+        budget = BUDGETS[channel]
+        with self.lock, torch.inference_mode():
+            #Made once the lock is held, time spent waiting for another generation is not part of the budget
+            generation = BudgetedGeneration(budget, self.stop, channel, cancel)
+            #A draft cancelled while it waited for the lock does not start at all
+            if generation.cancelled():
+                return generation.finish("")
+            output_ids = self.model.generate(
+                bot_input_ids,
+                max_new_tokens=budget.max_tokens,
+                pad_token_id=self.tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList([BudgetCriteria(self.tokenizer, generation)]),
+            )
+
+        answer = self.tokenizer.decode(output_ids[:, bot_input_ids.shape[-1]:][0], skip_special_tokens=True)
+        return generation.finish(answer, count_tokens=lambda kept: len(self.tokenizer.encode(kept)))
+
+    #Adds an exchange to the chat history
+    def commit(self, user, text, answer):
+        new_ids = self.tokenizer.encode(f">> {user}: {text}" + self.tokenizer.eos_token + answer + self.tokenizer.eos_token, return_tensors='pt')
+        self.chat_history_ids = torch.cat([self.chat_history_ids, new_ids], dim=-1) if self.chat_history_ids is not None else new_ids
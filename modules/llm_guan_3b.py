@@ -1,25 +1,54 @@
 from ctransformers import AutoModelForCausalLM
+import threading
 import torch
 
+from modules.generation import BUDGETS, BudgetedGeneration
+
 class LLM:
+    #The model starts the next turn with ### once it has answered
+    stop = ["###"]
+
     def __init__(self):
         
         self.model = AutoModelForCausalLM.from_pretrained("TheBloke/Guanaco-3B-Uncensored-v2-GGML", model_file="guanaco-3b-uncensored-v2.ggmlv1.q4_0.bin") 
 
         self.chat_history = []
+        #generate can be called for speculative drafts while another reply is running
+        self.lock = threading.Lock()
 
-    def chat(self, user, text):
-        chat_message = f'### {user}: {text}\n### Assistant: '
+    def chat(self, user, text, channel="voice"):
+        result = self.generate(user, text, channel)
+        self.commit(user, text, result)
+        return result
 
-        if len(self.chat_history) > 5:
-            self.chat_history.pop(0)
+    #Answers without touching the chat history, so a speculative draft can be thrown away
+    #cancel is a threading.Event, setting it stops decoding after the current token
+    def generate(self, user, text, channel="voice", cancel=None):
+        chat_message = f'### {user}: {text}\n### Assistant: '
 
-        prompt = "\n".join(self.chat_history)
+        prompt = "\n".join(self.chat_history[-5:] + [chat_message])
 
-        result = self.model(prompt).split("###")[0]
+        budget = BUDGETS[channel]
+        with self.lock:
+            #Made once the lock is held, time spent waiting for another generation is not part of the budget
+            generation = BudgetedGeneration(budget, self.stop, channel, cancel)
+            #Streamed so decoding can stop at the deadline or when cancelled, ctransformers also stops on the stop sequence itself.
+            #A draft cancelled while it waited for the lock does not start at all
+            if not generation.cancelled():
+                for piece in self.model(prompt, stream=True, max_new_tokens=budget.max_tokens, stop=self.stop):
+                    if not generation.add(piece):
+                        break
+            result = generation.finish(count_tokens=lambda kept: len(self.model.tokenize(kept)))
 
         print(result)
 
-        self.chat_history.append(chat_message + result)
+        return result
 
-        return result
\ No newline at end of file
+    #Adds an exchange to the chat history
+    def commit(self, user, text, result):
+        chat_message = f'### {user}: {text}\n### Assistant: '
+
+        if len(self.chat_history) > 5:
+            self.chat_history.pop(0)
+
+        self.chat_history.append(chat_message + result)
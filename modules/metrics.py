@@ -0,0 +1,217 @@
+#Default libraries
+import bisect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Latency buckets in seconds, from single packet handling up to slow LLM/TTS calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#Every stage between a user talking and the bot answering, in pipeline order
+STAGES = ("ingest", "resample", "vad", "asr", "end_of_turn", "username", "llm", "tts", "playback_start")
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=None):
+    items = list(key)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+class Histogram:
+    """Fixed bucket histogram. Observing is a bisect and three increments, no locking.
+    A lost increment under thread contention is acceptable for monitoring."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        #Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+        target = q * self.count
+        running = 0
+        for i, c in enumerate(self.counts):
+            running += c
+            if running >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge:
+    """Either set directly or backed by a callable that is only evaluated when metrics are read,
+    so queue depths and speaker counts cost nothing on the hot path."""
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return 0
+        return self.value
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+        self._server = None
+
+    def _get(self, kind, name, help, labels, factory):
+        key = _label_key(labels)
+        family = self._families.get(name)
+        if family is None:
+            with self._lock:
+                family = self._families.setdefault(name, {"kind": kind, "help": help, "children": {}})
+        metric = family["children"].get(key)
+        if metric is None:
+            with self._lock:
+                metric = family["children"].setdefault(key, factory())
+        return metric
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def counter(self, name, help="", **labels):
+        return self._get("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help="", fn=None, **labels):
+        gauge = self._get("gauge", name, help, labels, Gauge)
+        if fn is not None:
+            #Re-registering replaces the source, e.g. when the bot joins a new call
+            gauge.fn = fn
+        return gauge
+
+    def stage(self, stage):
+        return self.histogram("stage_latency_seconds", "Latency of each voice pipeline stage", stage=stage)
+
+    def observe_stage(self, stage, seconds):
+        self.stage(stage).observe(seconds)
+
+    def render_prometheus(self):
+        lines = []
+        for name, family in list(self._families.items()):
+            kind = family["kind"]
+            if family["help"]:
+                lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in list(family["children"].items()):
+                if kind == "histogram":
+                    running = 0
+                    for bound, c in zip(metric.buckets, metric.counts):
+                        running += c
+                        lines.append(f"{name}_bucket{_format_labels(key, ('le', bound))} {running}")
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {metric.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {metric.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {metric.count}")
+                elif kind == "counter":
+                    lines.append(f"{name}{_format_labels(key)} {metric.value}")
+                else:
+                    lines.append(f"{name}{_format_labels(key)} {metric.get()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Short human readable overview used by the !stats command."""
+        lines = []
+        stages = self._families.get("stage_latency_seconds", {"children": {}})["children"]
+        by_stage = {dict(key).get("stage"): h for key, h in stages.items()}
+        if any(h.count for h in by_stage.values()):
+            lines.append(f"{'stage':<15}{'count':>7}{'mean':>9}{'p50':>8}{'p95':>8}")
+        for stage in STAGES + tuple(s for s in by_stage if s not in STAGES):
+            h = by_stage.get(stage)
+            if h is None or h.count == 0:
+                continue
+            mean = h.sum / h.count
+            lines.append(f"{stage:<15}{h.count:>7}{mean:>9.3f}{h.quantile(0.5):>8.3g}{h.quantile(0.95):>8.3g}")
+
+        for name, family in list(self._families.items()):
+            if family["kind"] == "histogram":
+                continue
+            for key, metric in list(family["children"].items()):
+                value = metric.value if family["kind"] == "counter" else metric.get()
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines)
+
+    def start_http_server(self, port, host="127.0.0.1"):
+        """Serves the Prometheus text format on http://host:port/metrics from a daemon thread."""
+        if self._server is not None:
+            return self._server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """Thread pool that reports how many jobs are queued or running, set as the loop's default executor
+    so every run_in_executor(None, ...) call is counted."""
+
+    def __init__(self, max_workers=None, registry=None, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        registry = registry or metrics
+        self.inflight = registry.gauge("executor_inflight", "Jobs queued or running in the default executor")
+        registry.gauge("executor_workers", "Worker threads in the default executor", fn=lambda: self._max_workers)
+
+    def submit(self, fn, /, *args, **kwargs):
+        self.inflight.inc()
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self.inflight.dec())
+        return future
+
+#Process wide registry
+metrics = MetricsRegistry()
@@ -0,0 +1,168 @@
+#Default libraries
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from modules.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def resident_bytes():
+    """Process RSS plus CUDA memory held by PyTorch, used to measure what a model load costs."""
+    total = 0
+    try:
+        import psutil
+        total = psutil.Process().memory_info().rss
+    except ImportError:
+        try:
+            with open("/proc/self/statm") as f:
+                total = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            pass
+    #Only when something else already imported torch, the registry never loads it itself
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        total += torch.cuda.memory_allocated()
+    return total
+
+class ModelEntry:
+    def __init__(self, name, loader, unloader, keep_loaded):
+        self.name = name
+        self.loader = loader
+        self.unloader = unloader
+        self.keep_loaded = keep_loaded
+        self.model = None
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.resident = 0
+        self.lock = threading.Lock()
+
+class ModelRegistry:
+    """Process wide owner of the big models, so every sink and session shares one copy of each.
+
+    register() only records how to load a model. get() loads it on first use (call it from a worker
+    thread, loads can take seconds) and returns the shared instance. acquire() and release() count who
+    needs a model for a while, like a sink for the length of a call. Models nobody holds that have not
+    been used for idle_timeout seconds are unloaded by a background thread to give back RAM and VRAM,
+    and loaded again the next time they are needed, unless they were registered with keep_loaded.
+    """
+
+    def __init__(self, idle_timeout=1800, check_interval=30):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def register(self, name, loader, unloader=None, keep_loaded=False):
+        """loader() returns the model. unloader(model) frees what dropping the reference does not,
+        models with an unload() method get it called by default."""
+        with self.lock:
+            if name in self.entries:
+                return
+            self.entries[name] = entry = ModelEntry(name, loader, unloader, keep_loaded)
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap, name="model-reaper", daemon=True)
+                self.reaper.start()
+        metrics.gauge("model_loaded", "1 while a model is loaded", fn=lambda: int(entry.model is not None), model=name)
+        metrics.gauge("model_resident_bytes", "Memory taken by a model when it was loaded", fn=lambda: entry.resident if entry.model is not None else 0, model=name)
+
+    def get(self, name):
+        entry = self.entries[name]
+        entry.last_used = time.monotonic()
+        model = entry.model
+        if model is not None:
+            return model
+        with entry.lock:
+            if entry.model is None:
+                logger.info(f"Loading model {name}")
+                before = resident_bytes()
+                start_time = time.perf_counter()
+                entry.model = entry.loader()
+                metrics.histogram("model_load_seconds", "Time to load a model", model=name).observe(time.perf_counter() - start_time)
+                entry.resident = max(resident_bytes() - before, 0)
+                metrics.counter("model_loads_total", "Model loads", model=name).inc()
+            entry.last_used = time.monotonic()
+            return entry.model
+
+    def acquire(self, name):
+        """Marks a model as needed without loading it, the first get() does that."""
+        entry = self.entries[name]
+        with entry.lock:
+            entry.refs += 1
+            entry.last_used = time.monotonic()
+
+    def release(self, name):
+        entry = self.entries[name]
+        with entry.lock:
+            entry.refs = max(entry.refs - 1, 0)
+            entry.last_used = time.monotonic()
+
+    def prefetch(self, loop, name):
+        """Loads a model in the loop's executor without waiting for it. A failed load is logged here,
+        the next get() tries again. Returns the future."""
+        future = loop.run_in_executor(None, self.get, name)
+        future.add_done_callback(lambda future: self._prefetched(name, future))
+        return future
+
+    def _prefetched(self, name, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            metrics.counter("model_load_failures_total", "Model loads that raised", model=name).inc()
+            logger.error(f"Loading model {name} failed: {error!r}")
+
+    @contextmanager
+    def use(self, name):
+        self.acquire(name)
+        try:
+            yield self.get(name)
+        finally:
+            self.release(name)
+
+    def unload(self, name, idle_only=False):
+        entry = self.entries[name]
+        with entry.lock:
+            if entry.model is None:
+                return
+            #Checked under the lock so a model is never unloaded right after someone acquired it
+            if idle_only and (entry.refs > 0 or entry.keep_loaded or time.monotonic() - entry.last_used <= self.idle_timeout):
+                return
+            model, entry.model = entry.model, None
+            if entry.unloader is not None:
+                entry.unloader(model)
+            elif hasattr(model, "unload"):
+                model.unload()
+            del model
+            gc.collect()
+            torch = sys.modules.get("torch")
+            if torch is not None and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            metrics.counter("model_unloads_total", "Models unloaded after being idle", model=name).inc()
+            logger.info(f"Unloaded idle model {name}")
+
+    def reap(self):
+        while True:
+            time.sleep(self.check_interval)
+            for name in list(self.entries):
+                self.unload(name, idle_only=True)
+
+models = ModelRegistry()
+
+def whisper_model(size, cache_dir=None):
+    """Registers a faster-whisper model shared by every sink and returns its registry name."""
+    name = f"whisper:{size}"
+    if name not in models:
+        def load():
+            from faster_whisper import WhisperModel
+            return WhisperModel(size, device="cuda", compute_type="float16", download_root=cache_dir)
+        models.register(name, load)
+    return name
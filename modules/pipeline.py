@@ -0,0 +1,202 @@
+#Default libraries
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from modules.metrics import metrics
+from modules.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+class Turn:
+    """One finished transcript on its way through the pipeline."""
+
+    def __init__(self, user_id, text, trace_id=None, seq=0):
+        self.user_id = user_id
+        self.text = text
+        self.trace_id = trace_id
+        self.seq = seq
+        self.username = None
+        self.answer = None
+        self.audio = None
+        self.created = time.perf_counter()
+
+class VoicePipeline:
+    """Transcripts -> LLM workers -> TTS workers -> playback, each stage running concurrently.
+
+    While one answer is being synthesized or played, the next transcripts are already being answered.
+    llm_workers and tts_workers limit how many jobs each stage runs at once, queue_size bounds the
+    queues between stages so a slow stage pushes back instead of piling up work.
+
+    Ordering per user: a user never has two LLM jobs at once, so their chat history is built in order,
+    and their replies are played in the order they spoke. Replies of different users can overtake each other.
+
+    The stage callables are coroutines so the replay benchmark can swap in stubs:
+    resolve_username(user_id) -> str or None
+    respond(turn) -> answer text or None
+    synthesize(turn) -> audio or None
+    play(turn) -> returns once playback has started
+    on_partial(user_id, username, text) for partial transcripts, optional
+
+    With a scheduler (modules.scheduler.TurnScheduler) finished transcripts wait there, to be merged or
+    dropped, until the LLM stage has room for them.
+    """
+
+    def __init__(self, *, resolve_username, respond, synthesize, play, on_partial=None, llm_workers=1, tts_workers=1, queue_size=10, scheduler=None):
+        self.resolve_username = resolve_username
+        self.respond = respond
+        self.synthesize = synthesize
+        self.play = play
+        self.on_partial = on_partial
+        self.scheduler = scheduler
+        self.llm_workers = llm_workers
+        self.tts_workers = tts_workers
+
+        self.llm_queue = asyncio.Queue(queue_size)
+        self.tts_queue = asyncio.Queue(queue_size)
+        self.playback_queue = asyncio.Queue()
+        metrics.gauge("queue_depth", "Items waiting in each pipeline queue", fn=self.llm_queue.qsize, queue="llm")
+        metrics.gauge("queue_depth", "Items waiting in each pipeline queue", fn=self.tts_queue.qsize, queue="tts")
+        metrics.gauge("queue_depth", "Items waiting in each pipeline queue", fn=self.playback_queue.qsize, queue="playback")
+
+        #Per user sequence numbers, the next one allowed to play, and finished turns waiting for their turn
+        self.next_seq = defaultdict(int)
+        self.next_play = defaultdict(int)
+        self.ready = {}
+        #Users with an LLM job running
+        self.llm_busy = set()
+        self.llm_free = asyncio.Condition()
+
+        self.completed = metrics.counter("pipeline_turns_total", "Turns that reached playback")
+
+    async def run(self, queue : asyncio.Queue):
+        """Consumes sink output until the None sentinel, then lets the queued work finish."""
+        llm_workers = [asyncio.ensure_future(self.llm_worker()) for _ in range(self.llm_workers)]
+        tts_workers = [asyncio.ensure_future(self.tts_worker()) for _ in range(self.tts_workers)]
+        player = asyncio.ensure_future(self.player())
+        if self.scheduler is not None:
+            #Room for a turn means an idle LLM worker, so turns keep waiting (and merging) in the scheduler
+            scheduler = asyncio.ensure_future(self.scheduler.run(self.submit, lambda: self.llm_queue.empty() and len(self.llm_busy) < self.llm_workers))
+
+        while True:
+            response = await queue.get()
+            if response is None:
+                break
+            await self.dispatch(response)
+
+        #Drain stage by stage so nothing already accepted is lost
+        if self.scheduler is not None:
+            self.scheduler.close()
+            await scheduler
+        for _ in llm_workers:
+            await self.llm_queue.put(None)
+        await asyncio.gather(*llm_workers)
+        for _ in tts_workers:
+            await self.tts_queue.put(None)
+        await asyncio.gather(*tts_workers)
+        await self.playback_queue.put(None)
+        await player
+
+    async def dispatch(self, response):
+        user_id = response["user"]
+        trace_id = response.get("trace")
+
+        start_time = time.perf_counter()
+        username = await self.resolve_username(user_id)
+        elapsed = time.perf_counter() - start_time
+        metrics.observe_stage("username", elapsed)
+        tracer.span(trace_id, "username", elapsed)
+
+        if username is None:
+            logger.error(f"Username for {user_id} is null")
+            return
+
+        if response.get("partial"):
+            if self.on_partial is not None:
+                self.on_partial(user_id, username, response["result"])
+            return
+
+        turn = Turn(user_id, response["result"], trace_id)
+        turn.username = username
+        if self.scheduler is not None:
+            self.scheduler.add(turn)
+        else:
+            await self.submit(turn)
+
+    async def submit(self, turn : Turn):
+        turn.seq = self.next_seq[turn.user_id]
+        self.next_seq[turn.user_id] += 1
+        await self.llm_queue.put(turn)
+
+    async def llm_worker(self):
+        while True:
+            turn = await self.llm_queue.get()
+            if turn is None:
+                return
+            #Wait until this user has no other answer being generated
+            async with self.llm_free:
+                await self.llm_free.wait_for(lambda: turn.user_id not in self.llm_busy)
+                self.llm_busy.add(turn.user_id)
+            try:
+                start_time = time.perf_counter()
+                turn.answer = await self.respond(turn)
+                elapsed = time.perf_counter() - start_time
+                metrics.observe_stage("llm", elapsed)
+                tracer.span(turn.trace_id, "llm", elapsed, text=turn.answer)
+            except Exception as e:
+                logger.error(f"LLM failed for {turn.username}: {e}")
+                turn.answer = None
+            finally:
+                async with self.llm_free:
+                    self.llm_busy.discard(turn.user_id)
+                    self.llm_free.notify_all()
+
+            if turn.answer:
+                await self.tts_queue.put(turn)
+            else:
+                self.finish(turn)
+
+    async def tts_worker(self):
+        while True:
+            turn = await self.tts_queue.get()
+            if turn is None:
+                return
+            try:
+                start_time = time.perf_counter()
+                turn.audio = await self.synthesize(turn)
+                elapsed = time.perf_counter() - start_time
+                metrics.observe_stage("tts", elapsed)
+                tracer.span(turn.trace_id, "tts", elapsed)
+            except Exception as e:
+                logger.error(f"TTS failed for {turn.username}: {e}")
+                turn.audio = None
+            self.finish(turn)
+
+    def finish(self, turn : Turn):
+        """Releases a turn to playback once every earlier turn of the same user has been released."""
+        self.ready[(turn.user_id, turn.seq)] = turn
+        key = (turn.user_id, self.next_play[turn.user_id])
+        while key in self.ready:
+            ready = self.ready.pop(key)
+            if ready.audio is not None:
+                self.playback_queue.put_nowait(ready)
+            self.next_play[turn.user_id] += 1
+            key = (turn.user_id, self.next_play[turn.user_id])
+
+    async def player(self):
+        while True:
+            turn = await self.playback_queue.get()
+            if turn is None:
+                return
+            start_time = time.perf_counter()
+            try:
+                await self.play(turn)
+            except Exception as e:
+                logger.error(f"Playback failed: {e}")
+            elapsed = time.perf_counter() - start_time
+            metrics.observe_stage("playback_start", elapsed)
+            tracer.span(turn.trace_id, "playback_start", elapsed)
+            self.completed.inc()
+            if self.scheduler is not None:
+                self.scheduler.record_speech(turn.answer)
@@ -0,0 +1,141 @@
+#Default libraries
+import asyncio
+import logging
+import queue
+
+from modules.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+#What to do with a new item when a queue is full
+DROP_OLDEST = "drop_oldest"     #throw away the oldest pending item, good for audio where late data is useless
+COALESCE = "coalesce"           #merge into a pending item with the same key, falls back to drop oldest
+REJECT = "reject"               #refuse the new item
+POLICIES = (DROP_OLDEST, COALESCE, REJECT)
+
+#Sink only policy: while the voice queue is overloaded, users who are not already being transcribed are not heard
+REJECT_NEW_SPEAKERS = "reject_new_speakers"
+
+class _Shedding:
+    """Shared bounding logic for the asyncio and thread queues below.
+
+    The underlying queue is created unbounded so put()/put_nowait() never block or raise, the limit
+    is enforced in _put which both queue types call with their own locking already taken care of.
+    None is used as a shutdown sentinel everywhere in this project, so it is always accepted.
+    When expendable(item) is given, items it is true for are dropped before any other item, and a new
+    expendable item is refused rather than pushing out one that is not.
+    """
+
+    def _init_shedding(self, name, limit, policy, key, merge, high_watermark, expendable=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, expected one of {POLICIES}")
+        self.name = name
+        self.limit = limit
+        self.policy = policy
+        self.key = key
+        self.merge = merge
+        self.expendable = expendable
+        self.high_watermark = int(limit * high_watermark) if limit > 0 else 0
+        self.overloaded = False
+        self.shed = metrics.counter("queue_shed_total", "Items dropped, merged or rejected by bounded queues", queue=name, policy=policy)
+        self.overload_gauge = metrics.gauge("queue_overloaded", "1 while a queue is above its high watermark", queue=name)
+
+    def _shed_put(self, items, item):
+        """Returns the change in item count so callers can keep unfinished task counts right."""
+        if item is None or self.limit <= 0 or len(items) < self.limit:
+            items.append(item)
+            self._check_overload(len(items))
+            return 1
+
+        self.shed.inc()
+        if self.policy == REJECT:
+            return 0
+
+        if self.policy == COALESCE and self.key is not None:
+            item_key = self.key(item)
+            #Newest pending item for the same key, so order between keys is kept
+            for i in range(len(items) - 1, -1, -1):
+                pending = items[i]
+                if pending is not None and self.key(pending) == item_key:
+                    items[i] = self.merge(pending, item)
+                    return 0
+
+        victims = [i for i, pending in enumerate(items) if pending is not None]
+        if self.expendable is not None:
+            expendable = [i for i in victims if self.expendable(items[i])]
+            if not expendable and self.expendable(item):
+                return 0
+            victims = expendable or victims
+        if victims:
+            del items[victims[0]]
+        items.append(item)
+        return 0
+
+    def _check_overload(self, depth):
+        if not self.overloaded and self.high_watermark and depth >= self.high_watermark:
+            self.overloaded = True
+            self.overload_gauge.set(1)
+            logger.warning(f"Queue {self.name} overloaded: {depth}/{self.limit} items, shedding with {self.policy}")
+        elif self.overloaded and depth < self.high_watermark // 2:
+            self.overloaded = False
+            self.overload_gauge.set(0)
+            logger.info(f"Queue {self.name} recovered")
+
+class BoundedQueue(_Shedding, asyncio.Queue):
+    """asyncio.Queue that sheds load instead of growing without limit. limit <= 0 means unbounded."""
+
+    def __init__(self, limit, policy=DROP_OLDEST, *, name="queue", key=None, merge=None, high_watermark=0.8, expendable=None):
+        super().__init__()
+        self._init_shedding(name, limit, policy, key, merge, high_watermark, expendable)
+        metrics.gauge("queue_depth", "Items waiting in each pipeline queue", fn=self.qsize, queue=name)
+
+    def _put(self, item):
+        if self._shed_put(self._queue, item) == 0:
+            #put_nowait counts every item as unfinished, undo it for the ones that were not added
+            self._unfinished_tasks -= 1
+
+    def _get(self):
+        item = self._queue.popleft()
+        if self.overloaded:
+            self._check_overload(len(self._queue))
+        return item
+
+class BoundedThreadQueue(_Shedding, queue.Queue):
+    """queue.Queue counterpart of BoundedQueue for sinks that run their own thread."""
+
+    def __init__(self, limit, policy=DROP_OLDEST, *, name="queue", key=None, merge=None, high_watermark=0.8, expendable=None):
+        super().__init__()
+        self._init_shedding(name, limit, policy, key, merge, high_watermark, expendable)
+        metrics.gauge("queue_depth", "Items waiting in each pipeline queue", fn=self.qsize, queue=name)
+
+    def _put(self, item):
+        if self._shed_put(self.queue, item) == 0:
+            self.unfinished_tasks -= 1
+
+    def _get(self):
+        item = self.queue.popleft()
+        if self.overloaded:
+            self._check_overload(len(self.queue))
+        return item
+
+def voice_queue(limit, policy=DROP_OLDEST, thread=False):
+    """Bounded queue for raw audio packets coming out of a sink's write()."""
+    if policy == REJECT_NEW_SPEAKERS:
+        #Speakers already being heard still lose their oldest audio first
+        policy = DROP_OLDEST
+    queue_class = BoundedThreadQueue if thread else BoundedQueue
+    return queue_class(limit, policy, name="voice")
+
+def merge_transcripts(pending, new):
+    """Coalesces two transcripts from the same user into one LLM request."""
+    if new.get("partial"):
+        #A newer partial transcript replaces the older one
+        return new
+    merged = dict(pending)
+    merged["result"] = f"{pending['result']} {new['result']}"
+    return merged
+
+def transcript_queue(limit, policy=COALESCE):
+    #Partial transcripts only start speculative answers, a full queue drops them first and never a final one for them
+    return BoundedQueue(limit, policy, name="transcript", key=lambda item: (item["user"], item.get("partial", False)), merge=merge_transcripts,
+                        expendable=lambda item: item is not None and item.get("partial", False))
@@ -0,0 +1,153 @@
+#Default libraries
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+#3rd party libraries
+import numpy as np
+
+from modules.metrics import metrics
+from modules.speculative import normalize
+
+logger = logging.getLogger(__name__)
+
+class HashedNgramVectorizer:
+    """Embeds text as hashed word and character n-gram counts. Needs nothing but numpy.
+
+    Catches rewordings that share most of their words ("what are you" / "so what are you"), not paraphrases.
+    """
+
+    def __init__(self, dim=1024, char_ngrams=(3, 4)):
+        self.dim = dim
+        self.char_ngrams = char_ngrams
+
+    def features(self, text):
+        words = text.split()
+        yield from words
+        yield from (f"{a} {b}" for a, b in zip(words, words[1:]))
+        padded = f" {text} "
+        for n in self.char_ngrams:
+            for i in range(len(padded) - n + 1):
+                yield padded[i:i + n]
+
+    def __call__(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(text):
+            digest = hashlib.blake2b(feature.encode(), digest_size=4).digest()
+            vector[int.from_bytes(digest, "little") % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+def load_embedder(model_name="sentence-transformers/all-MiniLM-L6-v2"):
+    """A small CPU sentence embedding model when sentence-transformers is installed, otherwise HashedNgramVectorizer."""
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        logger.info("sentence-transformers is not installed, the response cache uses hashed n-grams")
+        return HashedNgramVectorizer()
+    model = SentenceTransformer(model_name, device="cpu")
+    return lambda text: model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+class ScopeIndex:
+    """Cached questions of one scope. Each question owns a row of vectors, rows of evicted questions are reused."""
+
+    def __init__(self, dim, size):
+        self.vectors = np.zeros((size, dim), dtype=np.float32)
+        #Question held by each row, None for free rows
+        self.keys = [None] * size
+        #question -> (row, answer, stored, seconds), least recently used first
+        self.entries = OrderedDict()
+
+    def remove(self, key):
+        row = self.entries.pop(key)[0]
+        self.vectors[row] = 0
+        self.keys[row] = None
+
+    def add(self, key, vector, answer, stored, seconds):
+        if key in self.entries:
+            self.remove(key)
+        if len(self.entries) == len(self.keys):
+            self.remove(next(iter(self.entries)))
+        row = self.keys.index(None)
+        self.vectors[row] = vector
+        self.keys[row] = key
+        self.entries[key] = (row, answer, stored, seconds)
+
+class ResponseCache:
+    """Answers repeated questions without running the LLM.
+
+    Questions are embedded and compared by cosine similarity against earlier questions in the same scope
+    (a guild and channel type, so voice and text answers are kept apart). An answer is reused when the
+    similarity reaches threshold and it is younger than ttl seconds. Each scope keeps at most max_entries
+    answers and evicts the least recently used one. Questions shorter than min_words are not cached,
+    their answers depend too much on what was said before.
+
+    Embedding a question takes a while, so get and put are meant to run in an executor. They are thread
+    safe, the embedding runs outside the lock.
+    """
+
+    def __init__(self, embed=None, threshold=0.9, ttl=3600, max_entries=500, min_words=3):
+        self.embed = embed if embed is not None else load_embedder()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_words = min_words
+        self.scopes = {}
+        self.dim = None
+        self.lock = threading.Lock()
+
+        self.outcomes = {outcome: metrics.counter("response_cache_total", "Response cache lookups by outcome", outcome=outcome)
+                         for outcome in ("hit", "miss")}
+        self.saved = metrics.counter("response_cache_saved_seconds", "LLM seconds saved by cached answers")
+        metrics.gauge("response_cache_hit_rate", "Share of cache lookups answered from the cache", fn=self.hit_rate)
+        metrics.gauge("response_cache_entries", "Answers held by the response cache", fn=lambda: sum(len(s.entries) for s in self.scopes.values()))
+
+    def hit_rate(self):
+        lookups = self.outcomes["hit"].value + self.outcomes["miss"].value
+        return round(self.outcomes["hit"].value / lookups, 3) if lookups else 0
+
+    def vector(self, key):
+        vector = np.asarray(self.embed(key), dtype=np.float32)
+        self.dim = len(vector)
+        return vector
+
+    def get(self, question, scope=None):
+        key = normalize(question)
+        index = self.scopes.get(scope)
+        if len(key.split()) < self.min_words or index is None or not index.entries:
+            self.outcomes["miss"].inc()
+            return None
+
+        vector = self.vector(key)
+        with self.lock:
+            #Free rows are zero so they never reach the threshold
+            similarities = index.vectors @ vector
+            best = int(np.argmax(similarities))
+            cached_key = index.keys[best]
+            if cached_key is None or similarities[best] < self.threshold:
+                self.outcomes["miss"].inc()
+                return None
+            _, answer, stored, seconds = index.entries[cached_key]
+            if time.monotonic() - stored > self.ttl:
+                index.remove(cached_key)
+                self.outcomes["miss"].inc()
+                return None
+            index.entries.move_to_end(cached_key)
+
+        self.outcomes["hit"].inc()
+        self.saved.inc(seconds)
+        return answer
+
+    def put(self, question, answer, scope=None, seconds=0.0):
+        """seconds is how long the LLM took, counted as saved on every later hit."""
+        key = normalize(question)
+        if not answer or len(key.split()) < self.min_words:
+            return
+        vector = self.vector(key)
+        with self.lock:
+            index = self.scopes.get(scope)
+            if index is None:
+                index = self.scopes[scope] = ScopeIndex(self.dim, self.max_entries)
+            index.add(key, vector, answer, time.monotonic(), seconds)
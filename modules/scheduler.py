@@ -0,0 +1,131 @@
+#Default libraries
+import asyncio
+import logging
+import time
+from collections import deque
+
+from modules.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class TurnScheduler:
+    """Decides which finished utterances get an answer, sitting between the sink output and the LLM stage.
+
+    - A turn is held while another speaker is mid-utterance (speaking_fn() returns the user ids talking
+      right now), for at most merge_window seconds, so their utterance is merged into it and a busy
+      channel gets one reply instead of a queue of them. Otherwise a turn leaves at once.
+    - Turns only leave the scheduler when the LLM stage can take them. Anything still waiting longer
+      than max_age seconds, or more than max_pending turns back, is dropped because the conversation
+      has moved past it.
+    - Answers are held back while the bot has already spoken for speaking_budget seconds in the
+      last budget_window seconds. Speaking time is estimated from the answer length at words_per_second.
+
+    on_discard(turn) is called for every turn that will not be answered on its own, because it was
+    merged into another one or dropped, e.g. to cancel work started for it early.
+    """
+
+    def __init__(self, merge_window=1.5, max_age=20.0, max_pending=3, speaking_budget=30.0, words_per_second=2.5, budget_window=60.0, on_discard=None, speaking_fn=None):
+        self.merge_window = merge_window
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.speaking_budget = speaking_budget
+        self.words_per_second = words_per_second
+        self.budget_window = budget_window
+        self.on_discard = on_discard
+        self.speaking_fn = speaking_fn
+
+        self.pending = deque()
+        self.arrived = asyncio.Event()
+        self.closed = False
+        #(time, seconds) of recent replies
+        self.spoken = deque()
+
+        self.merged = metrics.counter("scheduler_merged_total", "Utterances merged into another turn")
+        self.stale = metrics.counter("scheduler_dropped_total", "Utterances dropped by the turn scheduler", reason="stale")
+        self.superseded = metrics.counter("scheduler_dropped_total", "Utterances dropped by the turn scheduler", reason="superseded")
+        metrics.gauge("scheduler_speaking_seconds", "Estimated seconds spoken by the bot in the budget window", fn=self.speaking_seconds)
+
+    def add(self, turn):
+        self.pending.append(turn)
+        self.arrived.set()
+
+    def close(self):
+        self.closed = True
+        self.arrived.set()
+
+    def speaking_seconds(self):
+        now = time.monotonic()
+        while self.spoken and now - self.spoken[0][0] > self.budget_window:
+            self.spoken.popleft()
+        return sum(seconds for _, seconds in self.spoken)
+
+    def record_speech(self, text):
+        self.spoken.append((time.monotonic(), len(text.split()) / self.words_per_second))
+
+    async def run(self, submit, can_submit):
+        """submit(turn) hands a turn to the LLM stage, can_submit() says whether it has room for one."""
+        while True:
+            if not self.pending:
+                if self.closed:
+                    return
+                self.arrived.clear()
+                await self.arrived.wait()
+                continue
+
+            #Give other speakers a moment to finish their utterance
+            if not self.closed and self.others_speaking() and time.perf_counter() < self.pending[0].created + self.merge_window:
+                await asyncio.sleep(min(0.1, self.merge_window / 10))
+                continue
+
+            if not self.closed and (not can_submit() or self.speaking_seconds() >= self.speaking_budget):
+                await asyncio.sleep(min(0.1, self.merge_window / 10))
+                self.drop_stale()
+                continue
+
+            self.drop_stale()
+            if self.pending:
+                turns = list(self.pending)
+                self.pending.clear()
+                await submit(self.merge(turns))
+
+    def others_speaking(self):
+        if self.speaking_fn is None:
+            return False
+        waiting = {turn.user_id for turn in self.pending}
+        return any(user not in waiting for user in self.speaking_fn())
+
+    def drop_stale(self):
+        now = time.perf_counter()
+        while self.pending and now - self.pending[0].created > self.max_age:
+            turn = self.pending.popleft()
+            self.stale.inc()
+            self.discard(turn)
+            logger.info(f"Dropped stale turn from {turn.username}: {turn.text}")
+        while len(self.pending) > self.max_pending:
+            turn = self.pending.popleft()
+            self.superseded.inc()
+            self.discard(turn)
+            logger.info(f"Dropped superseded turn from {turn.username}: {turn.text}")
+
+    def discard(self, turn):
+        if self.on_discard is not None:
+            self.on_discard(turn)
+
+    def merge(self, turns):
+        if len(turns) == 1:
+            return turns[0]
+        self.merged.inc(len(turns) - 1)
+        first = turns[0]
+        for turn in turns[1:]:
+            self.discard(turn)
+        names = []
+        for turn in turns:
+            if turn.username not in names:
+                names.append(turn.username)
+        if len(names) == 1:
+            first.text = " ".join(turn.text for turn in turns)
+        else:
+            #Each line says who said what, the reply goes to everyone involved
+            first.text = "\n".join(f"{turn.username}: {turn.text}" for turn in turns)
+            first.username = " and ".join(names)
+        return first
@@ -0,0 +1,95 @@
+#Default libraries
+import asyncio
+import re
+import threading
+import time
+
+from modules.metrics import metrics
+
+def normalize(text):
+    #ASR partials and finals differ in casing and punctuation more often than in words
+    return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+class Draft:
+    def __init__(self, text, future, cancel_event):
+        self.text = text
+        self.key = normalize(text)
+        self.future = future
+        self.cancel_event = cancel_event
+        self.started = time.perf_counter()
+        self.finished = None
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.finished = time.perf_counter()
+
+    def cancel(self):
+        #Cancelling the executor future alone does not stop a generation that already started
+        self.cancel_event.set()
+        self.future.cancel()
+
+class SpeculativeResponder:
+    """Starts the LLM on a stable partial transcript before the turn has officially ended.
+
+    Sinks put {"partial": True} items on the transcript queue when the end of a turn looks likely.
+    speculate() starts generating a draft for that text. When the final transcript arrives, resolve()
+    keeps the draft if the words match, otherwise the draft is dropped and a fresh answer is generated.
+    Drafts run through generate(username, text, cancel), which must not change the chat history and
+    has to stop decoding once the threading.Event cancel is set, so a dropped draft leaves no trace and
+    does not hold up the LLM.
+    """
+
+    def __init__(self, loop : asyncio.AbstractEventLoop, generate):
+        self.loop = loop
+        self.generate = generate
+        self.drafts = {}
+
+        self.outcomes = {outcome: metrics.counter("speculative_total", "Speculative LLM drafts by outcome", outcome=outcome)
+                         for outcome in ("started", "hit", "miss")}
+        self.saved = metrics.histogram("speculative_saved_seconds", "LLM latency saved per turn by a speculative draft")
+        metrics.gauge("speculative_hit_rate", "Share of finished turns answered by a speculative draft", fn=self.hit_rate)
+
+    def hit_rate(self):
+        resolved = self.outcomes["hit"].value + self.outcomes["miss"].value
+        return round(self.outcomes["hit"].value / resolved, 3) if resolved else 0
+
+    def speculate(self, user_id, username, text):
+        key = normalize(text)
+        if not key:
+            return
+        draft = self.drafts.get(user_id)
+        if draft is not None:
+            if draft.key == key:
+                return
+            #Only one draft per user, a newer partial replaces the older one
+            draft.cancel()
+        cancel_event = threading.Event()
+        future = self.loop.run_in_executor(None, self.generate, username, text, cancel_event)
+        self.drafts[user_id] = Draft(text, future, cancel_event)
+        self.outcomes["started"].inc()
+
+    def cancel(self, user_id):
+        draft = self.drafts.pop(user_id, None)
+        if draft is not None:
+            draft.cancel()
+
+    async def resolve(self, user_id, username, text):
+        """Returns the answer for the final transcript, from the draft when it matches."""
+        draft = self.drafts.pop(user_id, None)
+        key = normalize(text)
+        if draft is not None and draft.key == key and not draft.future.cancelled():
+            arrived = time.perf_counter()
+            try:
+                answer = await draft.future
+            except Exception:
+                answer = None
+            if answer is not None:
+                #Time the draft had already been running when the final transcript arrived, up to its total run time
+                self.saved.observe(min(arrived, draft.finished or arrived) - draft.started)
+                self.outcomes["hit"].inc()
+                return answer
+
+        if draft is not None:
+            draft.cancel()
+            self.outcomes["miss"].inc()
+        return await self.loop.run_in_executor(None, self.generate, username, text, None)
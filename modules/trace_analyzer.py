@@ -0,0 +1,97 @@
+"""Rebuilds per-utterance waterfalls from the JSONL files written by modules.tracing.
+
+Usage:
+    python -m modules.trace_analyzer traces.jsonl [traces.jsonl.1 ...] [--trace ID] [--last N]
+"""
+#Default libraries
+import argparse
+import json
+from collections import defaultdict
+
+WIDTH = 50
+
+def load_spans(paths):
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    span = json.loads(line)
+                except json.JSONDecodeError:
+                    #Partially written line from a crash or a rotation
+                    continue
+                traces[span["trace"]].append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda s: s["ts"])
+    return traces
+
+def stage_totals(spans):
+    """Total time per stage name, repeated spans such as ASR partials are summed."""
+    totals = defaultdict(float)
+    for span in spans:
+        if span["dur"] > 0:
+            totals[span["name"]] += span["dur"]
+    return totals
+
+def slowest_stage(spans):
+    totals = stage_totals(spans)
+    if not totals:
+        return None, 0.0
+    name = max(totals, key=totals.get)
+    return name, totals[name]
+
+def waterfall(trace_id, spans):
+    start = spans[0]["ts"]
+    end = max(s["ts"] + s["dur"] for s in spans)
+    total = max(end - start, 1e-9)
+    user = next((s.get("user") for s in spans if s.get("user") is not None), None)
+
+    lines = [f"trace {trace_id} user {user} total {total:.3f}s"]
+    for span in spans:
+        offset = span["ts"] - start
+        left = int(offset / total * WIDTH)
+        bar = "|" if span["dur"] <= 0 else "#" * max(1, int(span["dur"] / total * WIDTH))
+        text = span.get("text")
+        text = f" {text[:40]!r}" if text else ""
+        lines.append(f"  {span['name']:<15}{offset:>8.3f}s {span['dur']:>7.3f}s {' ' * left}{bar}{text}")
+    name, seconds = slowest_stage(spans)
+    if name is not None:
+        lines.append(f"  slowest stage: {name} ({seconds:.3f}s, {seconds / total:.0%})")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-utterance waterfalls from trace JSONL files")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--trace", help="Only show this trace id")
+    parser.add_argument("--last", type=int, default=20, help="Show the last N utterances (default 20)")
+    args = parser.parse_args(argv)
+
+    traces = load_spans(args.files)
+    if args.trace is not None:
+        if args.trace not in traces:
+            print(f"Trace {args.trace} not found")
+            return 1
+        print(waterfall(args.trace, traces[args.trace]))
+        return 0
+
+    ordered = sorted(traces.items(), key=lambda item: item[1][0]["ts"])
+    for trace_id, spans in ordered[-args.last:]:
+        print(waterfall(trace_id, spans))
+        print()
+
+    #How often each stage is the bottleneck across every utterance in the files
+    slowest = defaultdict(int)
+    for spans in traces.values():
+        name, _ = slowest_stage(spans)
+        if name is not None:
+            slowest[name] += 1
+    print(f"{len(traces)} utterances, slowest stage counts:")
+    for name, count in sorted(slowest.items(), key=lambda item: -item[1]):
+        print(f"  {name:<15}{count:>6}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,76 @@
+#Default libraries
+import json
+import logging
+import logging.handlers
+import queue
+import time
+import uuid
+from contextlib import contextmanager
+
+class _JsonlFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.span, default=str)
+
+class Tracer:
+    """Per-utterance timelines. Every utterance gets a trace id on its first audio packet and each
+    stage (ASR partials, final transcript, LLM, TTS, playback) records a span against it.
+
+    Spans are handed to a QueueHandler, so the caller only pays for a dict and a queue put.
+    A QueueListener thread writes them to a rotating JSONL file. Until configure() is called every
+    call is a no-op.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._logger = logging.getLogger("discord_ai.trace")
+        self._logger.propagate = False
+        self._listener = None
+
+    def configure(self, path, max_bytes=10_000_000, backup_count=5):
+        if self._listener is not None:
+            return
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        file_handler.setFormatter(_JsonlFormatter())
+        span_queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(span_queue, file_handler)
+        self._listener.start()
+        self._logger.addHandler(logging.handlers.QueueHandler(span_queue))
+        self._logger.setLevel(logging.INFO)
+        self.enabled = True
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self.enabled = False
+
+    def new_trace(self, user=None):
+        trace_id = uuid.uuid4().hex[:12]
+        if self.enabled:
+            self._emit({"trace": trace_id, "name": "first_packet", "ts": time.time(), "dur": 0.0, "user": user})
+        return trace_id
+
+    def event(self, trace_id, name, **fields):
+        if self.enabled and trace_id is not None:
+            self._emit({"trace": trace_id, "name": name, "ts": time.time(), "dur": 0.0, **fields})
+
+    def span(self, trace_id, name, duration, **fields):
+        """Records a span that ended now and lasted duration seconds."""
+        if self.enabled and trace_id is not None:
+            self._emit({"trace": trace_id, "name": name, "ts": time.time() - duration, "dur": duration, **fields})
+
+    @contextmanager
+    def timed(self, trace_id, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.span(trace_id, name, time.perf_counter() - start, **fields)
+
+    def _emit(self, span):
+        record = self._logger.makeRecord(self._logger.name, logging.INFO, __file__, 0, span["name"], None, None)
+        record.span = span
+        self._logger.handle(record)
+
+#Process wide tracer
+tracer = Tracer()
@@ -1,20 +1,122 @@
 from tempfile import NamedTemporaryFile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import io
 
 from bark import SAMPLE_RATE, generate_audio, preload_models
+from bark.generation import clean_models
 import scipy.io.wavfile as wav
 import numpy as np
 
+from modules.generation import split_sentences
+
+#Silence put between sentences when they are joined into one file
+SENTENCE_GAP = 0.25
+
+def to_pcm16(audio_array):
+    """Peak normalizes float audio and converts it to int16 in one pass, silence stays silent."""
+    peak = np.max(np.abs(audio_array)) if audio_array.size else 0
+    scale = 32767 / peak if peak > 0 else 0
+    return np.clip(audio_array * scale, -32768, 32767).astype(np.int16)
+
+#Runs in the worker processes, each keeps its own copy of the Bark models
+def synthesize_sentence(sentence, history_prompt=None):
+    return to_pcm16(generate_audio(sentence, history_prompt=history_prompt, silent=True))
+
+def to_wav(audio_array, sample_rate):
+    data = io.BytesIO()
+    wav.write(data, sample_rate, audio_array)
+    data.seek(0)
+    return data
+
 class TTS:
-    def __init__(self):
-        preload_models()
-        self.sample_rate = 44100
+    """Bark, synthesizing each sentence of a reply separately.
+
+    With workers > 0 sentences are generated by a pool of processes (spawned, not forked, so CUDA works
+    in them). Every worker loads its own copy of the Bark models, so each one costs Bark's full memory,
+    GPU memory included; more than the default of 1 only pays off with room for several copies.
+    workers=0 generates them one after another on a thread of this process.
+    tts_sentences returns a future per sentence so playback can start with the first one. Audio is Bark's
+    native SAMPLE_RATE.
+    """
+
+    def __init__(self, workers=1, history_prompt=None):
+        self.workers = workers
+        self.history_prompt = history_prompt
+        self.sample_rate = SAMPLE_RATE
+        self.pool = None
+        self.local = None
+        if workers > 0:
+            self.start_pool()
+        else:
+            preload_models()
+
+    def start_pool(self):
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=preload_models)
+
+    #Bark keeps its models in a module level cache, called by modules.models when the TTS has been idle
+    def unload(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        else:
+            if self.local is not None:
+                self.local.shutdown(cancel_futures=True)
+                self.local = None
+            clean_models()
+
+    def tts_stream(self, text):
+        """Yields int16 audio for each sentence in order, each one as soon as it and the ones before it are done."""
+        sentences = split_sentences(text)
+        if self.workers == 0:
+            for sentence in sentences:
+                yield synthesize_sentence(sentence, self.history_prompt)
+            return
+
+        futures = [self.submit(sentence) for sentence in sentences]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def submit(self, sentence):
+        if self.workers == 0:
+            if self.local is None:
+                self.local = ThreadPoolExecutor(1, thread_name_prefix="bark")
+            return self.local.submit(synthesize_sentence, sentence, self.history_prompt)
+        if self.pool is None:
+            self.start_pool()
+        return self.pool.submit(synthesize_sentence, sentence, self.history_prompt)
+
+    def tts_sentences(self, text):
+        """Futures of in memory wav audio for each sentence, in order."""
+        futures = []
+        for sentence in split_sentences(text):
+            audio = self.submit(sentence)
+            wav_future = Future()
+            audio.add_done_callback(lambda audio, wav_future=wav_future: self.wav_done(audio, wav_future))
+            futures.append(wav_future)
+        return futures
+
+    def wav_done(self, audio, wav_future):
+        if audio.cancelled():
+            wav_future.cancel()
+        elif audio.exception() is not None:
+            wav_future.set_exception(audio.exception())
+        else:
+            wav_future.set_result(to_wav(audio.result(), self.sample_rate))
 
     def tts_wav(self, text):
-        audio_array = generate_audio(text)
-        
-        audio_array /= np.max(np.abs(audio_array))
-        audio_array = (audio_array * 32767).astype(np.int16)
+        gap = np.zeros(int(SENTENCE_GAP * self.sample_rate), dtype=np.int16)
+        chunks = []
+        for chunk in self.tts_stream(text):
+            if chunks:
+                chunks.append(gap)
+            chunks.append(chunk)
+        audio_array = np.concatenate(chunks) if chunks else gap
 
         temp_file = NamedTemporaryFile(delete=False).name + ".wav"
         wav.write(temp_file, self.sample_rate, audio_array)
-        return temp_file
\ No newline at end of file
+        return temp_file
@@ -1,16 +1,111 @@
 import pyttsx3
 from tempfile import NamedTemporaryFile
+from concurrent.futures import Future
+from queue import Empty, Queue
+import threading
+import wave
+import time
+import io
+import os
+
+from modules.generation import split_sentences
+from modules.metrics import metrics
+
+class TTSUnloaded(RuntimeError):
+    pass
 
 class TTS:
+    """pyttsx3 on a thread of its own.
+
+    pyttsx3 engines are not thread safe, so one worker thread creates the engine and runs every job from
+    a queue. Jobs return wav audio in memory (io.BytesIO). pyttsx3 can only write to a file, the worker
+    reads it back and deletes it straight away. tts_sentences queues every sentence of a reply at once,
+    so the next sentence is synthesized while the one before it plays. unload() fails every job that has
+    not started yet, and any submitted after it, with TTSUnloaded.
+    """
+
     def __init__(self):
-        self.engine = pyttsx3.init()
-        self.engine.setProperty('rate', 250)
-        voices = self.engine.getProperty('voices')
-        self.engine.setProperty('voice', voices[0].id)  # Select the first voice from available voices
         self.sample_rate = 44100
+        self.jobs = Queue()
+        self.rtf = metrics.histogram("tts_rtf", "Seconds of synthesis per second of audio produced", backend="pyttsx3")
+        self.ready = threading.Event()
+        self.error = None
+        self.closed = False
+        self.closing = threading.Lock()
+        self.worker = threading.Thread(target=self.run, name="pyttsx3", daemon=True)
+        self.worker.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
 
-    def tts_wav(self, text):
+    def run(self):
+        try:
+            engine = pyttsx3.init()
+            engine.setProperty('rate', 250)
+            voices = engine.getProperty('voices')
+            engine.setProperty('voice', voices[0].id)  # Select the first voice from available voices
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                engine.stop()
+                return
+            text, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.synthesize(engine, text))
+            except Exception as e:
+                future.set_exception(e)
+
+    def synthesize(self, engine, text):
+        start_time = time.perf_counter()
         temp_file = NamedTemporaryFile().name + ".wav"
-        self.engine.save_to_file(text, temp_file)
-        self.engine.runAndWait()
-        return temp_file
\ No newline at end of file
+        engine.save_to_file(text, temp_file)
+        engine.runAndWait()
+        try:
+            with open(temp_file, "rb") as file:
+                data = io.BytesIO(file.read())
+        finally:
+            os.remove(temp_file)
+
+        with wave.open(data) as wave_reader:
+            seconds = wave_reader.getnframes() / wave_reader.getframerate()
+        if seconds > 0:
+            self.rtf.observe((time.perf_counter() - start_time) / seconds)
+        data.seek(0)
+        return data
+
+    def submit(self, text):
+        future = Future()
+        with self.closing:
+            if self.closed:
+                future.set_exception(TTSUnloaded("pyttsx3 TTS was unloaded"))
+            else:
+                self.jobs.put((text, future))
+        return future
+
+    def tts_sentences(self, text):
+        """Futures of in memory wav audio for each sentence, in order."""
+        return [self.submit(sentence) for sentence in split_sentences(text)]
+
+    def tts_wav(self, text):
+        return self.submit(text).result()
+
+    def unload(self):
+        with self.closing:
+            self.closed = True
+            #Jobs queued behind the stop would never run, fail them so nobody waits on them forever
+            while True:
+                try:
+                    job = self.jobs.get_nowait()
+                except Empty:
+                    break
+                if job is not None and job[1].set_running_or_notify_cancel():
+                    job[1].set_exception(TTSUnloaded("pyttsx3 TTS was unloaded"))
+            self.jobs.put(None)
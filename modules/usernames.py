@@ -0,0 +1,80 @@
+#Default libraries
+import asyncio
+import time
+
+from modules.metrics import metrics
+
+def display_name(member):
+    """Guild nickname, then display name, then account name. Dots are read out by TTS so they become spaces."""
+    name = getattr(member, "nick", None) or getattr(member, "display_name", None) or member.name
+    return name.replace(".", " ")
+
+class UsernameResolver:
+    """Turns user ids from the sinks into names to address people by.
+
+    Lookups go to a TTL cache shared by every voice session, then the gateway member cache (filled by
+    Intents.all()), then the user cache, and only then a REST call. Concurrent REST lookups for the same
+    user share one request. prefetch() fills the cache for everyone in a voice channel when the bot joins.
+    """
+
+    def __init__(self, client, ttl=600):
+        self.client = client
+        self.ttl = ttl
+        self.cache = {}
+        self.inflight = {}
+        self.lookups = {source: metrics.counter("username_lookups_total", "Username lookups by where the name came from", source=source)
+                        for source in ("cache", "member", "user", "rest", "failed")}
+
+    def remember(self, user_id, name):
+        self.cache[user_id] = (name, time.monotonic() + self.ttl)
+
+    def prefetch(self, channel):
+        for member in channel.members:
+            self.remember(member.id, display_name(member))
+
+    def cached(self, user_id):
+        entry = self.cache.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    async def resolve(self, user_id, guild=None):
+        name = self.cached(user_id)
+        if name is not None:
+            self.lookups["cache"].inc()
+            return name
+
+        guilds = [guild] if guild is not None else self.client.guilds
+        for g in guilds:
+            member = g.get_member(user_id)
+            if member is not None:
+                self.lookups["member"].inc()
+                name = display_name(member)
+                self.remember(user_id, name)
+                return name
+
+        user = self.client.get_user(user_id)
+        if user is not None:
+            self.lookups["user"].inc()
+            name = display_name(user)
+            self.remember(user_id, name)
+            return name
+
+        return await self.fetch(user_id)
+
+    async def fetch(self, user_id):
+        future = self.inflight.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self.client.fetch_user(user_id))
+            self.inflight[user_id] = future
+            future.add_done_callback(lambda _: self.inflight.pop(user_id, None))
+        try:
+            user = await asyncio.shield(future)
+        except Exception as e:
+            self.lookups["failed"].inc()
+            print(f"Could not get username for {user_id}: {e}")
+            return None
+        self.lookups["rest"].inc()
+        name = display_name(user)
+        self.remember(user_id, name)
+        return name
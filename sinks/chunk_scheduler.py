@@ -0,0 +1,68 @@
+#Default libraries
+import time
+
+from modules.metrics import metrics
+
+class ChunkScheduler:
+    """Picks how many seconds of audio each streaming ASR call gets. All times are in seconds.
+
+    The speakers share one model, so while one speaker waits for their next chunk every other active
+    speaker gets a call: a round takes the sum of their smoothed call times. A chunk shorter than a round
+    (times headroom) queues up audio faster than it is transcribed. A word is committed once two passes
+    agree on it, so it shows up about two chunks plus a round after it was said. The chunk is the smallest
+    one that keeps up, a round times headroom, clamped between min_chunk and max_chunk: one speaker on a
+    fast model gets min_chunk, chunks only grow when more speakers or slower calls need them to. Calls
+    that put the expected commit latency past target_latency are counted as missed. Speakers without a
+    call in forget_after seconds are forgotten.
+    """
+
+    def __init__(self, min_chunk=0.5, max_chunk=4.0, target_latency=2.0, headroom=1.2, smoothing=0.3, active_fn=None, name="stream", forget_after=60.0):
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.target_latency = target_latency
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.active_fn = active_fn
+        self.forget_after = forget_after
+        #Smoothed seconds per process_iter call of each speaker, and when they last had one
+        self.calls = {}
+        self.last_call = {}
+
+        self.chunk_gauge = metrics.gauge("asr_chunk_seconds", "Audio per streaming ASR call picked by the scheduler", asr=name)
+        self.round_gauge = metrics.gauge("asr_round_seconds", "Time for every active speaker to get one ASR call", asr=name)
+        self.latency_gauge = metrics.gauge("asr_commit_latency_seconds", "Expected delay before a word is committed", asr=name)
+        self.chunks = metrics.histogram("asr_chunk_size_seconds", "Chunk sizes handed to streaming ASR", asr=name)
+        self.missed = metrics.counter("asr_chunk_latency_missed_total", "ASR calls whose chunk put the expected commit latency past the target", asr=name)
+        self.chunk_gauge.set(min_chunk)
+
+    def observe(self, key, audio_seconds, elapsed_seconds):
+        call = self.calls.get(key)
+        self.calls[key] = elapsed_seconds if call is None else call + self.smoothing * (elapsed_seconds - call)
+        now = time.monotonic()
+        self.last_call[key] = now
+        self.prune(now)
+        self.chunks.observe(audio_seconds)
+        if 2 * audio_seconds + self.round_seconds() > self.target_latency:
+            self.missed.inc()
+
+    def prune(self, now):
+        for key in [key for key, last in self.last_call.items() if now - last > self.forget_after]:
+            del self.calls[key]
+            del self.last_call[key]
+
+    def round_seconds(self):
+        if not self.calls:
+            return 0.0
+        active = list(self.active_fn()) if self.active_fn is not None else list(self.calls)
+        #Speakers without a measured call yet are assumed to cost the average
+        average = sum(self.calls.values()) / len(self.calls)
+        return sum(self.calls.get(key, average) for key in active)
+
+    def next_chunk(self):
+        round_seconds = self.round_seconds()
+        chunk = min(max(round_seconds * self.headroom, self.min_chunk), self.max_chunk)
+
+        self.chunk_gauge.set(round(chunk, 3))
+        self.round_gauge.set(round(round_seconds, 3))
+        self.latency_gauge.set(round(2 * chunk + round_seconds, 3))
+        return chunk
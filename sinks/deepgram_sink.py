@@ -2,6 +2,7 @@
 import asyncio
 from asyncio import Queue
 from enum import Enum
+import logging
 import time
 
 #3rd party libraries
@@ -13,6 +14,15 @@ from deepgram import (
     LiveOptions,
 )
 
+from modules.metrics import metrics
+from modules.queues import voice_queue, REJECT_NEW_SPEAKERS
+from modules.tracing import tracer
+from sinks.phrase_filter import phrase_filter
+from sinks.silence_gate import SilenceGate
+from sinks.packet_timing import GapTracker, gap_fill, stamp
+
+logger = logging.getLogger(__name__)
+
 class Speaker():
     class SpeakerState(Enum):
         RUNNING = 1
@@ -20,9 +30,10 @@ class Speaker():
         FINALIZE = 3
         STOP = 4
 
-    def __init__(self, loop : asyncio.BaseEventLoop, out_queue : Queue, deepgram_API_key, sentence_end=300, utterance_end=1000):   
+    def __init__(self, loop : asyncio.BaseEventLoop, out_queue : Queue, deepgram_API_key, sentence_end=300, utterance_end=1000, partial_results=True):   
         self.loop = loop
         self.queue = out_queue
+        self.partial_results = partial_results
 
         self.deepgram_API_key = deepgram_API_key
 
@@ -34,8 +45,13 @@ class Speaker():
 
         self.new_bytes = False
         self.last_byte = 0       
+        #Set once Deepgram was asked to flush the audio sent before the current silence
+        self.flushed = False
 
-        self.silent_packet = b"\x00" * 320
+        #Confirmed text of the current utterance and its correlation id
+        self.is_finals = []
+        self.confidences = []
+        self.trace_id = None
 
         self.state = self.SpeakerState.RUNNING    
         
@@ -43,26 +59,41 @@ class Speaker():
         self.user = user
         self.loop.create_task(self.deep_stream())
 
-    def add_data(self, data, current_time):
+    #received is when write() got the packet, gap the seconds of silence before it
+    def add_data(self, data, received, gap=0.0):
+        if self.trace_id is None:
+            self.trace_id = tracer.new_trace(self.user)
+        elif gap > 0:
+            #Pauses up to the endpointing time are sent as they were, so Deepgram hears the sentence end
+            self.data.append(gap_fill(gap, self.sentence_end/1000))
         self.data.append(data)
         self.new_bytes = True
-        self.last_byte = current_time
+        self.flushed = False
+        self.last_byte = received
 
-    def add_silence(self):
-        self.data.append(self.silent_packet)
+    async def end_utterance(self):
+        if len(self.is_finals) == 0:
+            return
+        utterance = " ".join(self.is_finals)
+        confidence = sum(self.confidences) / len(self.confidences) if self.confidences else None
+        trace_id = self.trace_id
+        self.is_finals = []
+        self.confidences = []
+        self.trace_id = None
+        end_of_turn = time.time() - self.last_byte
+        metrics.observe_stage("end_of_turn", end_of_turn)
+        tracer.span(trace_id, "end_of_turn", end_of_turn)
+        tracer.event(trace_id, "final", text=utterance)
+        if phrase_filter.is_valid(utterance, confidence=confidence):
+            await self.queue.put({"user" : self.user, "result" : utterance, "trace" : trace_id})
 
     def reset_data(self):
         self.data = []
         self.new_bytes = False
 
     async def deep_stream(self):
-        global is_finals
-        global queue
-        global user
-
-        user = self.user
-        queue = self.queue
-        is_finals = []
+        #The event handlers below get the connection as self
+        speaker = self
 
         try:
             config: DeepgramClientOptions = DeepgramClientOptions(
@@ -72,51 +103,42 @@ class Speaker():
             dg_connection = deepgram.listen.asyncwebsocket.v("1")
 
             async def on_open(self, open, **kwargs):
-                print("Connection Open")
+                logger.debug("Connection Open")
 
             async def on_message(self, result, **kwargs):
-                global is_finals
-                global queue
-                sentence = result.channel.alternatives[0].transcript
+                alternative = result.channel.alternatives[0]
+                sentence = alternative.transcript
                 if len(sentence) == 0:
                     return
                 if result.is_final:
-                    is_finals.append(sentence)
-                    if result.speech_final:
-                        utterance = " ".join(is_finals)
-                        print(f"Speech Final: {utterance}")                      
-                    else:
-                        print(f"Is Final: {sentence}")
+                    speaker.is_finals.append(sentence)
+                    speaker.confidences.append(alternative.confidence)
+                    #from_finalize: the flush asked for after sentence_end ms without packets
+                    from_finalize = getattr(result, "from_finalize", False)
+                    tracer.event(speaker.trace_id, "asr_final", text=sentence, speech_final=result.speech_final)
+                    #Deepgram's endpointing fired, the utterance end follows after utterance_end ms of silence
+                    if (result.speech_final or from_finalize) and speaker.partial_results and phrase_filter.check(" ".join(speaker.is_finals)) is None:
+                        await speaker.queue.put({"user" : speaker.user, "result" : " ".join(speaker.is_finals), "trace" : speaker.trace_id, "partial" : True})
                 else:
-                    print(f"Interim Results: {sentence}")
+                    tracer.event(speaker.trace_id, "asr_partial", text=sentence)
 
             async def on_metadata(self, metadata, **kwargs):
-                print(f"Metadata: {metadata}")
+                logger.debug(f"Metadata: {metadata}")
 
             async def on_speech_started(self, speech_started, **kwargs):
-                print("Speech Started")
+                tracer.event(speaker.trace_id, "speech_started")
                 
             async def on_utterance_end(self, utterance_end, **kwargs):               
-                global is_finals
-                global queue
-                global user
-
-                print("Utterance End")
-
-                if len(is_finals) > 0:
-                    utterance = " ".join(is_finals)
-                    print(f"Utterance End: {utterance}")
-                    await queue.put({"user" : user, "result" : utterance})
-                    is_finals = []
+                await speaker.end_utterance()
 
             async def on_close(self, close, **kwargs):
-                print("Connection Closed")
+                logger.debug("Connection Closed")
 
             async def on_error(self, error, **kwargs):
-                print(f"Handled Error: {error}")
+                logger.error(f"Handled Error: {error}")
 
             async def on_unhandled(self, unhandled, **kwargs):
-                print(f"Unhandled Websocket Message: {unhandled}")
+                logger.warning(f"Unhandled Websocket Message: {unhandled}")
 
             dg_connection.on(LiveTranscriptionEvents.Open, on_open)
             dg_connection.on(LiveTranscriptionEvents.Transcript, on_message)
@@ -146,18 +168,22 @@ class Speaker():
             }
 
             if await dg_connection.start(options, addons=addons) is False:
-                print("Failed to connect to Deepgram")
+                logger.error("Failed to connect to Deepgram")
                 return
 
             while self.state != self.SpeakerState.STOP:
                 if self.state == self.SpeakerState.TRANSCRIBE:
+                    start_time = time.perf_counter()
                     await dg_connection.send(b"".join(self.data))
+                    elapsed = time.perf_counter() - start_time
+                    metrics.observe_stage("asr", elapsed)
+                    tracer.span(self.trace_id, "asr_send", elapsed)
                     self.reset_data()
                     self.state = self.SpeakerState.RUNNING
                     
                 elif self.state == self.SpeakerState.FINALIZE:
+                    #Everything was sent already, packets that came in since are sent on the next pass
                     await dg_connection.finalize()
-                    self.reset_data()
                     self.state = self.SpeakerState.RUNNING
                 else:
                     await asyncio.sleep(.005)
@@ -166,18 +192,26 @@ class Speaker():
             await asyncio.sleep(1)
 
         except Exception as e:
-            print(f"Could not open socket: {e}")
+            logger.error(f"Could not open socket: {e}")
             return
 
 class DeepgramSink(Sink):
 
     class SinkSettings:
-        def __init__(self, deepgram_API_key,sentence_end = 300,utterence_end = 1000, data_length=25000, max_speakers=-1):   
+        def __init__(self, deepgram_API_key,sentence_end = 300,utterence_end = 1000, data_length=25000, max_speakers=-1, queue_size=1000, overload_policy="drop_oldest", partial_results=True, silence_gate=True):   
             self.deepgram_API_key = deepgram_API_key
             self.sentence_end = sentence_end
             self.utterence_end = utterence_end
             self.data_length = data_length
             self.max_speakers = max_speakers
+            #Max audio packets (20ms each) waiting to be sorted, and what to shed when full:
+            #"drop_oldest", "reject" (drop newest) or "reject_new_speakers"
+            self.queue_size = queue_size
+            self.overload_policy = overload_policy
+            #Send confirmed text as soon as Deepgram detects the end of speech, so an answer can be started early
+            self.partial_results = partial_results
+            #Drop audio that is clearly silence or background noise as it arrives instead of uploading it, see sinks/silence_gate.py
+            self.silence_gate = silence_gate
 
     def __init__(self, *, filters=None, sink_settings : SinkSettings, queue : asyncio.Queue, loop : asyncio.AbstractEventLoop):
         if filters is None:
@@ -193,8 +227,12 @@ class DeepgramSink(Sink):
 
         self.running = True  
 
-        self.voice_queue = Queue()
+        self.voice_queue = voice_queue(self.sink_settings.queue_size, self.sink_settings.overload_policy)
+        self.silence_gate = SilenceGate() if self.sink_settings.silence_gate else None
+        self.gaps = GapTracker()
         self.speakers = []
+        self.rejected_speakers = metrics.counter("queue_shed_total", "Items dropped, merged or rejected by bounded queues", queue="voice", policy=REJECT_NEW_SPEAKERS)
+        metrics.gauge("live_speakers", "Speakers currently tracked by the sink", fn=lambda: len(self.speakers))
         self.loop.create_task(self.insert_voice()) 
 
     async def insert_voice(self):
@@ -206,6 +244,7 @@ class DeepgramSink(Sink):
                 #Sorts data from queue for each speaker after each transcription             
                 while not self.voice_queue.empty():                  
                     item = await self.voice_queue.get()
+                    metrics.observe_stage("ingest", time.perf_counter() - item[2])
 
                     user_exists = False
                     for speaker in self.speakers:     
@@ -213,7 +252,7 @@ class DeepgramSink(Sink):
                             speaker.add_user(item[0])
                                        
                         if item[0] == speaker.user:
-                            speaker.add_data(item[1], current_time)                          
+                            speaker.add_data(item[1], item[3], item[4])                          
                             user_exists = True
                             break
 
@@ -224,9 +263,10 @@ class DeepgramSink(Sink):
                                                          self.queue, 
                                                          self.sink_settings.deepgram_API_key, 
                                                          self.sink_settings.sentence_end, 
-                                                         self.sink_settings.utterence_end))
+                                                         self.sink_settings.utterence_end,
+                                                         self.sink_settings.partial_results))
                             self.speakers[-1].add_user(item[0])
-                            self.speakers[-1].add_data(item[1], current_time)
+                            self.speakers[-1].add_data(item[1], item[3], item[4])
             else:  
                 #Loops with no wait time is bad
                 await asyncio.sleep(.02)
@@ -235,12 +275,14 @@ class DeepgramSink(Sink):
                 #Transcribe when new data is available
                 if speaker.new_bytes:
                     speaker.state = speaker.SpeakerState.TRANSCRIBE
-                #finalize data if X seconds passes from last data packet from discord
-                elif current_time > speaker.last_byte + speaker.utterance_end/1000:
-                    speaker.state = speaker.SpeakerState.FINALIZE   
-                #add silence to help process utterance
-                elif  current_time > speaker.last_byte + speaker.sentence_end/1000:
-                    speaker.add_silence()
+                #No audio is sent while a user is silent, so Deepgram can not hear the pause itself.
+                #Have it confirm everything sent so far once sentence_end passes from the last data packet from discord
+                elif not speaker.flushed and current_time > speaker.last_byte + speaker.sentence_end/1000:
+                    speaker.flushed = True
+                    speaker.state = speaker.SpeakerState.FINALIZE
+                #and end the utterance with what it confirmed once utterance_end passes
+                elif speaker.flushed and current_time > speaker.last_byte + speaker.utterance_end/1000:
+                    await speaker.end_utterance()
         
         for speaker in self.speakers:     
             speaker.state = speaker.SpeakerState.STOP
@@ -248,12 +290,25 @@ class DeepgramSink(Sink):
     #Gets audio data from discord for each user talking
     @Filters.container
     def write(self, data, user):
+        #Timing is taken here rather than when the queue is read. py-cord's zero padding and audio dropped by the
+        #silence gate are never uploaded, they come back as the gap in front of the speaker's next packet
+        data, received, gap = stamp(self.gaps, self.silence_gate, user, data)
+        if not data:
+            return
+
         data_len = len(data)
         if data_len > self.sink_settings.data_length:
             data = data[-self.sink_settings.data_length+int(self.sink_settings.data_length/10):]
+
+        #While overloaded, only keep listening to people who are already being transcribed
+        if (self.sink_settings.overload_policy == REJECT_NEW_SPEAKERS
+            and self.voice_queue.overloaded
+            and not any(speaker.user == user for speaker in self.speakers)):
+            self.rejected_speakers.inc()
+            return
         
         #Send bytes to be transcribed
-        self.voice_queue.put_nowait([user, data])
+        self.voice_queue.put_nowait([user, data, time.perf_counter(), received, gap])
 
     #End thread
     def close(self):
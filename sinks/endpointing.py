@@ -0,0 +1,85 @@
+#Default libraries
+import re
+
+from modules.metrics import metrics
+
+#Ends with . ! or ? (optionally followed by a closing quote or bracket) but not an ellipsis
+TERMINAL_PUNCTUATION = re.compile(r"(?<!\.)[.!?][\"')\]]*$")
+TRAILING_ELLIPSIS = re.compile(r"(\.{2,}|…)[\"')\]]*$")
+
+#Last words that almost always mean the sentence goes on
+CONTINUATION_WORDS = frozenset((
+    "and", "but", "or", "so", "because", "the", "a", "an", "to", "of", "with", "like", "um", "uh", "if", "that", "my", "your",
+))
+
+class TurnState:
+    """Per speaker bookkeeping for EndOfTurnDetector."""
+
+    def __init__(self):
+        self.text = ""
+        self.text_changed = 0
+        self.last_end = None
+        #Extra silence learned from this speaker resuming right after being cut off
+        self.extra = 0.0
+
+class EndOfTurnDetector:
+    """Decides when a speaker has finished their turn. All times are in seconds.
+
+    The silence needed before a turn ends starts at target_latency and is scaled by what has been heard:
+    - a transcript ending in terminal punctuation halves it, an ellipsis, comma or continuation word raises it
+    - a transcript that has not changed for stable_after seconds (ASR has nothing new to say) shortens it
+    - speakers who start talking again within resume_window of a cut off get more silence next time,
+      which decays again on turns that were not interrupted
+    The result is clamped between min_silence and max_silence.
+    """
+
+    def __init__(self, target_latency=1.0, min_silence=0.3, max_silence=2.5, stable_after=0.4, resume_window=1.5, adapt_step=0.15):
+        self.target_latency = target_latency
+        self.min_silence = min_silence
+        self.max_silence = max_silence
+        self.stable_after = stable_after
+        self.resume_window = resume_window
+        self.adapt_step = adapt_step
+
+        self.resumed = metrics.counter("turn_resumed_total", "Turns ended too early, the speaker kept talking right after")
+
+    def observe_voice(self, state : TurnState, now):
+        """Call for the first audio of a new turn."""
+        if state.last_end is None:
+            return
+        if now - state.last_end < self.resume_window:
+            state.extra = min(state.extra + self.adapt_step, self.max_silence)
+            self.resumed.inc()
+        else:
+            state.extra = max(0.0, state.extra - self.adapt_step / 2)
+        state.last_end = None
+
+    def observe_text(self, state : TurnState, text, now):
+        text = text.strip()
+        if text != state.text:
+            state.text = text
+            state.text_changed = now
+
+    def required_silence(self, state : TurnState, now):
+        silence = self.target_latency + state.extra
+        text = state.text
+        if text:
+            last_word = text.rsplit(None, 1)[-1].lower().strip(",;:")
+            if TRAILING_ELLIPSIS.search(text) or text.endswith((",", ";", ":")) or last_word in CONTINUATION_WORDS:
+                silence *= 1.5
+            elif TERMINAL_PUNCTUATION.search(text):
+                silence *= 0.5
+            if now - state.text_changed >= self.stable_after:
+                silence *= 0.75
+        return min(max(silence, self.min_silence), self.max_silence)
+
+    def is_end_of_turn(self, state : TurnState, silence, now):
+        return silence >= self.required_silence(state, now)
+
+    def is_likely_end(self, state : TurnState, silence, now, fraction=0.5):
+        """True part way into the required silence, early enough to start work on a turn that will probably end."""
+        return bool(state.text) and silence >= fraction * self.required_silence(state, now)
+
+    def end_turn(self, state : TurnState, now):
+        state.text = ""
+        state.last_end = now
@@ -0,0 +1,80 @@
+#Default libraries
+import time
+
+#3rd party libraries
+import numpy as np
+
+from modules.metrics import metrics
+
+#py-cord decodes every RTP packet to 20ms of 48kHz stereo 16 bit PCM
+DISCORD_BYTES_PER_SECOND = 48000 * 2 * 2
+PACKET_BYTES = DISCORD_BYTES_PER_SECOND // 50
+#One sample of both channels, fills have to stay aligned to it
+FRAME_BYTES = 4
+#Longest silence put back between two packets for local ASR, in seconds
+MAX_GAP_FILL = 0.2
+#A user whose last packet with sound is younger than this is taken to be mid-utterance, in seconds
+SPEAKING_HANGOVER = 0.5
+
+def split_prepended_silence(data):
+    """py-cord puts zeros for the time since a user's last packet (from the RTP timestamps) in front of
+    the next one. Returns (gap bytes, audio) with those zeros taken off."""
+    head = len(data) - PACKET_BYTES
+    if head <= 0:
+        return 0, data
+    #Not py-cord's padding if anything in front of the last packet is sound
+    if np.count_nonzero(np.frombuffer(data, dtype=np.uint8, count=head)):
+        return 0, data
+    return head, data[head:]
+
+class GapTracker:
+    """Per speaker silence that never made it into the queue, from py-cord's padding and the silence gate.
+
+    Sinks call dropped() for every byte of real time they throw away and take() when a packet is queued,
+    which returns the seconds of silence in front of it. The time of that packet is kept for speaking().
+    """
+
+    def __init__(self):
+        self.pending = {}
+        #Wall clock time of each user's last queued packet
+        self.heard = {}
+
+    def dropped(self, user, nbytes):
+        #Negative when the silence gate puts dropped preroll back in front of speech
+        self.pending[user] = self.pending.get(user, 0) + nbytes
+
+    def take(self, user, received=None):
+        self.heard[user] = time.time() if received is None else received
+        return max(self.pending.pop(user, 0), 0) / DISCORD_BYTES_PER_SECOND
+
+    def speaking(self, hangover=SPEAKING_HANGOVER):
+        """Users heard within the last hangover seconds. Called from the event loop while write() adds to heard."""
+        now = time.time()
+        return {user for user, heard in list(self.heard.items()) if now - heard < hangover}
+
+def stamp(gaps : GapTracker, silence_gate, user, data):
+    """Runs in write() on the voice thread. Returns the audio worth queueing (b"" for none) and the
+    packet's timing: wall clock time it was received and seconds of silence before it."""
+    received = time.time()
+    gap, data = split_prepended_silence(data)
+    if silence_gate is not None:
+        kept = silence_gate.filter(user, data)
+        gap += len(data) - len(kept)
+        data = kept
+    gaps.dropped(user, gap)
+    if not data:
+        return data, received, 0.0
+    return data, received, gaps.take(user, received)
+
+def gap_fill(gap, max_fill):
+    """Zeros standing in for a real gap between two packets of a speaker, at most max_fill seconds long.
+
+    Short pauses keep their length so words stay apart and timing stays right, longer ones are cut to
+    max_fill since the rest is silence that would only be resampled and transcribed for nothing.
+    """
+    if gap <= 0:
+        return b""
+    fill = min(gap, max_fill)
+    metrics.counter("gap_seconds_total", "Silence between a speaker's packets", outcome="filled").inc(fill)
+    metrics.counter("gap_seconds_total", "Silence between a speaker's packets", outcome="skipped").inc(gap - fill)
+    return bytes(int(fill * DISCORD_BYTES_PER_SECOND) // FRAME_BYTES * FRAME_BYTES)
@@ -0,0 +1,112 @@
+#Default libraries
+import re
+
+from modules.metrics import metrics
+
+# Whisper hallucinations and filler that are not worth an LLM and TTS round trip
+EXCLUDED_PHRASES = [
+    "",
+    "thanks",
+    "tch",
+    "thank you so much thank you",
+    "for more information on covid-19 vaccines visit our website",
+    "thank you very much",
+    "we'll be right back",
+    "subs by www.zeoranger.co.uk",
+    "hello everyone",
+    "thank you bye",
+    "thank you",
+    "all right",
+    "thank you thank you",
+    "thank you for watching",
+    "thanks for watching",
+    "i'll see you next time",
+    "got to cancel",
+    "shh",
+    "wow",
+    "shhh",
+    "hello",
+    "you",
+    "the",
+    "yeah",
+    "but",
+    "heh heh",
+    "heh",
+    "bye",
+    "okay",
+    "silence",
+    "make sure to like comment and subscribe",
+    "please subscribe",
+]
+
+_PUNCTUATION = re.compile(r"[.!?,;:\"()\[\]…-]+")
+_SPACES = re.compile(r"\s+")
+
+def normalize(text):
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text.lower())).strip()
+
+class PhraseFilter:
+    """Drops transcripts that are junk before they reach the LLM queue. Shared by every sink.
+
+    - exact match against a set of known hallucinations, after lowercasing and stripping punctuation
+    - repetition: the same word over and over, or mostly repeated n-grams, which is how whisper loops
+    - confidence signals from faster-whisper segments: no speech with low log probability (the rule
+      whisper itself uses), or a high compression ratio, weighted by segment duration
+    - a minimum confidence for engines that report one directly, like Deepgram
+    """
+
+    def __init__(self, excluded_phrases=EXCLUDED_PHRASES, max_word_repeats=4, ngram=3, min_unique_ngrams=0.5,
+                 no_speech_prob=0.6, avg_logprob=-1.0, compression_ratio=2.4, min_confidence=0.5):
+        # Stored normalized so the check is one set lookup
+        self.excluded = frozenset(normalize(p) for p in excluded_phrases)
+        self.max_word_repeats = max_word_repeats
+        self.ngram = ngram
+        self.min_unique_ngrams = min_unique_ngrams
+        self.no_speech_prob = no_speech_prob
+        self.avg_logprob = avg_logprob
+        self.compression_ratio = compression_ratio
+        self.min_confidence = min_confidence
+
+        self.checked = metrics.counter("phrases_checked_total", "Transcripts checked by the phrase filter")
+
+    def check(self, text, segments=None, confidence=None):
+        """Returns why the text is junk, or None if it should be answered."""
+        cleaned = normalize(text)
+        if cleaned in self.excluded:
+            return "excluded"
+
+        words = cleaned.split()
+        run = 1
+        for i in range(1, len(words)):
+            run = run + 1 if words[i] == words[i - 1] else 1
+            if run >= self.max_word_repeats:
+                return "repetition"
+        if len(words) >= 2 * self.ngram:
+            ngrams = [tuple(words[i:i + self.ngram]) for i in range(len(words) - self.ngram + 1)]
+            if len(set(ngrams)) < self.min_unique_ngrams * len(ngrams):
+                return "repetition"
+
+        # faster-whisper returns a generator, it is read once here so every weight below sees the segments
+        segments = list(segments) if segments is not None else []
+        total = sum(max(s.end - s.start, 0.01) for s in segments)
+        if total > 0:
+            weight = lambda attr: sum(getattr(s, attr) * max(s.end - s.start, 0.01) for s in segments) / total
+            if weight("no_speech_prob") > self.no_speech_prob and weight("avg_logprob") < self.avg_logprob:
+                return "no_speech"
+            if weight("compression_ratio") > self.compression_ratio:
+                return "compression_ratio"
+
+        if confidence is not None and confidence < self.min_confidence:
+            return "low_confidence"
+        return None
+
+    def is_valid(self, text, segments=None, confidence=None):
+        self.checked.inc()
+        reason = self.check(text, segments, confidence)
+        if reason is not None:
+            metrics.counter("phrases_dropped_total", "Transcripts dropped by the phrase filter", reason=reason).inc()
+            return False
+        return True
+
+# One filter for every sink, swap or reconfigure it before the bot joins a call
+phrase_filter = PhraseFilter()
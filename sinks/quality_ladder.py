@@ -0,0 +1,92 @@
+#Default libraries
+import logging
+import time
+
+from modules.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+#Each step is cheaper than the one before it. Keys are optional:
+#beam_size/best_of - decoding options passed to faster-whisper
+#model - whisper model size to switch to
+#min_chunk - minimum seconds of audio per streaming ASR call, bigger means fewer calls
+STREAM_LADDER = [
+    {"beam_size": 5},
+    {"beam_size": 2},
+    {"beam_size": 1},
+    {"beam_size": 1, "model": "small.en"},
+    {"beam_size": 1, "model": "small.en", "min_chunk": 1.0},
+]
+
+WHISPER_LADDER = [
+    {"beam_size": 10, "best_of": 3},
+    {"beam_size": 5, "best_of": 2},
+    {"beam_size": 1, "best_of": 1},
+    {"beam_size": 1, "best_of": 1, "model": "small.en"},
+    {"beam_size": 1, "best_of": 1, "model": "base.en"},
+]
+
+class QualityController:
+    """Moves along a quality ladder based on how far ASR is behind real time.
+
+    Load is the smoothed real-time factor (processing seconds per second of audio) multiplied by the number
+    of speakers waiting for ASR, since they share one model. Above step_down the controller moves to a
+    cheaper level, below step_up it moves back towards the best one. A cooldown between transitions stops
+    it from flapping while the new settings take effect.
+    """
+
+    def __init__(self, ladder, name="asr", pending_fn=None, step_down=0.9, step_up=0.4, smoothing=0.3, cooldown=5.0):
+        if not ladder:
+            raise ValueError("Quality ladder needs at least one level")
+        self.ladder = ladder
+        self.name = name
+        self.pending_fn = pending_fn
+        self.step_down = step_down
+        self.step_up = step_up
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+
+        self.level = 0
+        self.rtf = None
+        self.last_change = 0
+        self.listeners = []
+
+        self.level_gauge = metrics.gauge("asr_quality_level", "Current step on the ASR quality ladder, 0 is best", asr=name)
+        self.rtf_gauge = metrics.gauge("asr_rtf", "Smoothed ASR real-time factor", asr=name)
+        self.load_gauge = metrics.gauge("asr_load", "ASR real-time factor times pending speakers", asr=name)
+
+    @property
+    def settings(self):
+        return self.ladder[self.level]
+
+    def on_change(self, callback):
+        """callback(settings) runs on every transition and once now with the current level."""
+        self.listeners.append(callback)
+        callback(self.settings)
+
+    def observe(self, audio_seconds, elapsed_seconds):
+        if audio_seconds <= 0:
+            return
+        rtf = elapsed_seconds / audio_seconds
+        self.rtf = rtf if self.rtf is None else self.rtf + self.smoothing * (rtf - self.rtf)
+        pending = max(1, self.pending_fn()) if self.pending_fn is not None else 1
+        load = self.rtf * pending
+        self.rtf_gauge.set(round(self.rtf, 3))
+        self.load_gauge.set(round(load, 3))
+
+        now = time.monotonic()
+        if now - self.last_change < self.cooldown:
+            return
+        if load > self.step_down and self.level < len(self.ladder) - 1:
+            self._set_level(self.level + 1, "down", load, now)
+        elif load < self.step_up and self.level > 0:
+            self._set_level(self.level - 1, "up", load, now)
+
+    def _set_level(self, level, direction, load, now):
+        logger.info(f"{self.name} quality {direction}: level {self.level} -> {level} at load {load:.2f} {self.ladder[level]}")
+        self.level = level
+        self.last_change = now
+        self.level_gauge.set(level)
+        metrics.counter("asr_quality_transitions_total", "Steps taken on the ASR quality ladder", asr=self.name, direction=direction).inc()
+        for callback in self.listeners:
+            callback(self.settings)
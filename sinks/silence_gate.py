@@ -0,0 +1,102 @@
+#Default libraries
+import time
+from collections import deque
+
+#3rd party libraries
+import numpy as np
+
+from modules.metrics import metrics
+
+#Discord hands sinks 48kHz stereo 16 bit PCM
+DISCORD_SAMPLING = 48000
+DISCORD_CHANNELS = 2
+
+class GateState:
+    """Per speaker noise floor, hangover and the last dropped frames."""
+
+    def __init__(self, floor, preroll_frames):
+        self.floor = floor
+        self.hangover = 0
+        self.held = deque(maxlen=preroll_frames)
+
+class SilenceGate:
+    """Drops audio that is clearly silence before it reaches the sink's queue.
+
+    Audio is cut into frame_ms frames and each frame's RMS and peak are computed at once with NumPy over
+    a view of the packet. A frame is voiced when its RMS is margin times above the speaker's noise floor
+    and its peak is above min_peak. The floor follows quiet frames, falling fast and rising slowly, so it
+    settles on each speaker's background noise. hangover_ms of audio after a voiced frame is kept so
+    word endings and short pauses are not clipped, and the last preroll_ms of dropped audio is put back
+    in front of speech so soft word onsets survive.
+    """
+
+    def __init__(self, frame_ms=20, margin=2.5, min_floor=30.0, min_peak=300, hangover_ms=300, preroll_ms=60, fall=0.2, rise=0.01,
+                 sample_rate=DISCORD_SAMPLING, channels=DISCORD_CHANNELS):
+        self.frame_samples = sample_rate * frame_ms // 1000 * channels
+        self.margin = margin
+        self.min_floor = min_floor
+        self.min_peak = min_peak
+        self.hangover_frames = hangover_ms // frame_ms
+        self.preroll_frames = preroll_ms // frame_ms
+        self.fall = fall
+        self.rise = rise
+        self.states = {}
+
+        self.kept = metrics.counter("silence_gate_bytes_total", "Audio bytes seen by the silence gate", outcome="kept")
+        self.dropped = metrics.counter("silence_gate_bytes_total", "Audio bytes seen by the silence gate", outcome="dropped")
+        self.cpu = metrics.counter("silence_gate_cpu_seconds_total", "CPU time spent in the silence gate")
+
+    def voiced(self, state : GateState, rms, peak):
+        mask = np.empty(len(rms), dtype=bool)
+        for i in range(len(rms)):
+            if rms[i] > state.floor * self.margin and peak[i] > self.min_peak:
+                mask[i] = True
+                state.hangover = self.hangover_frames
+            else:
+                mask[i] = state.hangover > 0
+                state.hangover = max(state.hangover - 1, 0)
+                step = self.fall if rms[i] < state.floor else self.rise
+                state.floor = max(state.floor + step * (rms[i] - state.floor), self.min_floor)
+        return mask
+
+    def filter(self, user, data):
+        """Returns the voiced part of data, b"" when there is none."""
+        start_time = time.thread_time()
+        samples = np.frombuffer(data, dtype=np.int16)
+        frames = len(samples) // self.frame_samples
+        if frames == 0:
+            self.kept.inc(len(data))
+            return data
+
+        state = self.states.get(user)
+        if state is None:
+            state = self.states[user] = GateState(self.min_floor, self.preroll_frames)
+
+        #A partial frame at the end is judged with the last full frame
+        framed = samples[:frames * self.frame_samples].reshape(frames, self.frame_samples).astype(np.float32)
+        rms = np.sqrt(np.mean(framed * framed, axis=1))
+        peak = np.max(np.abs(framed), axis=1)
+        mask = self.voiced(state, rms, peak)
+
+        frame_bytes = self.frame_samples * 2
+        if mask.all() and not state.held:
+            kept = data
+        else:
+            pieces = []
+            for i in range(frames):
+                frame = data[i * frame_bytes:(i + 1) * frame_bytes]
+                if mask[i]:
+                    pieces.extend(state.held)
+                    state.held.clear()
+                    pieces.append(frame)
+                else:
+                    state.held.append(frame)
+            if mask[-1]:
+                pieces.append(data[frames * frame_bytes:])
+            kept = b"".join(pieces)
+
+        self.kept.inc(len(kept))
+        #Preroll put back in front of speech was already counted as dropped
+        self.dropped.inc(max(len(data) - len(kept), 0))
+        self.cpu.inc(time.thread_time() - start_time)
+        return kept
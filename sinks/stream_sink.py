@@ -6,17 +6,34 @@ import time
 #3rd party libraries
 from discord.sinks.core import Filters, Sink, default_filters
 from sinks.whisper_stream.whisper_online import *
-
-asr = FasterWhisperASR("en", "medium.en")  # loads and wraps Whisper model
+from modules.metrics import metrics
+from modules.models import models
+from modules.queues import voice_queue, REJECT_NEW_SPEAKERS
+from modules.tracing import tracer
+from sinks.quality_ladder import QualityController, STREAM_LADDER
+from sinks.endpointing import EndOfTurnDetector, TurnState
+from sinks.chunk_scheduler import ChunkScheduler
+from sinks.phrase_filter import phrase_filter
+from sinks.silence_gate import SilenceGate
+from sinks.packet_timing import DISCORD_BYTES_PER_SECOND, GapTracker, MAX_GAP_FILL, gap_fill, stamp
+from sinks.whisper_stream.silero_vad_engine import BatchedVAD, VADBatcher
+
+asr = FasterWhisperASR("en", "medium.en")  # wraps the shared Whisper model, loaded on first use
 asr.use_vad()
 
 DISCORD_SAMPLING = 48000
 WHISPER_SAMPLING = 16000
 
 class Speaker():
-    def __init__(self, loop : asyncio.BaseEventLoop, out_queue : Queue, min_chunk=1000):   
+    def __init__(self, loop : asyncio.BaseEventLoop, out_queue : Queue, min_chunk=1000, quality : QualityController = None, endpointer : EndOfTurnDetector = None, vad : VADBatcher = None,
+                 scheduler : ChunkScheduler = None, buffer_trimming=("segment", 15)):   
         self.loop = loop
         self.queue = out_queue
+        self.quality = quality
+        #Sizes the chunks from ASR speed and load when set, otherwise min_chunk is used as is
+        self.scheduler = scheduler
+        self.endpointer = endpointer if endpointer is not None else EndOfTurnDetector()
+        self.turn = TurnState()
 
         #minimum value in seconds to process audio buffer
         self.min_chunk = min_chunk/1000
@@ -26,9 +43,20 @@ class Speaker():
 
         self.last_byte = 0
 
-        self.phrases = []
+        #Correlation id for the utterance currently being heard, set on its first packet
+        self.trace_id = None
 
-        self.online = OnlineASRProcessor(asr)
+        self.phrases = []
+        #Text last sent as a partial result for speculative answers
+        self.speculated = None
+
+        #With a VAD only voiced audio reaches whisper and the turn ends as soon as the VAD hears the end of speech.
+        #The VAD of every speaker runs in shared batches
+        self.vad = vad
+        if vad is not None:
+            self.online = VACOnlineASRProcessor(self.min_chunk, asr, vad=vad.engine, buffer_trimming=buffer_trimming)
+        else:
+            self.online = OnlineASRProcessor(asr, buffer_trimming=buffer_trimming)
         self.online.init()
 
         self.processing = False
@@ -39,52 +67,50 @@ class Speaker():
         self.user = user
         asyncio.create_task(self.stream())
 
-    def add_data(self, data, current_time):
+    #received is when write() got the packet, gap the seconds of silence before it
+    def add_data(self, data, received, gap=0.0):
+        if self.trace_id is None:
+            #First packet of a new turn, the silence before it is not part of it
+            self.trace_id = tracer.new_trace(self.user)
+            self.endpointer.observe_voice(self.turn, received)
+        elif gap > 0:
+            self.data.append(gap_fill(gap, MAX_GAP_FILL))
         self.data.append(data)
-        self.last_byte = current_time
-
-    def add_silence(self):
-        sample_rate = DISCORD_SAMPLING
-        channels = 2
-        bit_depth = 16
-
-        bytes_per_sample = bit_depth // 8
-        total_samples = int(sample_rate * channels * (self.min_chunk*5))
-        total_bytes = total_samples * bytes_per_sample
-
-        silent_packet = b'\x00' * total_bytes
-
-        self.data.append(silent_packet)
+        self.last_byte = received
 
     #TODO remake this godsforsaken conversion, has some noise from conversion
     def convert_audio(self, audio_bytes):
         #a = np.frombuffer(audio_bytes, np.int16).flatten().astype(np.float32)/32768.0
-        s_f = sf.SoundFile(io.BytesIO(audio_bytes), channels=2,endian="LITTLE",samplerate=DISCORD_SAMPLING, subtype="PCM_16",format="RAW")
-        a, _ = librosa.load(s_f,sr=WHISPER_SAMPLING, mono=True,dtype=np.float32)  
+        with metrics.stage("resample").time():
+            s_f = sf.SoundFile(io.BytesIO(audio_bytes), channels=2,endian="LITTLE",samplerate=DISCORD_SAMPLING, subtype="PCM_16",format="RAW")
+            a, _ = librosa.load(s_f,sr=WHISPER_SAMPLING, mono=True,dtype=np.float32)  
         return a
 
-    async def recieve_audio_chunk(self):
+    #force sends whatever audio is left even if it is shorter than min_chunk, used when the turn ends
+    async def recieve_audio_chunk(self, force=False):
         if len(self.data) == 0:
             return None
 
-        minlimit = self.min_chunk*DISCORD_SAMPLING
-        out = []
+        min_chunk = self.scheduler.next_chunk() if self.scheduler is not None else self.min_chunk
+        if self.quality is not None:
+            #Cheaper quality levels can ask for bigger chunks so ASR is called less often
+            min_chunk = max(min_chunk, self.quality.settings.get("min_chunk", 0))
+        #The VAD processor decides on its own when enough voiced audio has come in
+        if isinstance(self.online, VACOnlineASRProcessor):
+            self.online.online_chunk_size = min_chunk
+
+        #Measured on the raw bytes, so nothing is resampled until there is a whole chunk
+        if not force and sum(len(d) for d in self.data) < min_chunk*DISCORD_BYTES_PER_SECOND:
+            return None
 
         a = self.convert_audio(b"".join(self.data))
         
         assert a.dtype == np.float32, "Audio data should be float32."
         assert -1.0 <= a.min() and a.max() <= 1.0, "Audio data should be normalized between -1.0 and 1.0."
         assert len(a) > 0, "Audio data should not be empty."
-        out.append(a)
-        
-        if sum(len(x) for x in out) < minlimit:
-            return None
-
-        if not out:
-            return None
         
         self.data = []
-        return np.concatenate(out)
+        return a
 
     async def stream(self):
         while self.running:
@@ -96,35 +122,76 @@ class Speaker():
 
     def end(self):
         self.running = False
+        #The shared VAD keeps a stream per speaker until it is told to let go
+        if self.vad is not None:
+            self.vad.engine.remove(self.online.vac.key)
+
+    #Runs in the executor, inserting into a VAC processor cuts the audio at the VAD events
+    def process_chunk(self, a, vad_event):
+        if self.vad is not None:
+            self.online.insert_vad_result(a, vad_event)
+        else:
+            self.online.insert_audio_chunk(a)
+        start_time = time.perf_counter()
+        transcript = self.online.process_iter()
+        return transcript, time.perf_counter() - start_time
 
     async def transcript_check(self, a):     
-            self.online.insert_audio_chunk(a)
             try:
                 loop = asyncio.get_event_loop()
                 self.processing = True
-                transcript = await loop.run_in_executor(None, self.online.process_iter,)
+                vad_event = await self.vad.detect(self.online.vac.key, a) if self.vad is not None else None
+                transcript, elapsed = await loop.run_in_executor(None, self.process_chunk, a, vad_event)
+                #Passes the VAD answered on its own say nothing about ASR speed
+                if getattr(self.online, "ran_asr", True):
+                    metrics.observe_stage("asr", elapsed)
+                    if self.quality is not None:
+                        self.quality.observe(len(a)/WHISPER_SAMPLING, elapsed)
+                    if self.scheduler is not None:
+                        self.scheduler.observe(self, len(a)/WHISPER_SAMPLING, elapsed)
+                tracer.span(self.trace_id, "asr", elapsed, audio=len(a)/WHISPER_SAMPLING, text=transcript[2])
                 self.processing = False
-                self.phrases.append(transcript[2])         
             except AssertionError as e:
+                self.processing = False
                 logger.error(f"assertion error: {e}")
-                pass
             else:
                 if transcript[0] is not None:
-                    #TODO Logic for using VAD for processing
                     self.phrases.append(transcript[2]) 
+                if getattr(self.online, "finalized", False):
+                    end_of_turn = time.time() - self.last_byte
+                    metrics.observe_stage("end_of_turn", end_of_turn)
+                    tracer.span(self.trace_id, "end_of_turn", end_of_turn, vad=True)
+                    await self.send_transcript("".join(self.phrases))
+                    return
+                #Committed text plus the hypothesis still waiting to be confirmed, used to judge the end of the turn
+                pending = self.online.to_flush(self.online.transcript_buffer.complete())[2]
+                self.endpointer.observe_text(self.turn, "".join(self.phrases) + pending, time.time())
+
+    async def send_partial(self):
+        text = self.turn.text
+        if text == self.speculated or phrase_filter.check(text) is not None:
+            return
+        self.speculated = text
+        tracer.event(self.trace_id, "partial", text=text)
+        await self.queue.put({"user" : self.user, "result" : text, "trace" : self.trace_id, "partial" : True})
 
     async def send_transcript(self, transcript : str):
+        trace_id = self.trace_id
+        #The last pass covers the audio still in the buffer, so its segments describe the end of the turn
+        segments = self.online.last_segments
         self.online.init()
         self.phrases = []
-        if transcript.strip() != "":
-            await self.queue.put({"user" : self.user, "result" : transcript})
+        self.speculated = None
+        self.trace_id = None
+        self.endpointer.end_turn(self.turn, time.time())
+        tracer.event(trace_id, "final", text=transcript)
+        if phrase_filter.is_valid(transcript, segments):
+            await self.queue.put({"user" : self.user, "result" : transcript, "trace" : trace_id})
         
     async def finish_transcript(self):
-        self.add_silence()
-        while True:
-            a = await self.recieve_audio_chunk()
-            if a is None:
-                break
+        #Transcribe the real audio left over, then take the unconfirmed hypothesis as the end of the turn
+        a = await self.recieve_audio_chunk(force=True)
+        if a is not None:
             await self.transcript_check(a)
         
         transcript = self.online.finish() 
@@ -135,11 +202,43 @@ class Speaker():
 class StreamSink(Sink):
 
     class SinkSettings:
-        def __init__(self, min_chunk = 1000, min_silence = 1000, data_length=25000, max_speakers=-1):   
+        def __init__(self, min_chunk = 1000, min_silence = 1000, data_length=25000, max_speakers=-1, queue_size=1000, overload_policy="drop_oldest", quality_ladder=STREAM_LADDER,
+                     target_latency = 1000, max_silence = 2500, partial_results = True, silence_gate = True, vac = False,
+                     adaptive_chunk = True, max_chunk = 4000, commit_latency = 2000, buffer_trimming = ("segment", 15)):   
             self.min_chunk = min_chunk
+            #Size each ASR chunk from the measured ASR speed and the number of speakers talking, in ms.
+            #min_chunk and max_chunk bound it. commit_latency does not size chunks: a chunk small enough to meet it but too small
+            #to keep up would only let audio pile up, so calls that put the delay before words are confirmed past it are counted as missed.
+            #See sinks/chunk_scheduler.py. With adaptive_chunk=False every chunk is min_chunk
+            self.adaptive_chunk = adaptive_chunk
+            self.max_chunk = max_chunk
+            self.commit_latency = commit_latency
+            #When to cut transcribed audio off the front of a speaker's buffer, every ASR call decodes the whole buffer again.
+            #("segment", s) cuts at whisper segment ends once the buffer is over s seconds,
+            #("sentence", s) at the end of the last complete sentence, which allows a much shorter buffer like ("sentence", 6)
+            self.buffer_trimming = buffer_trimming
+            #End of turn detection, all in ms. target_latency is the silence waited for on an ordinary turn,
+            #it is shortened for finished sentences and lengthened for trailing words, within min_silence and max_silence
             self.min_silence = min_silence
+            self.target_latency = target_latency
+            self.max_silence = max_silence
+            #Send the transcript so far when the end of the turn looks likely, so an answer can be started early
+            self.partial_results = partial_results
             self.data_length = data_length
             self.max_speakers = max_speakers
+            #Max audio packets (20ms each) waiting to be sorted, and what to shed when full:
+            #"drop_oldest", "reject" (drop newest) or "reject_new_speakers"
+            self.queue_size = queue_size
+            self.overload_policy = overload_policy
+            #Decoding settings to step through when ASR falls behind real time, see sinks/quality_ladder.py
+            #A single level pins the settings
+            self.quality_ladder = quality_ladder
+            #Drop audio that is clearly silence or background noise as it arrives, see sinks/silence_gate.py
+            self.silence_gate = silence_gate
+            #Run Silero VAD in front of whisper (needs a local model, see sinks/whisper_stream/silero_vad_engine.py).
+            #Whisper only gets voiced audio and a turn ends as soon as the VAD hears 500ms of non-speech.
+            #The VAD can only hear non-speech that arrives, so pair it with silence_gate=False
+            self.vac = vac
 
     def __init__(self, *, filters=None, sink_settings : SinkSettings, queue : asyncio.Queue, loop : asyncio.AbstractEventLoop):
         if filters is None:
@@ -154,9 +253,36 @@ class StreamSink(Sink):
         self.vc = None
 
         self.running = True  
-
-        self.voice_queue = Queue()
+        #Keeps the model loaded for as long as this sink is recording
+        self.audio_model = asr.registry_name()
+        models.acquire(self.audio_model)
+        models.prefetch(self.loop, self.audio_model)
+
+        self.voice_queue = voice_queue(self.sink_settings.queue_size, self.sink_settings.overload_policy)
+        self.silence_gate = SilenceGate() if self.sink_settings.silence_gate else None
+        self.gaps = GapTracker()
         self.speakers = []
+        self.rejected_speakers = metrics.counter("queue_shed_total", "Items dropped, merged or rejected by bounded queues", queue="voice", policy=REJECT_NEW_SPEAKERS)
+        metrics.gauge("live_speakers", "Speakers currently tracked by the sink", fn=lambda: len(self.speakers))
+
+        #Speakers with audio waiting for or inside ASR share the one model
+        self.quality = QualityController(self.sink_settings.quality_ladder, "stream",
+                                         pending_fn=lambda: sum(1 for s in self.speakers if s.processing or s.data))
+        self.quality.on_change(asr.set_quality)
+
+        self.scheduler = None
+        if self.sink_settings.adaptive_chunk:
+            self.scheduler = ChunkScheduler(min_chunk=self.sink_settings.min_chunk/1000,
+                                            max_chunk=self.sink_settings.max_chunk/1000,
+                                            target_latency=self.sink_settings.commit_latency/1000,
+                                            active_fn=lambda: [s for s in self.speakers if s.processing or s.data])
+
+        #One VAD for every speaker of this sink, chunks of all speakers are run in the same batch
+        self.vad = VADBatcher(self.loop, BatchedVAD()) if self.sink_settings.vac else None
+
+        self.endpointer = EndOfTurnDetector(target_latency=self.sink_settings.target_latency/1000,
+                                            min_silence=self.sink_settings.min_silence/1000,
+                                            max_silence=self.sink_settings.max_silence/1000)
         self.loop.create_task(self.insert_voice()) 
 
     async def insert_voice(self):
@@ -168,6 +294,7 @@ class StreamSink(Sink):
                 #Sorts data from queue for each speaker after each transcription             
                 while not self.voice_queue.empty():                  
                     item = await self.voice_queue.get()
+                    metrics.observe_stage("ingest", time.perf_counter() - item[2])
 
                     user_exists = False
                     for speaker in self.speakers:     
@@ -175,7 +302,7 @@ class StreamSink(Sink):
                             speaker.add_user(item[0])
                                        
                         if item[0] == speaker.user:
-                            speaker.add_data(item[1], current_time)                          
+                            speaker.add_data(item[1], item[3], item[4])                          
                             user_exists = True
                             break
 
@@ -184,20 +311,34 @@ class StreamSink(Sink):
                         if self.sink_settings.max_speakers < 0 or len(self.speakers) <= self.sink_settings.max_speakers:
                             self.speakers.append(Speaker(self.loop, 
                                                          self.queue,
-                                                         self.sink_settings.min_chunk))
+                                                         self.sink_settings.min_chunk,
+                                                         self.quality,
+                                                         self.endpointer,
+                                                         self.vad,
+                                                         self.scheduler,
+                                                         self.sink_settings.buffer_trimming))
                             self.speakers[-1].add_user(item[0])
-                            self.speakers[-1].add_data(item[1], current_time)
+                            self.speakers[-1].add_data(item[1], item[3], item[4])
             else:  
                 #Loops with no wait time is bad
                 await asyncio.sleep(.02)
 
             for speaker in self.speakers:
-                #finalize data if X seconds passes from last data packet from discord
-                if (current_time > speaker.last_byte + self.sink_settings.min_silence 
-                    and len(speaker.phrases)>0 
-                    and not speaker.processing):
+                #Discord only sends packets while the user's voice activity is on, so time since the last packet is silence
+                silence = current_time - speaker.last_byte
+                if ((speaker.turn.text or speaker.data)
+                    and not speaker.processing
+                    and self.endpointer.is_end_of_turn(speaker.turn, silence, current_time)):
                     
+                    trace_id = speaker.trace_id
                     await speaker.finish_transcript()
+                    end_of_turn = time.time() - speaker.last_byte
+                    metrics.observe_stage("end_of_turn", end_of_turn)
+                    tracer.span(trace_id, "end_of_turn", end_of_turn)
+                elif (self.sink_settings.partial_results
+                      and not speaker.processing
+                      and self.endpointer.is_likely_end(speaker.turn, silence, current_time)):
+                    await speaker.send_partial()
 
         for speaker in self.speakers:
             speaker.end()
@@ -205,14 +346,28 @@ class StreamSink(Sink):
     #Gets audio data from discord for each user talking
     @Filters.container
     def write(self, data, user):
+        #Timing is taken here rather than when the queue is read. py-cord's zero padding and audio dropped by the
+        #silence gate are never queued, they come back as the gap in front of the speaker's next packet
+        data, received, gap = stamp(self.gaps, self.silence_gate, user, data)
+        if not data:
+            return
+
         data_len = len(data)
         if data_len > self.sink_settings.data_length:
             data = data[-self.sink_settings.data_length+int(self.sink_settings.data_length/10):]
+
+        #While overloaded, only keep listening to people who are already being transcribed
+        if (self.sink_settings.overload_policy == REJECT_NEW_SPEAKERS
+            and self.voice_queue.overloaded
+            and not any(speaker.user == user for speaker in self.speakers)):
+            self.rejected_speakers.inc()
+            return
         
         #Send bytes to be transcribed
-        self.voice_queue.put_nowait([user, data])
+        self.voice_queue.put_nowait([user, data, time.perf_counter(), received, gap])
 
     #End thread
     def close(self):
         self.running = False
+        models.release(self.audio_model)
         self.queue.put_nowait(None)
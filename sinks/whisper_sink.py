@@ -7,50 +7,32 @@ import time
 import re
 import wave
 import asyncio
+import logging
 
 # 3rd party libraries
 from discord.sinks.core import Filters, Sink, default_filters
 import torch  # Had issues where removing torch causes whisper to throw an error
-from faster_whisper import WhisperModel  # TODO Perhaps have option for default whisper
 import speech_recognition as sr  # TODO Replace with something simpler
 
-# Outside of class so it doesn't load everytime the bot joins a discord call
+from modules.metrics import metrics
+from modules.models import models, whisper_model
+from modules.queues import voice_queue, REJECT_NEW_SPEAKERS
+from modules.tracing import tracer
+from sinks.quality_ladder import QualityController, WHISPER_LADDER
+from sinks.phrase_filter import phrase_filter
+from sinks.silence_gate import SilenceGate
+from sinks.packet_timing import GapTracker, MAX_GAP_FILL, gap_fill, stamp
+
+logger = logging.getLogger(__name__)
+
 # Models are: "base.en" "small.en" "medium.en" "large-v2"
-audio_model = WhisperModel("medium.en", device="cuda", compute_type="float16")
-
-excluded_phrases = [
-    "",
-    "thanks",
-    "tch",
-    "thank you so much thank you",
-    "for more information on covid-19 vaccines visit our website",
-    "thank you very much",
-    "thank you very much.",
-    "we'll be right back.",
-    "subs by www.zeoranger.co.uk",
-    "hello everyone",
-    "thank you bye",
-    "thank you",
-    "all right",
-    "thank you thank you",
-    "thank you for watching",
-    "thanks for watching",
-    "i'll see you next time",
-    "got to cancel",
-    "shh",
-    "wow",
-    "shhh",
-    "hello",
-    "you",
-    "the",
-    "yeah",
-    "but",
-    "heh heh",
-    "heh",
-    "bye",
-    "okay",
-    "silence",
-]
+# Shared through modules.models with the stream sink, loaded on the first transcription and unloaded when idle
+AUDIO_MODEL_SIZE = "medium.en"
+
+
+def get_audio_model(size):
+    # Smaller models asked for by the quality ladder are registered and loaded the first time they are needed
+    return models.get(whisper_model(size))
 
 
 # Class for storing info for each speaker in discord
@@ -60,6 +42,9 @@ class Speaker:
 
         self.data = [data]
 
+        # Correlation id that follows this utterance from the first packet to playback
+        self.trace_id = tracer.new_trace(user)
+
         self.start_time = time.time()
         self.last_word = self.start_time
 
@@ -86,6 +71,10 @@ class WhisperSink(Sink):
     max_phrase_timeout - Send out the current transcription after x seconds if the user continues to talk for a long period\n
     min_phrase_length - Minimum length of transcription to reduce noise\n
     max_speakers - The amount of users to transcribe when all speakers are talking at once.\n
+    queue_size - Max audio packets waiting to be sorted across all speakers, older audio is shed when transcription falls behind\n
+    overload_policy - What to shed when the queue is full: "drop_oldest", "reject" (newest packet) or "reject_new_speakers"\n
+    quality_ladder - Decoding settings to step down through when transcription falls behind real time, see sinks/quality_ladder.py\n
+    silence_gate - Drop audio that is clearly silence or background noise as it arrives, see sinks/silence_gate.py\n
     """
 
     class SinkSettings:
@@ -96,7 +85,11 @@ class WhisperSink(Sink):
                     no_data_multiplier=0.75,
                     max_phrase_timeout=30,
                     min_phrase_length=3,
-                    max_speakers=-1
+                    max_speakers=-1,
+                    queue_size=1000,
+                    overload_policy="drop_oldest",
+                    quality_ladder=WHISPER_LADDER,
+                    silence_gate=True,
                     ):          
 
             self.data_length = data_length
@@ -106,6 +99,10 @@ class WhisperSink(Sink):
             self.max_phrase_timeout = max_phrase_timeout
             self.min_phrase_length = min_phrase_length
             self.max_speakers = max_speakers
+            self.queue_size = queue_size
+            self.overload_policy = overload_policy
+            self.quality_ladder = quality_ladder
+            self.silence_gate = silence_gate
 
     def __init__(self, *, filters=None, sink_settings : SinkSettings, queue : asyncio.Queue, loop : asyncio.AbstractEventLoop):
         if filters is None:
@@ -126,21 +123,38 @@ class WhisperSink(Sink):
 
         self.temp_file = NamedTemporaryFile().name
 
-        self.voice_queue = Queue()
+        # Keeps the model loaded for as long as this sink is recording
+        self.audio_model = whisper_model(AUDIO_MODEL_SIZE)
+        models.acquire(self.audio_model)
+        models.prefetch(self.loop, self.audio_model)
+
+        self.voice_queue = voice_queue(self.sink_settings.queue_size, self.sink_settings.overload_policy, thread=True)
+        self.silence_gate = SilenceGate() if self.sink_settings.silence_gate else None
+        self.gaps = GapTracker()
+        self.rejected_speakers = metrics.counter("queue_shed_total", "Items dropped, merged or rejected by bounded queues", queue="voice", policy=REJECT_NEW_SPEAKERS)
+        metrics.gauge("live_speakers", "Speakers currently tracked by the sink", fn=lambda: len(self.speakers))
+
+        # Speakers with new audio are transcribed one after another on this sink's thread
+        self.quality = QualityController(
+            self.sink_settings.quality_ladder,
+            "whisper",
+            pending_fn=lambda: sum(1 for speaker in self.speakers if speaker.new_bytes > 0),
+        )
+
         self.voice_thread = threading.Thread(target=self.insert_voice, args=())
         self.voice_thread.start()
 
-    def is_valid_phrase(self, speaker_phrase, result):
-        cleaned_result = re.sub(r"[.!?,]", "", result).lower().strip()
-        return speaker_phrase != result and cleaned_result not in excluded_phrases
+    def is_valid_phrase(self, speaker_phrase, result, segments=None):
+        return speaker_phrase != result and phrase_filter.is_valid(result, segments)
 
-    def transcribe_audio(self, temp_file):
+    def transcribe_audio(self, temp_file, trace_id=None):
         # The whisper model
-        start_time = time.time()
-        segments, info = audio_model.transcribe(
+        start_time = time.perf_counter()
+        quality = self.quality.settings
+        segments, info = get_audio_model(quality.get("model", AUDIO_MODEL_SIZE)).transcribe(
             temp_file,
-            beam_size=10,
-            best_of=3,
+            beam_size=quality.get("beam_size", 10),
+            best_of=quality.get("best_of", 3),
             vad_filter=True,
             vad_parameters=dict(min_silence_duration_ms=250 ),
             no_speech_threshold = 0.6,
@@ -150,13 +164,17 @@ class WhisperSink(Sink):
         result = ""
         for segment in segments:
             result += segment.text
-        print(f"Transcribe: {time.time() - start_time}")
-        print(result)
-        return result
+        elapsed = time.perf_counter() - start_time
+        metrics.observe_stage("asr", elapsed)
+        self.quality.observe(info.duration, elapsed)
+        tracer.span(trace_id, "asr", elapsed, audio=info.duration, text=result)
+        logger.debug(f"Transcribe: {elapsed} {result}")
+        return result, segments
 
     # Get SST from whisper and store result into speaker
     def transcribe(self, speaker: Speaker):
         # TODO Figure out the best way to save the audio fast and remove any noise
+        start_time = time.perf_counter()
         audio_data = sr.AudioData(
             bytes().join(speaker.data),
             self.vc.decoder.SAMPLING_RATE,
@@ -173,12 +191,15 @@ class WhisperSink(Sink):
             wave_writer.setframerate(self.vc.decoder.SAMPLING_RATE)
             wave_writer.writeframes(wav_data.getvalue())
             wave_writer.close()
+        elapsed = time.perf_counter() - start_time
+        metrics.observe_stage("resample", elapsed)
+        tracer.span(speaker.trace_id, "resample", elapsed)
 
         # Transcribe results takes wav file (self.temp_file) and outputs transcription
-        transcription = self.transcribe_audio(self.temp_file)
+        transcription, segments = self.transcribe_audio(self.temp_file, speaker.trace_id)
 
         # Checks if user is saying a new valid phrase
-        if self.is_valid_phrase(speaker.phrase, transcription):
+        if self.is_valid_phrase(speaker.phrase, transcription, segments):
             speaker.empty_bytes_counter = 0
 
             speaker.word_timeout = self.sink_settings.quiet_phrase_timeout
@@ -206,10 +227,15 @@ class WhisperSink(Sink):
                 # Sorts data from queue for each speaker after each transcription
                 while not self.voice_queue.empty():
                     item = self.voice_queue.get()
+                    metrics.observe_stage("ingest", time.perf_counter() - item[2])
 
                     user_heard = False
                     for speaker in self.speakers:
                         if item[0] == speaker.user:
+                            # Real pauses inside the phrase are put back, cut short
+                            if item[4] > 0:
+                                speaker.data.append(gap_fill(item[4], MAX_GAP_FILL))
+                                speaker.new_bytes += 1
                             speaker.data.append(item[1])
                             user_heard = True
                             speaker.new_bytes += 1
@@ -240,8 +266,11 @@ class WhisperSink(Sink):
                     part1 = current_time - speaker.last_word > word_timeout
                     part2 = current_time - speaker.start_time > self.sink_settings.max_phrase_timeout
                     if (part1 or part2):
-                        print(f"Stop talking: {part1}. Too long: {part2}")
-                        self.loop.call_soon_threadsafe(self.queue.put_nowait, {"user": speaker.user, "result": speaker.phrase})
+                        logger.debug(f"Stop talking: {part1}. Too long: {part2}")
+                        metrics.observe_stage("end_of_turn", current_time - speaker.last_word)
+                        tracer.span(speaker.trace_id, "end_of_turn", current_time - speaker.last_word)
+                        tracer.event(speaker.trace_id, "final", text=speaker.phrase)
+                        self.loop.call_soon_threadsafe(self.queue.put_nowait, {"user": speaker.user, "result": speaker.phrase, "trace": speaker.trace_id})
 
                         self.speakers.remove(speaker)
                 elif current_time > self.sink_settings.quiet_phrase_timeout * 2:
@@ -255,16 +284,29 @@ class WhisperSink(Sink):
     @Filters.container
     def write(self, data, user):
         # Discord will send empty bytes from when the user stopped talking to when the user starts to talk again.
-        # Its only the first the first data that grows massive and its only silent audio, so its trimmed.
+        # Those zeros and audio dropped by the silence gate are taken off here and come back as the gap in front of the next packet.
+        data, received, gap = stamp(self.gaps, self.silence_gate, user, data)
+        if not data:
+            return
 
         data_len = len(data)
         if data_len > self.sink_settings.data_length:
             data = data[-self.sink_settings.data_length :]
 
+        # While overloaded, only keep listening to people who are already being transcribed
+        if (
+            self.sink_settings.overload_policy == REJECT_NEW_SPEAKERS
+            and self.voice_queue.overloaded
+            and not any(speaker.user == user for speaker in self.speakers)
+        ):
+            self.rejected_speakers.inc()
+            return
+
         # Send bytes to be transcribed
-        self.voice_queue.put([user, data])
+        self.voice_queue.put([user, data, time.perf_counter(), received, gap])
 
     # End thread
     def close(self):
         self.running = False
+        models.release(self.audio_model)
         self.queue.put_nowait(None)
@@ -0,0 +1,64 @@
+import numpy as np
+
+# Growable float32 audio buffer for the online processors.
+# np.append copies the whole buffer on every chunk and slicing the head off on every trim makes a new
+# array. Here audio is appended into spare capacity at the end, trimming only moves the start offset,
+# and the array is compacted or doubled only when it runs out of room, so both are amortized O(1).
+
+
+class AudioBuffer:
+    """Audio samples in a preallocated array, the live samples are data[start:end].
+
+    view() is a contiguous, zero copy view of the live samples. It stays valid until the next append,
+    which may move the samples, so take a new view after appending.
+    """
+
+    def __init__(self, capacity=16000):
+        self.data = np.empty(max(int(capacity), 1), dtype=np.float32)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def view(self):
+        return self.data[self.start:self.end]
+
+    def append(self, audio):
+        audio = np.asarray(audio, dtype=np.float32).ravel()
+        n = len(audio)
+        if self.end + n > len(self.data):
+            self.make_room(n)
+        self.data[self.end:self.end + n] = audio
+        self.end += n
+
+    def make_room(self, n):
+        size = len(self)
+        needed = size + n
+        if needed <= len(self.data) and self.start >= size:
+            # at least half of the used part was trimmed away, the move costs no more than what was trimmed
+            self.data[:size] = self.data[self.start:self.end]
+        else:
+            capacity = len(self.data)
+            while capacity < needed:
+                capacity *= 2
+            data = np.empty(capacity, dtype=np.float32)
+            data[:size] = self.data[self.start:self.end]
+            self.data = data
+        self.start = 0
+        self.end = size
+
+    def trim(self, n):
+        """Drops the first n samples."""
+        self.start = min(self.start + max(int(n), 0), self.end)
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def keep_last(self, n):
+        """Drops all but the last n samples, returns how many were dropped."""
+        dropped = max(len(self) - n, 0)
+        self.trim(dropped)
+        return dropped
+
+    def clear(self):
+        self.start = self.end = 0
@@ -0,0 +1,57 @@
+import re
+
+from modules.generation import SENTENCE_END
+
+# Sentence splitter for OnlineASRProcessor's "sentence" buffer trimming, no dependencies.
+# It has the split() method of MosesTokenizer that words_to_sentences uses, and returns the sentences
+# with their words unchanged so they can be matched back to the timestamped words.
+
+# Lowercase, without the final dot. A dot after these does not end a sentence.
+ABBREVIATIONS = frozenset((
+    "mr", "mrs", "ms", "dr", "prof", "st", "jr", "sr", "vs", "mt", "no", "fig", "approx", "dept", "est",
+    "e.g", "i.e", "a.m", "p.m", "u.s", "u.k", "inc", "ltd", "co", "jan", "feb", "mar", "apr", "jun", "jul",
+    "aug", "sep", "sept", "oct", "nov", "dec",
+))
+
+# Only the end of the text before the dot is searched, abbreviations are short
+PREVIOUS_WORD = re.compile(r"([\w.]+)$")
+LOOKBEHIND = 16
+NEXT_CHARACTER = re.compile(r"\s*(\S)")
+
+
+class SentenceSplitter:
+    """Splits text at . ! and ? followed by a space or the end of the text.
+
+    A dot is not a sentence end after a known abbreviation or a single letter initial, and no sentence
+    end is taken when the next word starts lowercase, so "Dr. Smith", "J. R. R." and "e.g. this" stay
+    in one sentence.
+    """
+
+    def __init__(self, abbreviations=ABBREVIATIONS):
+        self.abbreviations = abbreviations
+
+    def is_end(self, text, match):
+        dot = match.start()
+        if text[dot] == ".":
+            word = PREVIOUS_WORD.search(text[max(dot - LOOKBEHIND, 0):dot])
+            if word is not None:
+                word = word.group(1).lower()
+                if word in self.abbreviations or (len(word) == 1 and word.isalpha()):
+                    return False
+        following = NEXT_CHARACTER.match(text, match.end())
+        return following is None or not following.group(1).islower()
+
+    def split(self, text):
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(text):
+            if not self.is_end(text, match):
+                continue
+            sentence = text[start:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        rest = text[start:].strip()
+        if rest:
+            sentences.append(rest)
+        return sentences
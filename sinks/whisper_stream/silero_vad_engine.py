@@ -0,0 +1,350 @@
+import os
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from modules.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Batched, offline replacement for FixedVADIterator.
+# The model is loaded from a local file (no torch.hub, no network): silero_vad.onnx through ONNX Runtime,
+# or silero_vad.jit through TorchScript, both on CPU. Silero is a recurrent model, so the windows of one
+# stream have to be run in order, but the windows of different streams (speakers) are stacked into one
+# batch and run in a single model call. The start/end events are the ones VADIterator produces.
+
+SILERO_VAD_MODEL = os.environ.get("SILERO_VAD_MODEL", None)
+
+
+def default_model_path():
+    """SILERO_VAD_MODEL, else the model files shipped with the silero-vad pip package."""
+    if SILERO_VAD_MODEL is not None:
+        return SILERO_VAD_MODEL
+    try:
+        import silero_vad
+    except ImportError:
+        raise FileNotFoundError("Set SILERO_VAD_MODEL to a local silero_vad.onnx or silero_vad.jit, or pip install silero-vad")
+    data = os.path.join(os.path.dirname(silero_vad.__file__), "data")
+    for name in ("silero_vad.onnx", "silero_vad.jit"):
+        path = os.path.join(data, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No silero model found in {data}")
+
+
+class OnnxSilero:
+    """silero_vad.onnx, which takes its recurrent state as an input, so any batch of streams can be run."""
+
+    def __init__(self, path, threads=1):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, x, state, sampling_rate):
+        """x: (batch, context + window) float32, state: (2, batch, 128). Returns speech probabilities and the new state."""
+        out, state = self.session.run(None, {"input": x, "state": state, "sr": np.array(sampling_rate, dtype=np.int64)})
+        return out[:, 0], state
+
+
+# Private attributes silero v5's TorchScript model keeps its recurrent state in
+JIT_STATE_ATTRIBUTES = ("_state", "_context", "_last_sr", "_last_batch_size")
+
+
+class TorchSilero:
+    """silero_vad.jit. The TorchScript model keeps its state and context as attributes, they are swapped in for every batch.
+
+    Those attributes are private to silero v5's model. When the loaded model does not have them, batched
+    is False and every stream runs its own copy of the model, one window at a time.
+    threads calls torch.set_num_threads, which changes the thread count of the whole process, torch LLMs
+    included, so it is left alone unless given.
+    """
+
+    def __init__(self, path, threads=None):
+        import torch
+        self.torch = torch
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.path = path
+        self.model = self.load()
+        self.model.reset_states()
+        self.batched = all(hasattr(self.model, name) for name in JIT_STATE_ATTRIBUTES)
+        if not self.batched:
+            logger.warning(f"{path} does not keep its state in {', '.join(JIT_STATE_ATTRIBUTES)} (silero v5), running one model per stream")
+
+    def load(self):
+        model = self.torch.jit.load(self.path, map_location="cpu")
+        model.eval()
+        return model
+
+    def stream_model(self):
+        return self.load()
+
+    def run_stream(self, model, window, sampling_rate):
+        """One window through a stream's own model, which keeps that stream's state itself."""
+        with self.torch.inference_mode():
+            return model(self.torch.from_numpy(window).unsqueeze(0), sampling_rate).item()
+
+    def __call__(self, x, state, sampling_rate):
+        torch = self.torch
+        context_size = 64 if sampling_rate == 16000 else 32
+        with torch.inference_mode():
+            x = torch.from_numpy(x)
+            self.model._state = torch.from_numpy(state)
+            self.model._context = x[:, :context_size]
+            self.model._last_sr = sampling_rate
+            self.model._last_batch_size = x.shape[0]
+            out = self.model(x[:, context_size:], sampling_rate)
+            # one copy back to numpy per batch instead of an .item() sync per window
+            return out[:, 0].numpy(), self.model._state.numpy()
+
+
+def load_silero(path=None, threads=1, torch_threads=None):
+    """threads is ONNX Runtime's per session thread count. torch_threads is process wide, see TorchSilero."""
+    path = path or default_model_path()
+    if path.endswith(".onnx"):
+        return OnnxSilero(path, threads)
+    return TorchSilero(path, torch_threads)
+
+
+class RingBuffer:
+    """Fixed size float32 buffer, audio is written in and read out in windows without reallocating."""
+
+    def __init__(self, capacity):
+        self.data = np.zeros(capacity, dtype=np.float32)
+        self.start = 0
+        self.size = 0
+
+    def write(self, audio):
+        audio = np.asarray(audio, dtype=np.float32)
+        capacity = len(self.data)
+        if self.size + len(audio) > capacity:
+            raise OverflowError("VAD ring buffer is full, process() is not keeping up")
+        end = (self.start + self.size) % capacity
+        first = min(len(audio), capacity - end)
+        self.data[end:end + first] = audio[:first]
+        self.data[:len(audio) - first] = audio[first:]
+        self.size += len(audio)
+
+    def read(self, n, out):
+        capacity = len(self.data)
+        first = min(n, capacity - self.start)
+        out[:first] = self.data[self.start:self.start + first]
+        out[first:n] = self.data[:n - first]
+        self.start = (self.start + n) % capacity
+        self.size -= n
+
+
+class VADStream:
+    """Per stream audio, recurrent state and VADIterator's trigger logic."""
+
+    def __init__(self, engine, model=None):
+        # Only for models that can not be batched, see TorchSilero
+        self.model = model
+        if model is None and not getattr(engine.model, "batched", True):
+            self.model = engine.model.stream_model()
+        self.buffer = RingBuffer(engine.buffer_samples)
+        self.state = np.zeros((2, 1, 128), dtype=np.float32)
+        self.context = np.zeros(engine.context_size, dtype=np.float32)
+        self.triggered = False
+        self.temp_end = 0
+        self.current_sample = 0
+
+    def step(self, engine, speech_prob, return_seconds):
+        # Same decisions as VADIterator.__call__
+        self.current_sample += engine.window_size
+        if speech_prob >= engine.threshold and self.temp_end:
+            self.temp_end = 0
+
+        if speech_prob >= engine.threshold and not self.triggered:
+            self.triggered = True
+            speech_start = self.current_sample - engine.speech_pad_samples
+            return {'start': int(speech_start) if not return_seconds else round(speech_start / engine.sampling_rate, 1)}
+
+        if speech_prob < engine.threshold - 0.15 and self.triggered:
+            if not self.temp_end:
+                self.temp_end = self.current_sample
+            if self.current_sample - self.temp_end < engine.min_silence_samples:
+                return None
+            speech_end = self.temp_end + engine.speech_pad_samples
+            self.temp_end = 0
+            self.triggered = False
+            return {'end': int(speech_end) if not return_seconds else round(speech_end / engine.sampling_rate, 1)}
+        return None
+
+
+def merge_event(ret, r):
+    # How FixedVADIterator folds the events of several windows into the one it returns
+    if ret is None:
+        return r
+    if r is not None:
+        if 'end' in r:
+            ret['end'] = r['end']
+        if 'start' in r and 'end' in ret:
+            del ret['end']
+    return ret
+
+
+class BatchedVAD:
+    """Silero VAD for many streams at once.
+
+    feed(key, audio) adds audio to a stream's ring buffer. process() runs every complete window of every
+    stream: the k-th pending window of all streams that have one goes into the same model call. It returns
+    {key: event} with the events merged the way FixedVADIterator merges them for one call.
+    model is a path to the model file, or anything called like OnnxSilero. Thread safe. reset() and
+    remove() never wait for a running batch, they are queued and applied before the next feed or process.
+    """
+
+    def __init__(self, model=None, threshold=0.5, sampling_rate=16000, min_silence_duration_ms=500, speech_pad_ms=100,
+                 buffer_seconds=30, threads=1, torch_threads=None):
+        if sampling_rate not in [8000, 16000]:
+            raise ValueError('BatchedVAD does not support sampling rates other than [8000, 16000]')
+        self.model = model if model is not None and not isinstance(model, str) else load_silero(model, threads, torch_threads)
+        self.threshold = threshold
+        self.sampling_rate = sampling_rate
+        self.window_size = 512 if sampling_rate == 16000 else 256
+        self.context_size = 64 if sampling_rate == 16000 else 32
+        self.min_silence_samples = sampling_rate * min_silence_duration_ms / 1000
+        self.speech_pad_samples = sampling_rate * speech_pad_ms / 1000
+        self.buffer_samples = int(buffer_seconds * sampling_rate)
+        self.streams = {}
+        self.lock = threading.Lock()
+        # (reset, key) waiting for the lock, appended from any thread
+        self.changes = deque()
+
+    def reset(self, key):
+        self.changes.append((True, key))
+
+    def remove(self, key):
+        self.changes.append((False, key))
+
+    def _apply_changes(self):
+        while self.changes:
+            reset, key = self.changes.popleft()
+            if not reset:
+                self.streams.pop(key, None)
+                continue
+            # A stream's own model is kept, loading it again for every utterance would be slow
+            model = getattr(self.streams.get(key), "model", None)
+            if model is not None:
+                model.reset_states()
+            self.streams[key] = VADStream(self, model)
+
+    def feed(self, key, audio):
+        with self.lock:
+            self._apply_changes()
+            stream = self.streams.get(key)
+            if stream is None:
+                stream = self.streams[key] = VADStream(self)
+            stream.buffer.write(audio)
+
+    def process(self, keys=None, return_seconds=False):
+        with self.lock:
+            self._apply_changes()
+            return self._process(keys, return_seconds)
+
+    def _process(self, keys, return_seconds):
+        keys = list(self.streams) if keys is None else keys
+        events = {key: None for key in keys}
+        pending = [(key, self.streams[key]) for key in keys if key in self.streams]
+        width = self.context_size + self.window_size
+        while True:
+            ready = [(key, stream) for key, stream in pending if stream.buffer.size >= self.window_size]
+            if not ready:
+                return events
+            x = np.empty((len(ready), width), dtype=np.float32)
+            state = np.empty((2, len(ready), 128), dtype=np.float32)
+            for i, (key, stream) in enumerate(ready):
+                x[i, :self.context_size] = stream.context
+                stream.buffer.read(self.window_size, x[i, self.context_size:])
+                state[:, i] = stream.state[:, 0]
+
+            if getattr(self.model, "batched", True):
+                probs, state = self.model(x, state, self.sampling_rate)
+            else:
+                probs = [self.model.run_stream(stream.model, x[i, self.context_size:], self.sampling_rate) for i, (_, stream) in enumerate(ready)]
+
+            for i, (key, stream) in enumerate(ready):
+                stream.state[:, 0] = state[:, i]
+                stream.context[:] = x[i, -self.context_size:]
+                events[key] = merge_event(events[key], stream.step(self, float(probs[i]), return_seconds))
+            for key in events:
+                if events[key] == {}:
+                    events[key] = None
+
+
+class BatchedVADIterator:
+    """Drop in for FixedVADIterator backed by a (possibly shared) BatchedVAD, one instance per stream.
+
+    Called on its own it runs just this stream. Callers with many streams can feed them all and call
+    engine.process() once instead.
+    """
+
+    def __init__(self, engine : BatchedVAD, key=None):
+        self.engine = engine
+        self.key = key if key is not None else id(self)
+        self.reset_states()
+
+    def reset_states(self):
+        self.engine.reset(self.key)
+
+    def __call__(self, x, return_seconds=False):
+        self.engine.feed(self.key, x)
+        return self.engine.process([self.key], return_seconds)[self.key]
+
+
+class VADBatcher:
+    """Runs a shared BatchedVAD for streams that each await their own chunk on an asyncio loop.
+
+    detect(key, audio) returns the event for that chunk. Chunks of all streams that come in while the
+    previous batch is running (or in the same loop iteration) are fed and processed together in one
+    engine.process() call, in the executor so the event loop never runs the model or waits on its lock.
+    """
+
+    def __init__(self, loop, engine : BatchedVAD):
+        self.loop = loop
+        self.engine = engine
+        # key -> (audio, future) waiting for the next batch
+        self.waiting = {}
+        self.running = False
+        self.batch_streams = metrics.histogram("vad_batch_streams", "Streams run together in one VAD batch")
+
+    async def detect(self, key, audio):
+        future = self.loop.create_future()
+        self.waiting[key] = (audio, future)
+        if not self.running:
+            self.running = True
+            self.loop.create_task(self.run())
+        return await future
+
+    def process(self, batch):
+        for key, (audio, _) in batch.items():
+            self.engine.feed(key, audio)
+        return self.engine.process(list(batch))
+
+    async def run(self):
+        try:
+            while self.waiting:
+                # lets the other streams whose chunk is ready in this iteration join the batch
+                await asyncio.sleep(0)
+                batch, self.waiting = self.waiting, {}
+                start_time = time.perf_counter()
+                try:
+                    events = await self.loop.run_in_executor(None, self.process, batch)
+                except Exception as e:
+                    for _, future in batch.values():
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                metrics.observe_stage("vad", time.perf_counter() - start_time)
+                self.batch_streams.observe(len(batch))
+                for key, (_, future) in batch.items():
+                    if not future.done():
+                        future.set_result(events.get(key))
+        finally:
+            self.running = False
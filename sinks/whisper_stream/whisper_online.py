@@ -7,6 +7,13 @@ import io
 import soundfile as sf
 import librosa
 import math
+import time
+from collections import deque
+
+from modules.metrics import metrics
+from modules.models import models, whisper_model
+from sinks.whisper_stream.audio_buffer import AudioBuffer
+from sinks.whisper_stream.sentence_splitter import SentenceSplitter
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +52,6 @@ class FasterWhisperASR(ASRBase):
     sep = ""
 
     def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
-        from faster_whisper import WhisperModel
         if model_dir is not None:
             logger.debug(f"Loading whisper model from model_dir {model_dir}. modelsize and cache_dir parameters are not used.")
             model_size_or_path = model_dir
@@ -54,14 +60,29 @@ class FasterWhisperASR(ASRBase):
         else:
             raise ValueError("modelsize or model_dir parameter must be set")
 
-        model = WhisperModel(model_size_or_path, device="cuda", compute_type="float16", download_root=cache_dir)
+        # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
+        self.decode_kargs = {"beam_size": 5}
+        self.cache_dir = cache_dir
+        self.default_model = model_size_or_path
+        self.model_name = model_size_or_path
 
-        return model
+        # the model itself lives in the shared registry, it is loaded on the first transcribe call and unloaded when idle
+        return None
 
-    def transcribe(self, audio, init_prompt=""):
+    def registry_name(self, model_name=None):
+        return whisper_model(model_name or self.default_model, self.cache_dir)
 
-        # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
-        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=5, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
+    def set_quality(self, settings):
+        """Applies a level of sinks.quality_ladder. A different model size is loaded on the next transcribe call,
+        so the caller (usually the event loop) is not blocked by the load."""
+        self.decode_kargs = {k: settings[k] for k in ("beam_size", "best_of") if k in settings}
+        self.model_name = settings.get("model", self.default_model)
+
+    def current_model(self):
+        return models.get(self.registry_name(self.model_name))
+
+    def transcribe(self, audio, init_prompt=""):
+        segments, info = self.current_model().transcribe(audio, language=self.original_language, initial_prompt=init_prompt, word_timestamps=True, condition_on_previous_text=True, **self.decode_kargs, **self.transcribe_kargs)
         #print(info)  # info contains language detection result
 
         return list(segments)
@@ -175,10 +196,11 @@ class OpenaiApiASR(ASRBase):
 
 class HypothesisBuffer:
 
+    # deques, words are only ever taken from the front and added at the back
     def __init__(self, logfile=sys.stderr):
-        self.commited_in_buffer = []
-        self.buffer = []
-        self.new = []
+        self.commited_in_buffer = deque()
+        self.buffer = deque()
+        self.new = deque()
 
         self.last_commited_time = 0
         self.last_commited_word = None
@@ -190,7 +212,7 @@ class HypothesisBuffer:
         # the new tail is added to self.new
         
         new = [(a+offset,b+offset,t) for a,b,t in new]
-        self.new = [(a,b,t) for a,b,t in new if a > self.last_commited_time-0.1]
+        self.new = deque((a,b,t) for a,b,t in new if a > self.last_commited_time-0.1)
 
         if len(self.new) >= 1:
             a,b,t = self.new[0]
@@ -205,7 +227,7 @@ class HypothesisBuffer:
                         if c == tail:
                             words = []
                             for j in range(i):
-                                words.append(repr(self.new.pop(0)))
+                                words.append(repr(self.new.popleft()))
                             words_msg = " ".join(words)
                             logger.debug(f"removing last {i} words: {words_msg}")
                             break
@@ -224,18 +246,18 @@ class HypothesisBuffer:
                 commit.append((na,nb,nt))
                 self.last_commited_word = nt
                 self.last_commited_time = nb
-                self.buffer.pop(0)
-                self.new.pop(0)
+                self.buffer.popleft()
+                self.new.popleft()
             else:
                 break
         self.buffer = self.new
-        self.new = []
+        self.new = deque()
         self.commited_in_buffer.extend(commit)
         return commit
 
     def pop_commited(self, time):
         while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
-            self.commited_in_buffer.pop(0)
+            self.commited_in_buffer.popleft()
 
     def complete(self):
         return self.buffer
@@ -246,7 +268,7 @@ class OnlineASRProcessor:
 
     def __init__(self, asr, tokenizer=None, buffer_trimming=("segment", 15), logfile=sys.stderr):
         """asr: WhisperASR object
-        tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer. It can be None, if "segment" buffer trimming option is used, then tokenizer is not used at all.
+        tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer. It can be None, if "segment" buffer trimming option is used, then tokenizer is not used at all. With "sentence" and no tokenizer the built-in SentenceSplitter is used.
         ("segment", 15)
         buffer_trimming: a pair of (option, seconds), where option is either "sentence" or "segment", and seconds is a number. Buffer is trimmed if it is longer than "seconds" threshold. Default is the most recommended option.
         logfile: where to store the log. 
@@ -255,48 +277,57 @@ class OnlineASRProcessor:
         self.tokenizer = tokenizer
         self.logfile = logfile
 
+        # reused across init() calls, it grows to the longest buffer the trimming lets through
+        self.audio = AudioBuffer(self.SAMPLING_RATE*buffer_trimming[1])
         self.init()
 
         self.buffer_trimming_way, self.buffer_trimming_sec = buffer_trimming
+        if self.tokenizer is None and self.buffer_trimming_way == "sentence":
+            self.tokenizer = SentenceSplitter()
 
     def init(self, offset=None):
         """run this when starting or restarting processing"""
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio.clear()
         self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
         self.buffer_time_offset = 0
         if offset is not None:
             self.buffer_time_offset = offset
         self.transcript_buffer.last_commited_time = self.buffer_time_offset
-        self.commited = []
+        # commited words inside the audio buffer. The last commited word always stays here.
+        self.commited = deque()
+        # the scrolled away commited words the prompt is made of, only as many as the 200 characters need
+        self.prompt_words = deque()
+        self.prompt_chars = 0
+        # segments of the last transcription, for confidence checks on the result
+        self.last_segments = []
+
+    @property
+    def audio_buffer(self):
+        # zero copy view of the buffered audio
+        return self.audio.view()
 
     def insert_audio_chunk(self, audio):
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self.audio.append(audio)
 
     def prompt(self):
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer. 
         "context" is the commited text that is inside the audio buffer. It is transcribed again and skipped. It is returned only for debugging and logging reasons.
         """
-        k = max(0,len(self.commited)-1)
-        while k > 0 and self.commited[k-1][1] > self.buffer_time_offset:
-            k -= 1
-
-        p = self.commited[:k]
-        p = [t for _,_,t in p]
-        prompt = []
-        l = 0
-        while p and l < 200:  # 200 characters prompt size
-            x = p.pop(-1)
-            l += len(x)+1
-            prompt.append(x)
-        non_prompt = self.commited[k:]
-        return self.asr.sep.join(prompt[::-1]), self.asr.sep.join(t for _,_,t in non_prompt)
+        return self.asr.sep.join(t for _,_,t in self.prompt_words), self.asr.sep.join(t for _,_,t in self.commited)
+
+    def scroll_commited(self):
+        """Moves the commited words that are no longer in the audio buffer to the prompt window, and drops
+        the ones the 200-character prompt does not reach any more. Run when words are commited or the buffer is trimmed.
+        """
+        while len(self.commited) > 1 and self.commited[0][1] <= self.buffer_time_offset:
+            word = self.commited.popleft()
+            self.prompt_words.append(word)
+            self.prompt_chars += len(word[2])+1
+            while self.prompt_chars - len(self.prompt_words[0][2])-1 >= 200:  # 200 characters prompt size
+                self.prompt_chars -= len(self.prompt_words.popleft()[2])+1
     
     def validate_audio_buffer(self, buffer):
-        print(f"Audio buffer type: {type(buffer)}")
-        print(f"Audio buffer dtype: {buffer.dtype}")
-        print(f"Audio buffer size: {buffer.size}")
-        print(f"Audio buffer max value: {np.max(buffer)}")
-        print(f"Audio buffer min value: {np.min(buffer)}")
+        logger.debug(f"Audio buffer type: {type(buffer)} dtype: {buffer.dtype} size: {buffer.size} max: {np.max(buffer)} min: {np.min(buffer)}")
         if not isinstance(buffer, np.ndarray):
             raise TypeError(f"Audio buffer must be a numpy array, got {type(buffer)}")
         if buffer.dtype not in [np.float32, np.float64]:
@@ -304,9 +335,9 @@ class OnlineASRProcessor:
         if np.any(np.isnan(buffer)) or np.any(np.isinf(buffer)):
             raise ValueError("Audio buffer contains NaN or Inf values")
         if np.max(np.abs(buffer)) > 1.0:
-            print("Normalizing audio buffer to range [-1, 1]")
+            logger.debug("Normalizing audio buffer to range [-1, 1]")
             buffer = buffer / np.max(np.abs(buffer))
-        print("Audio buffer validated successfully.")
+        logger.debug("Audio buffer validated successfully.")
         return buffer
     
     def process_iter(self):
@@ -320,6 +351,7 @@ class OnlineASRProcessor:
         logger.debug(f"CONTEXT: {non_prompt}")
         logger.debug(f"transcribing {len(self.audio_buffer)/self.SAMPLING_RATE:2.2f} seconds from {self.buffer_time_offset:2.2f}")
         res = self.asr.transcribe(self.audio_buffer, init_prompt=prompt)
+        self.last_segments = res
 
         # transform to [(beg,end,"word1"), ...]
         tsw = self.asr.ts_words(res)
@@ -327,6 +359,7 @@ class OnlineASRProcessor:
         self.transcript_buffer.insert(tsw, self.buffer_time_offset)
         o = self.transcript_buffer.flush()
         self.commited.extend(o)
+        self.scroll_commited()
         completed = self.to_flush(o)
         logger.debug(f">>>>COMPLETE NOW: {completed}")
         the_rest = self.to_flush(self.transcript_buffer.complete())
@@ -352,7 +385,7 @@ class OnlineASRProcessor:
         return self.to_flush(o)
 
     def chunk_completed_sentence(self):
-        if self.commited == []: return
+        if not self.commited: return
         logger.debug(self.commited)
         sents = self.words_to_sentences(self.commited)
         for s in sents:
@@ -368,7 +401,7 @@ class OnlineASRProcessor:
         self.chunk_at(chunk_at)
 
     def chunk_completed_segment(self, res):
-        if self.commited == []: return
+        if not self.commited: return
 
         ends = self.asr.segments_end_ts(res)
 
@@ -393,25 +426,26 @@ class OnlineASRProcessor:
         """
         self.transcript_buffer.pop_commited(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds*self.SAMPLING_RATE):]
+        self.audio.trim(int(cut_seconds*self.SAMPLING_RATE))
         self.buffer_time_offset = time
+        self.scroll_commited()
 
     def words_to_sentences(self, words):
         """Uses self.tokenizer for sentence segmentation of words.
         Returns: [(beg,end,"sentence 1"),...]
         """
         
-        cwords = [w for w in words]
+        cwords = deque(words)
         t = " ".join(o[2] for o in cwords)
-        s = self.tokenizer.split(t)
+        s = deque(self.tokenizer.split(t))
         out = []
         while s:
             beg = None
             end = None
-            sent = s.pop(0).strip()
+            sent = s.popleft().strip()
             fsent = sent
             while cwords:
-                b,e,w = cwords.pop(0)
+                b,e,w = cwords.popleft()
                 w = w.strip()
                 if beg is None and sent.startswith(w):
                     beg = b
@@ -454,42 +488,64 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
     When it detects end of speech (non-voice for 500ms), it makes OnlineASRProcessor to end the utterance immediately.
     '''
 
-    def __init__(self, online_chunk_size, *a, **kw):
+    def __init__(self, online_chunk_size, *a, vad=None, **kw):
         self.online_chunk_size = online_chunk_size
 
         self.online = OnlineASRProcessor(*a, **kw)
 
-        # VAC:
-        import torch
-        model, _ = torch.hub.load(
-            repo_or_dir='snakers4/silero-vad',
-            model='silero_vad'
-        )
-        from silero_vad_iterator import FixedVADIterator
-        self.vac = FixedVADIterator(model)  # we use the default options there: 500ms silence, 100ms padding, etc.  
+        # VAC: silero from a local model file, see silero_vad_engine.py. Pass a shared BatchedVAD as vad
+        # to run the VAD of many processors in one batch.
+        from sinks.whisper_stream.silero_vad_engine import BatchedVAD, BatchedVADIterator
+        self.vac = BatchedVADIterator(vad if vad is not None else BatchedVAD())  # we use the default options there: 500ms silence, 100ms padding, etc.  
 
         self.logfile = self.online.logfile
+        self.audio = AudioBuffer(2*self.SAMPLING_RATE)
+        self.asr_avoided = metrics.counter("asr_calls_avoided_total", "ASR passes skipped because VAD heard no speech")
         self.init()
 
+    # the wrapped processor holds the model and the transcript
+    @property
+    def asr(self):
+        return self.online.asr
+
+    @property
+    def transcript_buffer(self):
+        return self.online.transcript_buffer
+
+    @property
+    def last_segments(self):
+        return self.online.last_segments
+
     def init(self):
         self.online.init()
         self.vac.reset_states()
         self.current_online_chunk_buffer_size = 0
 
         self.is_currently_final = False
+        # True after a process_iter that ended the utterance because VAD heard the end of speech
+        self.finalized = False
+        # False after a process_iter that did not call the ASR model
+        self.ran_asr = False
 
         self.status = None  # or "voice" or "nonvoice"
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio.clear()
         self.buffer_offset = 0  # in frames
 
     def clear_buffer(self):
-        self.buffer_offset += len(self.audio_buffer)
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.buffer_offset += len(self.audio)
+        self.audio.clear()
 
 
     def insert_audio_chunk(self, audio):
+        start_time = time.perf_counter()
         res = self.vac(audio)
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        metrics.observe_stage("vad", time.perf_counter() - start_time)
+        self.insert_vad_result(audio, res)
+
+    def insert_vad_result(self, audio, res):
+        '''Second half of insert_audio_chunk, for callers that ran the VAD on audio themselves,
+        e.g. batched with other processors through VADBatcher with self.vac.key.'''
+        self.audio.append(audio)
 
         if res is not None:
             frame = list(res.values())[0]-self.buffer_offset
@@ -525,18 +581,23 @@ class VACOnlineASRProcessor(OnlineASRProcessor):
             else:
                 # We keep 1 second because VAD may later find start of voice in it.
                 # But we trim it to prevent OOM. 
-                self.buffer_offset += max(0,len(self.audio_buffer)-self.SAMPLING_RATE)
-                self.audio_buffer = self.audio_buffer[-self.SAMPLING_RATE:]
+                self.buffer_offset += self.audio.keep_last(self.SAMPLING_RATE)
 
     def process_iter(self):
+        self.finalized = False
+        self.ran_asr = False
         if self.is_currently_final:
+            self.finalized = True
             return self.finish()
         elif self.current_online_chunk_buffer_size > self.SAMPLING_RATE*self.online_chunk_size:
             self.current_online_chunk_buffer_size = 0
+            self.ran_asr = True
             ret = self.online.process_iter()
             return ret
         else:
-            print("no online update, only VAD", self.status, file=self.logfile)
+            logger.debug(f"no online update, only VAD {self.status}")
+            if self.status != 'voice':
+                self.asr_avoided.inc()
             return (None, None, "")
 
     def finish(self):
@@ -0,0 +1,22 @@
+from collections import namedtuple
+
+from sinks.phrase_filter import PhraseFilter
+
+# The fields of faster-whisper's Segment the filter reads
+Segment = namedtuple("Segment", "start end text no_speech_prob avg_logprob compression_ratio")
+
+def speech(start, end, text):
+    return Segment(start, end, text, no_speech_prob=0.05, avg_logprob=-0.3, compression_ratio=1.4)
+
+def test_segment_generator_is_read_once():
+    segments = (s for s in [speech(0.0, 1.5, " Can you turn the music down"), speech(1.5, 2.5, " a little?")])
+    assert PhraseFilter().check(" Can you turn the music down a little?", segments) is None
+
+def test_no_speech_segments_from_generator():
+    segments = (Segment(0.0, 2.0, " Thank you.", 0.9, -1.5, 1.2) for _ in range(1))
+    assert PhraseFilter().check(" Thanks for coming over", segments) == "no_speech"
+
+def test_spent_generator():
+    segments = (s for s in [speech(0.0, 1.0, " Okay then")])
+    list(segments)
+    assert PhraseFilter().check(" Okay then", segments) is None
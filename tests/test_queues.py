@@ -0,0 +1,34 @@
+from modules.queues import transcript_queue
+
+def final(user, text):
+    return {"user": user, "result": text}
+
+def partial(user, text):
+    return {"user": user, "result": text, "partial": True}
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+def test_partial_does_not_evict_finals():
+    queue = transcript_queue(2)
+    queue.put_nowait(final(1, "hello there"))
+    queue.put_nowait(final(2, "how are you"))
+    queue.put_nowait(partial(3, "what is"))
+    assert drain(queue) == [final(1, "hello there"), final(2, "how are you")]
+
+def test_final_evicts_partial_first():
+    queue = transcript_queue(2)
+    queue.put_nowait(final(1, "hello there"))
+    queue.put_nowait(partial(2, "how are"))
+    queue.put_nowait(final(3, "good morning"))
+    assert drain(queue) == [final(1, "hello there"), final(3, "good morning")]
+
+def test_partial_replaces_older_partial():
+    queue = transcript_queue(2)
+    queue.put_nowait(final(1, "hello there"))
+    queue.put_nowait(partial(2, "how are"))
+    queue.put_nowait(partial(2, "how are you"))
+    assert drain(queue) == [final(1, "hello there"), partial(2, "how are you")]